@@ -0,0 +1,78 @@
+"""
+Benchmark of conversation compaction against the mock upstreams.
+
+Keeps one long conversation going with each provider's model, once without compaction and a long window of
+dialogues, and once with compaction and a short window, the way it is meant to be configured. For each run it reports
+the size of the request bodies the upstreams received (median and over the last turns, to show whether prompts keep
+growing), the latency of the turns, and how many summary calls the compactor made. The summaries are written in the
+background, so they should not show up in the turn latency.
+
+Run from the repository root: python -m benchmarks.bench_compaction
+"""
+import argparse
+import json
+import logging
+import statistics
+import tempfile
+import time
+from benchmarks.load_test import CLAUDE_MODEL, GOOGLE_MODEL, OPENAI_MODEL, PROMPT, free_port, write_config
+from benchmarks.mock_upstreams import MockUpstreams
+from modules.Config import Config
+from modules.ModelRouter import ModelRouter
+from modules.helpers.client_helpers import create_api_clients
+
+UPSTREAM_KINDS = {OPENAI_MODEL: "openai", GOOGLE_MODEL: "gemini", CLAUDE_MODEL: "anthropic"}
+
+
+def create_router(directory: str, upstream_url: str, window: int, compaction: bool) -> ModelRouter:
+    config = Config(write_config(directory, upstream_url, free_port(), "sync", 0))
+    config.openai_max_dialogues_per_conversation = window
+    config.compaction_enabled = compaction
+    config.compaction_model = OPENAI_MODEL
+    openai_api_client, google_api_client, claude_api_client = create_api_clients(config)
+    return ModelRouter(openai_api_client=openai_api_client, google_ai_api_client=google_api_client,
+                       claude_api_client=claude_api_client, config=config)
+
+
+def bench(name: str, mock: MockUpstreams, window: int, compaction: bool, num_turns: int):
+    with tempfile.TemporaryDirectory() as directory:
+        router = create_router(directory, mock.base_url, window, compaction)
+    for model, kind in UPSTREAM_KINDS.items():
+        body_sizes, latencies = [], []
+        for turn in range(num_turns):
+            start = time.perf_counter()
+            router.send_prompt(model, f"Turn {turn}: {PROMPT}", image_url=None, conversation_id=f"{name}-{model}")
+            latencies.append(time.perf_counter() - start)
+            with mock.lock:
+                body_sizes.append(len(json.dumps(mock.last_bodies[kind])))
+        latencies.sort()
+        tail = body_sizes[-max(num_turns // 10, 1):]
+        print(f"{name:>10} {model:>26}: request body median {statistics.median(body_sizes) / 1024:6.1f} KiB, "
+              f"last turns {statistics.mean(tail) / 1024:6.1f} KiB, "
+              f"turn p50 {latencies[len(latencies) // 2] * 1000:6.1f} ms, "
+              f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:6.1f} ms")
+    if router.compactor is not None:
+        # Let the summaries of the last evictions finish before reading the counts
+        deadline = time.monotonic() + 30
+        while router.compactor.get_stats()["queued"] > 0 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        print(f"{name:>10} compactor: {router.compactor.get_stats()}")
+    router.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--window", type=int, default=20, help="dialogues kept without compaction")
+    parser.add_argument("--compacted-window", type=int, default=4, help="dialogues kept with compaction")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    with MockUpstreams(latency_ms=args.latency_ms) as mock:
+        bench("window", mock, args.window, False, args.turns)
+        bench("compacted", mock, args.compacted_window, True, args.turns)
+
+
+if __name__ == '__main__':
+    main()
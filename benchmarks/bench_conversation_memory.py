@@ -0,0 +1,143 @@
+"""
+Memory benchmark for conversations held in the containers.
+
+Fills an OpenAI and a Claude container with 10k and 100k conversations of max_dialogues_per_conversation dialogues
+each and reports the traced Python heap per conversation. The legacy layout (list storage, __dict__ dialogues
+keeping full response messages and stripped text copies) is measured alongside for comparison. Last, every turn is
+asked of all three providers at once, with each model's branch holding its own copy of the turn ("copies") and with
+the branches sharing it through the turn store ("shared").
+
+Run from the repository root: python -m benchmarks.bench_conversation_memory
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from modules.ConversationContainer import (ClaudeConversationContainer, GoogleConversationContainer,
+                                           OpenAIConversationContainer)
+from modules.TurnStore import Turn, TurnStore
+
+MODEL = "gpt-4o"
+DIALOGUES_PER_CONVERSATION = 5
+
+
+class LegacyOpenAIDialogue:
+    def __init__(self, prompt_message: dict, response_message: dict, prompt_num_tokens: int, response_num_tokens: int):
+        self.prompt_message = prompt_message
+        self.prompt_text = prompt_message["content"][0]["text"].strip()
+        self.response_message = response_message
+        self.response_text = response_message["content"].strip()
+        self.prompt_num_tokens = prompt_num_tokens
+        self.response_num_tokens = response_num_tokens
+        self.total_num_tokens = self.prompt_num_tokens + self.response_num_tokens
+
+
+class LegacyOpenAIConversation:
+    def __init__(self, max_length: int, model: str):
+        self.max_length = max_length
+        self.update_epoch = time.time()
+        self.dialogues = []
+        self.model = model
+
+
+def make_turn(conversation_index: int, dialogue_index: int):
+    prompt = f"  What should I do in world {conversation_index}, turn {dialogue_index}?  "
+    response = f"\nIn world {conversation_index} you could explore the lake, then talk to the greeter. " * 3
+    prompt_message = {"role": "user", "content": [{"type": "text", "text": prompt}]}
+    response_message = {"role": "assistant", "content": response, "refusal": None, "annotations": []}
+    return prompt_message, response_message
+
+
+def measure(label: str, num_conversations: int, fill):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    holder = fill(num_conversations)
+    seconds = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:15s} {num_conversations:>7d} conversations: {current / 1024 / 1024:8.1f} MiB "
+          f"({current / num_conversations:7.0f} B/conversation) built in {seconds:.2f}s")
+    del holder
+
+
+def fill_legacy(num_conversations: int):
+    conversations = {}
+    for i in range(num_conversations):
+        conversation = LegacyOpenAIConversation(max_length=DIALOGUES_PER_CONVERSATION, model=MODEL)
+        for j in range(DIALOGUES_PER_CONVERSATION):
+            prompt_message, response_message = make_turn(i, j)
+            conversation.dialogues.append(LegacyOpenAIDialogue(prompt_message, response_message, 12, 60))
+        conversations[str(i)] = conversation
+    return conversations
+
+
+def fill_openai(num_conversations: int):
+    container = OpenAIConversationContainer(conversation_prune_after_seconds=0,
+                                            max_dialogues_per_conversation=DIALOGUES_PER_CONVERSATION,
+                                            max_conversations=0)
+    for i in range(num_conversations):
+        conversation = container.get_conversation(str(i), MODEL)
+        for j in range(DIALOGUES_PER_CONVERSATION):
+            prompt_message, response_message = make_turn(i, j)
+            # Token counts are passed in so the benchmark measures storage rather than tokenization
+            conversation.add(turn=Turn(prompt_message["content"][0]["text"]), response_text=response_message["content"],
+                             prompt_num_tokens=12)
+    return container
+
+
+def fill_claude(num_conversations: int):
+    container = ClaudeConversationContainer(conversation_prune_after_seconds=0,
+                                            max_dialogues_per_conversation=DIALOGUES_PER_CONVERSATION,
+                                            model="claude", max_conversations=0)
+    for i in range(num_conversations):
+        conversation = container.get_conversation(str(i), "claude")
+        for j in range(DIALOGUES_PER_CONVERSATION):
+            prompt_message, response_message = make_turn(i, j)
+            conversation.add(turn=Turn(prompt_message["content"][0]["text"]), response_text=response_message["content"],
+                             prompt_num_tokens=12, response_num_tokens=60)
+    return container
+
+
+def fill_fan_out(num_conversations: int, turn_store: TurnStore = None):
+    options = dict(conversation_prune_after_seconds=0, max_dialogues_per_conversation=DIALOGUES_PER_CONVERSATION,
+                   max_conversations=0)
+    containers = (OpenAIConversationContainer(**options), ClaudeConversationContainer(model="claude", **options),
+                  GoogleConversationContainer(model="gemini", **options))
+    models = (MODEL, "claude", "gemini")
+    for i in range(num_conversations):
+        conversations = [container.get_conversation(str(i), model) for container, model in zip(containers, models)]
+        for j in range(DIALOGUES_PER_CONVERSATION):
+            prompt_message, response_message = make_turn(i, j)
+            prompt = prompt_message["content"][0]["text"]
+            for conversation in conversations:
+                # Without a store each model keeps its own copy of the prompt, as its message format used to
+                turn = turn_store.get_turn(prompt) if turn_store is not None else Turn("".join(list(prompt)))
+                # Each model answers in its own words, only the turn can be shared
+                response = "".join(list(response_message["content"]))
+                if conversation.model == MODEL:
+                    conversation.add(turn=turn, response_text=response, prompt_num_tokens=12)
+                else:
+                    conversation.add(turn=turn, response_text=response, prompt_num_tokens=12, response_num_tokens=60)
+    return containers
+
+
+def fill_fan_out_shared(num_conversations: int):
+    return fill_fan_out(num_conversations, TurnStore())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000")
+    args = parser.parse_args()
+
+    for size in [int(size) for size in args.sizes.split(",")]:
+        measure("legacy", size, fill_legacy)
+        measure("openai", size, fill_openai)
+        measure("claude", size, fill_claude)
+        measure("3 models copies", size, fill_fan_out)
+        measure("3 models shared", size, fill_fan_out_shared)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark for the SQLite conversation store.
+
+Fills a Claude container backed by a fresh store with N conversations of max_dialogues_per_conversation dialogues
+each, then reports how long the request threads spent on it (against the same fill without a store), how long the
+writer needed to make everything durable, and the write throughput. It then "restarts": opens the store and a new
+container again, and reports the time until the server could serve, the first lazy load, and the average load latency
+over a sample of conversations.
+
+Run from the repository root: python -m benchmarks.bench_conversation_store
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import Optional
+from modules.ConversationContainer import ClaudeConversationContainer
+from modules.ConversationStore import SQLiteConversationStore
+from modules.TurnStore import Turn
+
+MODEL = "claude"
+DIALOGUES_PER_CONVERSATION = 5
+
+
+def make_container(store: Optional[SQLiteConversationStore]) -> ClaudeConversationContainer:
+    # max_conversations bounds memory as a deployment would, older conversations are only in the store
+    return ClaudeConversationContainer(conversation_prune_after_seconds=0,
+                                       max_dialogues_per_conversation=DIALOGUES_PER_CONVERSATION,
+                                       model=MODEL, max_conversations=10000, store=store)
+
+
+def make_turn(conversation_index: int, dialogue_index: int):
+    prompt = f"What should I do in world {conversation_index}, turn {dialogue_index}?"
+    response = f"In world {conversation_index} you could explore the lake, then talk to the greeter. " * 3
+    return Turn(prompt), response
+
+
+def fill(container: ClaudeConversationContainer, num_conversations: int):
+    for i in range(num_conversations):
+        conversation = container.get_conversation(str(i), MODEL)
+        for j in range(DIALOGUES_PER_CONVERSATION):
+            turn, response_text = make_turn(i, j)
+            conversation.add(turn=turn, response_text=response_text)
+
+
+def bench_writes(path: str, num_conversations: int, batch_size: int):
+    start = time.perf_counter()
+    fill(make_container(None), num_conversations)
+    baseline_seconds = time.perf_counter() - start
+
+    store = SQLiteConversationStore(path, batch_size=batch_size)
+    container = make_container(store)
+    start = time.perf_counter()
+    fill(container, num_conversations)
+    request_seconds = time.perf_counter() - start
+    store.flush(timeout_seconds=3600)
+    durable_seconds = time.perf_counter() - start
+    stats = store.get_stats()
+    store.close()
+
+    num_saves = num_conversations * DIALOGUES_PER_CONVERSATION
+    print(f"writes   {num_conversations:>7d} conversations, {num_saves} saves: "
+          f"{request_seconds:.2f}s on request threads ({request_seconds / num_saves * 1e6:.1f} us/save), "
+          f"durable after {durable_seconds:.2f}s ({baseline_seconds:.2f}s without a store)")
+    print(f"         {stats['written']} rows in {stats['batches']} batches, "
+          f"{stats['written'] / durable_seconds:,.0f} rows/s, {os.path.getsize(path) / 1024 / 1024:.1f} MiB on disk")
+
+
+def bench_restart(path: str, num_conversations: int, num_samples: int):
+    start = time.perf_counter()
+    store = SQLiteConversationStore(path)
+    container = make_container(store)
+    ready_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    container.get_conversation("0", MODEL)
+    first_load_seconds = time.perf_counter() - start
+
+    sample = random.sample(range(num_conversations), min(num_samples, num_conversations))
+    start = time.perf_counter()
+    for i in sample:
+        assert len(container.get_conversation(str(i), MODEL).dialogues) == DIALOGUES_PER_CONVERSATION
+    load_seconds = time.perf_counter() - start
+    store.close()
+
+    print(f"restart  ready to serve in {ready_seconds * 1000:.1f} ms, first load {first_load_seconds * 1000:.2f} ms, "
+          f"{load_seconds / len(sample) * 1e6:.0f} us/load over {len(sample)} conversations")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--samples", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "conversations.sqlite3")
+        bench_writes(path, args.conversations, args.batch_size)
+        bench_restart(path, args.conversations, args.samples)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Memory benchmark for images held in conversation history.
+
+Fills Gemini and Claude containers with conversations whose turns each carry an image, and reports the memory they
+hold per conversation: the traced Python heap, and the growth of the process's resident memory, which also covers
+the pixel buffers PIL allocates outside the Python heap. Images are kept with every turn (no image window), to show
+what the history itself costs. Each turn gets its own copy of the image's bytes, as it would from a download.
+The legacy forms, a decoded PIL image per Gemini turn and a base64 string per Claude turn, are measured alongside the
+shared image store. Each run is done with every image distinct, and with a few images shared by all conversations,
+as when everyone in a world asks about the same thing.
+
+Run from the repository root: python -m benchmarks.bench_image_memory
+"""
+import argparse
+import base64
+import gc
+import os
+import random
+import time
+import tracemalloc
+from io import BytesIO
+import PIL.Image
+from modules.ConversationContainer import ClaudeConversationContainer, GoogleConversationContainer
+from modules.ImageStore import ImageStore
+from modules.TurnStore import Turn
+
+MODEL = "bench-model"
+DIALOGUES_PER_CONVERSATION = 3
+IMAGE_SIZE = (512, 384)
+
+
+def make_jpeg(seed: int) -> bytes:
+    # Small blocks of random colour, so the JPEG is about the size of a screenshot's
+    rng = random.Random(seed)
+    image = PIL.Image.new("RGB", IMAGE_SIZE)
+    for x in range(0, IMAGE_SIZE[0], 8):
+        for y in range(0, IMAGE_SIZE[1], 8):
+            image.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)), (x, y, x + 8, y + 8))
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=85)
+    return buffered.getvalue()
+
+
+def google_legacy_part(data: bytes, image_store: ImageStore):
+    image = PIL.Image.open(BytesIO(data))
+    # The SDK needs the pixels to send it, so the decoded buffer stays alive with the conversation
+    image.load()
+    return image
+
+
+def google_store_part(data: bytes, image_store: ImageStore):
+    return image_store.intern(data, "image/jpeg")
+
+
+def claude_legacy_part(data: bytes, image_store: ImageStore) -> dict:
+    return {"type": "base64", "media_type": "image/jpeg", "data": base64.b64encode(data).decode("ascii")}
+
+
+def claude_store_part(data: bytes, image_store: ImageStore):
+    return image_store.intern(data, "image/jpeg")
+
+
+def fill_google(num_conversations: int, images: list, make_part):
+    image_store = ImageStore()
+    container = GoogleConversationContainer(conversation_prune_after_seconds=0,
+                                            max_dialogues_per_conversation=DIALOGUES_PER_CONVERSATION,
+                                            model=MODEL, max_conversations=0)
+    for i in range(num_conversations):
+        conversation = container.get_conversation(str(i), MODEL)
+        for j in range(DIALOGUES_PER_CONVERSATION):
+            data = bytes(bytearray(images[(i * DIALOGUES_PER_CONVERSATION + j) % len(images)]))
+            # Token counts are passed in so the benchmark measures storage rather than tokenization
+            conversation.add(turn=Turn("What is this?"), response_text="A picture of coloured squares.",
+                             image=make_part(data, image_store), prompt_num_tokens=300, response_num_tokens=8)
+    return container, image_store
+
+
+def fill_claude(num_conversations: int, images: list, make_part):
+    image_store = ImageStore()
+    container = ClaudeConversationContainer(conversation_prune_after_seconds=0,
+                                            max_dialogues_per_conversation=DIALOGUES_PER_CONVERSATION,
+                                            model=MODEL, max_conversations=0)
+    for i in range(num_conversations):
+        conversation = container.get_conversation(str(i), MODEL)
+        for j in range(DIALOGUES_PER_CONVERSATION):
+            data = bytes(bytearray(images[(i * DIALOGUES_PER_CONVERSATION + j) % len(images)]))
+            conversation.add(turn=Turn("What is this?"), response_text="A picture of coloured squares.",
+                             image=make_part(data, image_store), prompt_num_tokens=300, response_num_tokens=8)
+    return container, image_store
+
+
+def get_resident_bytes() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def measure(label: str, num_conversations: int, images: list, fill, make_part):
+    gc.collect()
+    resident_before = get_resident_bytes()
+    tracemalloc.start()
+    start = time.perf_counter()
+    holder = fill(num_conversations, images, make_part)
+    seconds = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    resident = get_resident_bytes() - resident_before
+    print(f"{label:14s} {num_conversations:>5d} conversations, {len(images):>5d} images: "
+          f"heap {current / 1024 / 1024:7.1f} MiB, resident +{resident / 1024 / 1024:7.1f} MiB "
+          f"({max(current, resident) / num_conversations / 1024:7.1f} KiB/conversation), built in {seconds:.2f}s")
+    del holder
+    gc.collect()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=300)
+    parser.add_argument("--shared-images", type=int, default=10)
+    args = parser.parse_args()
+
+    distinct = [make_jpeg(seed) for seed in range(args.conversations * DIALOGUES_PER_CONVERSATION)]
+    print(f"Images are {IMAGE_SIZE[0]}x{IMAGE_SIZE[1]} JPEGs of about {len(distinct[0]) / 1024:.0f} KiB")
+    # Resident memory freed by one run is reused by the next, so the legacy runs, which hold the most, go first
+    for images in (distinct, distinct[:args.shared_images]):
+        measure("google legacy", args.conversations, images, fill_google, google_legacy_part)
+        measure("claude legacy", args.conversations, images, fill_claude, claude_legacy_part)
+        measure("google store", args.conversations, images, fill_google, google_store_part)
+        measure("claude store", args.conversations, images, fill_claude, claude_store_part)
+
+
+if __name__ == '__main__':
+    main()
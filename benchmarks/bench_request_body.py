@@ -0,0 +1,95 @@
+"""
+Micro-benchmark of building and serializing the OpenAI request body against conversation length.
+
+For each length, a conversation is kept full while new turns are added, as in a long session, and every request body
+is built the old way (the history rendered to messages and the whole body passed through json.dumps) and spliced
+together from the encoded fragments the dialogues keep. The spliced time includes encoding the newest dialogue's
+fragment, which is done once when it is added. When orjson is installed, json_helpers uses it for both the fragments
+and the rest of the body; the old way is also timed with orjson to tell the codec's share from the splicing's.
+
+Run from the repository root: python -m benchmarks.bench_request_body
+"""
+import argparse
+import json
+import time
+from modules.Conversation import OpenAIConversation
+from modules.Dialogue import OpenAIDialogue
+from modules.TurnStore import Turn
+from modules.helpers.json_helpers import JSON_CODEC, EncodedMessages, dumps_body, encode_messages, orjson
+
+MODEL = "gpt-4o"
+SYSTEM_MESSAGE = {"role": "system", "content": [{"type": "text", "text": "You are a helpful guide in a virtual world."}]}
+PROMPT = "What should I do next in this world, and who should I talk to first?"
+RESPONSE = "You could explore the lake, then talk to the greeter by the fountain about the events tonight. " * 4
+
+
+def make_conversation(length: int) -> OpenAIConversation:
+    conversation = OpenAIConversation(max_length=length, model=MODEL)
+    for i in range(length):
+        add_turn(conversation, i)
+    return conversation
+
+
+def add_turn(conversation: OpenAIConversation, i: int):
+    # Token counts are passed in so the benchmark measures serialization rather than tokenization
+    conversation.add(turn=Turn(f"{PROMPT} ({i})"), response_text=RESPONSE, prompt_num_tokens=20)
+
+
+def legacy_body(conversation: OpenAIConversation, prompt_message: dict, dumps) -> bytes:
+    messages = [SYSTEM_MESSAGE] + conversation.build_messages_for_api(tuple(conversation.dialogues))
+    messages.append(prompt_message)
+    return dumps({"model": MODEL, "messages": messages, "max_tokens": 1000, "temperature": 0.7})
+
+
+def spliced_body(conversation: OpenAIConversation, prompt_message: dict, encoded_system_message: bytes) -> bytes:
+    fragments, count = conversation.get_encoded_messages()
+    fragments = [encoded_system_message] + fragments + [encode_messages([prompt_message])]
+    messages = EncodedMessages(fragments, count + 2, prompt_message)
+    return dumps_body({"model": MODEL, "messages": messages, "max_tokens": 1000, "temperature": 0.7})
+
+
+def time_requests(conversation: OpenAIConversation, requests: int, build) -> float:
+    """Seconds per request, each one after a new turn was added."""
+    seconds = 0.0
+    for i in range(requests):
+        add_turn(conversation, i)
+        prompt_message = OpenAIDialogue.render_prompt(Turn(f"{PROMPT} [{i}]"))
+        start = time.perf_counter()
+        build(conversation, prompt_message)
+        seconds += time.perf_counter() - start
+    return seconds / requests
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", default="1,5,20,50,200")
+    parser.add_argument("--requests", type=int, default=500)
+    args = parser.parse_args()
+
+    encoded_system_message = encode_messages([SYSTEM_MESSAGE])
+    builds = {
+        "json.dumps": lambda conversation, prompt_message: legacy_body(
+            conversation, prompt_message, lambda body: json.dumps(body).encode("utf-8")),
+    }
+    if orjson is not None:
+        builds["orjson.dumps"] = lambda conversation, prompt_message: legacy_body(
+            conversation, prompt_message, orjson.dumps)
+
+    def spliced(conversation, prompt_message):
+        spliced_body(conversation, prompt_message, encoded_system_message)
+        # Paid once per dialogue, when it is added
+        conversation.dialogues[-1].encode(RESPONSE)
+    builds["spliced"] = spliced
+
+    print(f"codec={JSON_CODEC} requests={args.requests}, microseconds per request body:")
+    print(f"{'dialogues':>9s} {'body KiB':>9s} " + " ".join(f"{label:>13s}" for label in builds))
+    for length in [int(length) for length in args.lengths.split(",")]:
+        conversation = make_conversation(length)
+        body_bytes = len(spliced_body(conversation, OpenAIDialogue.render_prompt(Turn(PROMPT)),
+                                      encoded_system_message))
+        timings = [time_requests(conversation, args.requests, build) for build in builds.values()]
+        print(f"{length:>9d} {body_bytes / 1024:>9.1f} " + " ".join(f"{seconds * 1e6:>13.1f}" for seconds in timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark of the per-request tokenization cost of the OpenAI path.
+
+Compares the old behaviour (an encoding_for_model lookup for every count, plus a trim that re-sums every dialogue
+on each loop iteration) with the cached encodings and running token totals.
+
+Run from the repository root: python -m benchmarks.bench_tokenizer
+"""
+import argparse
+import time
+import tiktoken
+from modules.Conversation import OpenAIConversation
+from modules.TurnStore import Turn
+from modules.helpers.prompt_helpers import get_num_tokens_from_string, get_encoding, ApproximateEncoding
+
+PROMPT = "Can you describe the world we're standing in right now, and what the best thing to do here is?"
+RESPONSE = ("This world is a cozy lakeside cabin at dusk. The best thing to do is sit by the fire, "
+            "grab a drink from the counter and watch the fireflies over the water. ") * 4
+
+
+def legacy_num_tokens(string: str, model: str) -> int:
+    encoding = tiktoken.encoding_for_model(model)
+    return len(encoding.encode(string))
+
+
+def legacy_request(model: str, dialogue_tokens: list, token_limit: int):
+    # One count for the prompt, then two in OpenAIDialogue.__init__
+    prompt_tokens = legacy_num_tokens(PROMPT, model)
+    legacy_num_tokens(PROMPT, model)
+    legacy_num_tokens(RESPONSE, model)
+    dialogues = list(dialogue_tokens)
+    while len(dialogues) > 0 and sum(dialogues) + prompt_tokens >= token_limit:
+        dialogues.pop(0)
+
+
+def cached_request(model: str, conversation: OpenAIConversation, token_limit: int):
+    prompt_tokens = get_num_tokens_from_string(PROMPT, model)
+    conversation.trim(prompt_tokens=prompt_tokens, token_limit=token_limit)
+    conversation.add(turn=Turn(PROMPT), response_text=RESPONSE, prompt_num_tokens=prompt_tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--dialogues", type=int, default=50)
+    args = parser.parse_args()
+
+    if isinstance(get_encoding(args.model), ApproximateEncoding):
+        print("tiktoken encodings could not be loaded (no network?), the comparison would be meaningless")
+        return
+
+    per_dialogue = get_num_tokens_from_string(PROMPT, args.model) + get_num_tokens_from_string(RESPONSE, args.model)
+    # A limit that forces one dialogue out of a full conversation each turn
+    token_limit = per_dialogue * args.dialogues
+
+    dialogue_tokens = [per_dialogue] * args.dialogues
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        legacy_request(args.model, dialogue_tokens, token_limit)
+    legacy_seconds = time.perf_counter() - start
+
+    conversation = OpenAIConversation(max_length=args.dialogues, model=args.model)
+    for _ in range(args.dialogues):
+        cached_request(args.model, conversation, token_limit * 2)
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        cached_request(args.model, conversation, token_limit)
+    cached_seconds = time.perf_counter() - start
+
+    print(f"model={args.model} requests={args.requests} dialogues={args.dialogues}")
+    print(f"legacy: {legacy_seconds / args.requests * 1e6:9.1f} us/request")
+    print(f"cached: {cached_seconds / args.requests * 1e6:9.1f} us/request")
+    print(f"speedup: {legacy_seconds / cached_seconds:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Throughput benchmark for the multi-process worker pool.
+
+Every worker runs a real OpenAIAPIClient whose post() is replaced by a canned completion, so each request does the
+work a worker does in production (conversation lookup and trim, token counts, serializing the body, parsing the
+response, adding the turn) without a network. Requests are spread over a set of conversations and kept at a fixed
+concurrency, for 1, 2, 4 and 8 workers. --upstream-ms adds a simulated upstream delay per request.
+
+Throughput can only grow with the number of workers up to the number of cores of the machine.
+
+Run from the repository root: python -m benchmarks.bench_workers
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterator, Optional
+from modules.OpenAIAPIClient import OpenAIAPIClient
+from modules.WorkerPool import WorkerPool
+
+MODEL = "gpt-4o"
+PROMPT = "Can you describe the world we're standing in right now, and what the best thing to do here is?"
+RESPONSE = ("This world is a cozy lakeside cabin at dusk. The best thing to do is sit by the fire, "
+            "grab a drink from the counter and watch the fireflies over the water. ") * 4
+COMPLETION = json.dumps({"choices": [{"message": {"role": "assistant", "content": RESPONSE}}]})
+
+
+class CannedOpenAIAPIClient(OpenAIAPIClient):
+    upstream_seconds = 0.0
+
+    def post(self, body: dict, headers: dict, path: str):
+        json.dumps(body)
+        if self.upstream_seconds:
+            time.sleep(self.upstream_seconds)
+        return COMPLETION
+
+
+class BenchmarkRouter:
+    def __init__(self, client: CannedOpenAIAPIClient):
+        self.client = client
+
+    def get_provider(self, model: str) -> Optional[str]:
+        return "openai"
+
+    def send_prompt(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                    deadline: Optional[float] = None) -> str:
+        return self.client.send_prompt(prompt=text, model=model, image_url=image_url, conversation_id=conversation_id,
+                                       deadline=deadline)
+
+    def stream_prompt(self, model: str, text: str, image_url: str, conversation_id: Optional[str]) -> Iterator[str]:
+        return iter([self.send_prompt(model, text, image_url, conversation_id)])
+
+    def get_stats(self) -> dict:
+        return self.client.conversations.get_stats()
+
+    def close(self):
+        self.client.conversations.close()
+
+
+def create_benchmark_router(config_path: str) -> BenchmarkRouter:
+    # The config path carries the simulated upstream delay, workers are spawned and can't see our globals
+    logging.getLogger("modules.helpers.logging_helper").setLevel(logging.ERROR)
+    CannedOpenAIAPIClient.upstream_seconds = float(config_path) / 1000
+    client = CannedOpenAIAPIClient(base_url="http://upstream", path="/v1/chat/completions", api_key="key",
+                                   max_conversation_tokens=4096, max_response_tokens=400,
+                                   max_dialogues_per_conversation=10, conversation_prune_after_seconds=3600,
+                                   temperature=0.7, system_message="You are a helpful guide in a virtual world.")
+    return BenchmarkRouter(client)
+
+
+def bench(num_workers: int, num_requests: int, num_conversations: int, concurrency: int, upstream_ms: float):
+    pool = WorkerPool(config_path=str(upstream_ms), num_workers=num_workers, threads_per_worker=concurrency,
+                      router_factory=create_benchmark_router)
+    try:
+        # Warm up every worker, imports and the tokenizer are loaded on first use
+        for index in range(num_conversations):
+            pool.send_prompt(MODEL, PROMPT, None, f"warmup-{index}")
+
+        slots = threading.Semaphore(concurrency)
+        done = threading.Event()
+        remaining = [num_requests]
+        lock = threading.Lock()
+
+        def on_done(future):
+            slots.release()
+            future.result()
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    done.set()
+
+        start = time.perf_counter()
+        for i in range(num_requests):
+            slots.acquire()
+            pool.submit_prompt(MODEL, PROMPT, None, f"conversation-{i % num_conversations}").add_done_callback(on_done)
+        done.wait()
+        seconds = time.perf_counter() - start
+    finally:
+        pool.close()
+
+    print(f"{num_workers} workers: {num_requests} requests in {seconds:.2f}s, {num_requests / seconds:,.0f} requests/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--conversations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--upstream-ms", type=float, default=0)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} cores")
+    for num_workers in args.workers:
+        bench(num_workers, args.requests, args.conversations, args.concurrency, args.upstream_ms)
+
+
+if __name__ == '__main__':
+    main()
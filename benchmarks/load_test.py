@@ -0,0 +1,268 @@
+"""
+Offline load test of /prompt.
+
+Starts the mock OpenAI, Anthropic and Gemini upstreams from benchmarks/mock_upstreams.py, writes a config from
+config_sample.ini that points every client at them, and runs main.py as a separate process, the way it is deployed.
+Each scenario then sends synthetic Neos traffic from --concurrency threads:
+
+    single         one OpenAI model, no conversation
+    multi          all three providers in one request
+    image          Gemini and Claude describing one of a handful of images
+    conversation   every thread keeps one conversation going for many turns
+
+and reports throughput, p50/p95/p99 latency, and the server's resident memory (all processes, including workers)
+after the scenario and at its peak.
+
+Results are compared against benchmarks/load_test_baseline.json when it was recorded with the same settings; a
+throughput drop or a p95 increase larger than --tolerance exits with status 1. --save-baseline records a new one.
+
+Run from the repository root: python -m benchmarks.load_test
+"""
+import argparse
+import configparser
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+import httpx
+from benchmarks.mock_upstreams import MockUpstreams
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPOSITORY_ROOT, "benchmarks", "load_test_baseline.json")
+
+OPENAI_MODEL = "gpt-4o"
+GOOGLE_MODEL = "gemini-1.5-flash"
+CLAUDE_MODEL = "claude-3-5-sonnet-latest"
+PROMPT = "Can you describe the world we're standing in right now, and what the best thing to do here is?"
+NUM_IMAGES = 8
+SCENARIOS = ("single", "multi", "image", "conversation")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_config(directory: str, upstream_url: str, port: int, mode: str, workers: int) -> str:
+    config = configparser.ConfigParser()
+    config.read(os.path.join(REPOSITORY_ROOT, "config_sample.ini"))
+    for section in ("openai_api_client", "google_api_client", "claude_api_client"):
+        config[section]["api_key"] = "load-test"
+    config["openai_api_client"]["base_url"] = upstream_url
+    config["google_api_client"]["base_url"] = upstream_url
+    config["claude_api_client"]["base_url"] = upstream_url
+    config["openai_api_client"]["max_dialogues_per_conversation"] = "20"
+    config["server"]["host"] = "127.0.0.1"
+    config["server"]["port"] = str(port)
+    config["server"]["whitelist_enabled"] = "False"
+    config["server"]["mode"] = mode
+    config["server"]["workers"] = str(workers)
+    config["rate_limit"]["caller_requests_per_minute"] = "0"
+    path = os.path.join(directory, "config.ini")
+    with open(path, "w") as f:
+        config.write(f)
+    return path
+
+
+def start_server(directory: str, port: int, log_file) -> subprocess.Popen:
+    # main.py reads config.ini from its working directory
+    process = subprocess.Popen([sys.executable, os.path.join(REPOSITORY_ROOT, "main.py")], cwd=directory,
+                               stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode}, see {log_file.name}")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("The server did not start listening within 60 seconds")
+
+
+def get_rss_bytes(pid: int) -> Dict[str, int]:
+    """Current and peak resident memory of a process and its children, from /proc (Linux only)."""
+    total = {"rss": 0, "peak_rss": 0}
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids.extend(int(child) for child in f.read().split())
+    except OSError:
+        pass
+    for process_id in pids:
+        try:
+            with open(f"/proc/{process_id}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total["rss"] += int(line.split()[1]) * 1024
+                    elif line.startswith("VmHWM:"):
+                        total["peak_rss"] += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def percentile(sorted_samples: List[float], percent: float) -> Optional[float]:
+    if not sorted_samples:
+        return None
+    return sorted_samples[min(int(len(sorted_samples) * percent / 100), len(sorted_samples) - 1)]
+
+
+class Scenario:
+    """Builds the query parameters of the n-th request a thread sends."""
+    def __init__(self, name: str, upstream_url: str):
+        self.name = name
+        self.upstream_url = upstream_url
+
+    def params(self, thread_state: dict, n: int) -> dict:
+        if self.name == "single":
+            return {"models": OPENAI_MODEL}
+        if self.name == "multi":
+            return {"models": f"{OPENAI_MODEL},{GOOGLE_MODEL},{CLAUDE_MODEL}"}
+        if self.name == "image":
+            # Neos clients send image URLs with | in place of /
+            image_url = f"{self.upstream_url}/images/{n % NUM_IMAGES}.png".replace("/", "|")
+            return {"models": f"{GOOGLE_MODEL},{CLAUDE_MODEL}", "image_url": image_url}
+        conversation_id = thread_state.setdefault("conversation_id", str(uuid.uuid4()))
+        return {"models": OPENAI_MODEL, "conversation_id": conversation_id}
+
+
+def run_scenario(base_url: str, scenario: Scenario, num_requests: int, concurrency: int,
+                 get_memory: Callable[[], Dict[str, int]]) -> dict:
+    latencies: List[float] = []
+    errors = [0]
+    lock = threading.Lock()
+    next_request = [0]
+
+    def worker():
+        thread_state = {}
+        with httpx.Client(base_url=base_url, timeout=120) as client:
+            while True:
+                with lock:
+                    n = next_request[0]
+                    next_request[0] += 1
+                if n >= num_requests:
+                    return
+                start = time.perf_counter()
+                try:
+                    response = client.post("/prompt", params=scenario.params(thread_state, n),
+                                           content=f"{PROMPT} ({n})".encode("utf-8"))
+                    failed = response.status_code != 200
+                except httpx.HTTPError:
+                    failed = True
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    memory = get_memory()
+    return {
+        "requests": num_requests,
+        "errors": errors[0],
+        "requests_per_second": round(num_requests / seconds, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "rss_mb": round(memory["rss"] / 1024 / 1024, 1),
+        "peak_rss_mb": round(memory["peak_rss"] / 1024 / 1024, 1),
+    }
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        throughput_change = result["requests_per_second"] / previous["requests_per_second"] - 1
+        p95_change = result["p95_ms"] / previous["p95_ms"] - 1
+        print(f"  {name:<13} throughput {throughput_change:+.1%}, p95 {p95_change:+.1%} against the baseline")
+        if throughput_change < -tolerance:
+            regressions.append(f"{name}: throughput fell {-throughput_change:.1%}")
+        if p95_change > tolerance:
+            regressions.append(f"{name}: p95 rose {p95_change:.1%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=400, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=50, help="unmeasured requests before each scenario")
+    parser.add_argument("--latency-ms", type=float, default=50, help="mean upstream latency")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync")
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression against the baseline")
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    settings = {"requests": args.requests, "concurrency": args.concurrency, "warmup": args.warmup,
+                "latency_ms": args.latency_ms,
+                "jitter_ms": args.jitter_ms, "mode": args.mode, "workers": args.workers}
+    results = {}
+    with MockUpstreams(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms) as upstreams, \
+            tempfile.TemporaryDirectory() as directory:
+        port = free_port()
+        write_config(directory, upstreams.base_url, port, args.mode, args.workers)
+        with open(os.path.join(directory, "server.log"), "w") as log_file:
+            server = start_server(directory, port, log_file)
+            try:
+                for name in args.scenarios:
+                    scenario = Scenario(name, upstreams.base_url)
+                    get_memory = lambda: get_rss_bytes(server.pid)
+                    # Lets lazily created clients, connections and workers settle first
+                    run_scenario(f"http://127.0.0.1:{port}", scenario, args.warmup, args.concurrency, get_memory)
+                    result = run_scenario(f"http://127.0.0.1:{port}", scenario, args.requests, args.concurrency,
+                                          get_memory)
+                    results[name] = result
+                    print(f"{name:<13} {result['requests_per_second']:>7.1f} req/s  p50 {result['p50_ms']:>7.1f} ms  "
+                          f"p95 {result['p95_ms']:>7.1f} ms  p99 {result['p99_ms']:>7.1f} ms  "
+                          f"rss {result['rss_mb']:.0f} MiB (peak {result['peak_rss_mb']:.0f})  "
+                          f"{result['errors']} errors")
+            finally:
+                server.terminate()
+                server.wait(30)
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump({"settings": settings, "cpu_count": os.cpu_count(), "python": platform.python_version(),
+                       "results": results}, f, indent=2)
+            f.write("\n")
+        print(f"Saved the baseline to {BASELINE_PATH}")
+        return
+
+    if not os.path.exists(BASELINE_PATH):
+        return
+    with open(BASELINE_PATH) as f:
+        baseline = json.load(f)
+    if baseline["settings"] != settings:
+        print("The baseline was recorded with different settings, not comparing")
+        return
+    regressions = compare(results, baseline["results"], args.tolerance)
+    if regressions:
+        print("Regressions: " + "; ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,286 @@
+"""
+Local stand-ins for the OpenAI chat completions, Anthropic messages and Gemini generateContent endpoints, plus an image
+host, so the server can be load tested and integration tested without API keys or spending money.
+
+Every endpoint answers after a configurable latency with uniform jitter. Replies echo the start of the last prompt so
+callers can tell them apart. fail_next() makes an upstream answer its next requests with an error status instead, to
+exercise retries and circuit breakers. Streamed requests (OpenAI and Anthropic with "stream": true, Gemini's
+streamGenerateContent) are answered one word per chunk, as server-sent events or, for Gemini, a streamed JSON array.
+
+Run from the repository root to serve them until interrupted: python -m benchmarks.mock_upstreams --port 8090
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from typing import Optional
+from PIL import Image
+
+OPENAI_PATH = "/v1/chat/completions"
+ANTHROPIC_PATH = "/v1/messages"
+GEMINI_PATH_SUFFIX = ":generateContent"
+GEMINI_STREAM_PATH_SUFFIX = ":streamGenerateContent"
+IMAGE_PATH_PREFIX = "/images/"
+
+
+def make_png(seed: int, size: int = 256) -> bytes:
+    image = Image.new("RGB", (size, size), ((seed * 67) % 256, (seed * 151) % 256, (seed * 29) % 256))
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return buffered.getvalue()
+
+
+def last_prompt_text(value) -> str:
+    """The text of the last user turn, in any of the three request formats."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, list):
+        for item in reversed(value):
+            text = last_prompt_text(item)
+            if text:
+                return text
+        return ""
+    if isinstance(value, dict):
+        for key in ("text", "content", "parts"):
+            if key in value:
+                return last_prompt_text(value[key])
+    return ""
+
+
+class MockUpstreams:
+    """The mock endpoints on one ThreadingHTTPServer, started in a background thread."""
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency_ms: float = 0, jitter_ms: float = 0,
+                 response_words: int = 40):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.response_words = response_words
+        self.lock = threading.Lock()
+        self.requests = {"openai": 0, "anthropic": 0, "gemini": 0, "image": 0}
+        # The most recent request body per upstream, for tests
+        self.last_bodies = {}
+        self.images = {}
+        # Errors to answer the next requests with, per upstream, as (status, retry_after) pairs
+        self.pending_failures = {"openai": [], "anthropic": [], "gemini": []}
+
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                mock.handle_get(self)
+
+            def do_POST(self):
+                mock.handle_post(self)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockUpstreams":
+        self.thread = threading.Thread(target=self.server.serve_forever, name="mock-upstreams", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "MockUpstreams":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, kind: str, body: Optional[dict] = None):
+        with self.lock:
+            self.requests[kind] += 1
+            if body is not None:
+                self.last_bodies[kind] = body
+
+    def fail_next(self, kind: str, count: int = 1, status: int = 503, retry_after: Optional[float] = None):
+        with self.lock:
+            self.pending_failures[kind].extend([(status, retry_after)] * count)
+
+    def send_pending_failure(self, handler: BaseHTTPRequestHandler, kind: str) -> bool:
+        with self.lock:
+            if not self.pending_failures[kind]:
+                return False
+            status, retry_after = self.pending_failures[kind].pop(0)
+        message = f"Mock {kind} failure"
+        body = {
+            "openai": {"error": {"message": message, "type": "server_error"}},
+            "anthropic": {"type": "error", "error": {"type": "api_error", "message": message}},
+            "gemini": {"error": {"code": status, "message": message, "status": "UNAVAILABLE"}},
+        }[kind]
+        headers = {"Retry-After": f"{retry_after:g}"} if retry_after is not None else {}
+        self.send_json(handler, status, body, headers)
+        return True
+
+    def wait(self):
+        delay_ms = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+    def reply_text(self, prompt: str) -> str:
+        filler = " ".join(f"word{i}" for i in range(max(self.response_words - 4, 0)))
+        return f"Mock reply to: {prompt[:40]} {filler}".strip()
+
+    def handle_get(self, handler: BaseHTTPRequestHandler):
+        path = handler.path.split("?")[0]
+        if not path.startswith(IMAGE_PATH_PREFIX):
+            self.send_json(handler, 404, {"error": "not found"})
+            return
+        self.count("image")
+        seed = sum(path.encode("utf-8"))
+        with self.lock:
+            data = self.images.get(path)
+            if data is None:
+                data = self.images[path] = make_png(seed)
+        self.send_bytes(handler, 200, data, "image/png")
+
+    def handle_post(self, handler: BaseHTTPRequestHandler):
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = json.loads(handler.rfile.read(length) or b"{}")
+        path = handler.path.split("?")[0]
+        self.wait()
+
+        kind = ("openai" if path == OPENAI_PATH else "anthropic" if path == ANTHROPIC_PATH
+                else "gemini" if path.endswith((GEMINI_PATH_SUFFIX, GEMINI_STREAM_PATH_SUFFIX)) else None)
+        if kind is not None and self.send_pending_failure(handler, kind):
+            self.count(kind, body)
+            return
+
+        if path == OPENAI_PATH:
+            self.count("openai", body)
+            text = self.reply_text(last_prompt_text(body.get("messages", [])))
+            if body.get("stream"):
+                self.send_openai_stream(handler, body.get("model"), text)
+                return
+            self.send_json(handler, 200, {
+                "id": "chatcmpl-mock", "object": "chat.completion", "model": body.get("model"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": text}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": self.response_words, "total_tokens": 10},
+            })
+        elif path == ANTHROPIC_PATH:
+            self.count("anthropic", body)
+            text = self.reply_text(last_prompt_text(body.get("messages", [])))
+            if body.get("stream"):
+                self.send_anthropic_stream(handler, body.get("model"), text)
+                return
+            self.send_json(handler, 200, {
+                "id": "msg_mock", "type": "message", "role": "assistant", "model": body.get("model"),
+                "content": [{"type": "text", "text": text}], "stop_reason": "end_turn", "stop_sequence": None,
+                "usage": {"input_tokens": 10, "output_tokens": self.response_words},
+            })
+        elif path.endswith(GEMINI_PATH_SUFFIX):
+            self.count("gemini", body)
+            text = self.reply_text(last_prompt_text(body.get("contents", [])))
+            self.send_json(handler, 200, self.gemini_response(text))
+        elif path.endswith(GEMINI_STREAM_PATH_SUFFIX):
+            self.count("gemini", body)
+            text = self.reply_text(last_prompt_text(body.get("contents", [])))
+            self.send_gemini_stream(handler, text)
+        else:
+            self.send_json(handler, 404, {"error": f"unknown path {path}"})
+
+    def gemini_response(self, text: str) -> dict:
+        return {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP",
+                            "index": 0}],
+            "usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": self.response_words,
+                              "totalTokenCount": 10 + self.response_words},
+        }
+
+    def send_gemini_stream(self, handler: BaseHTTPRequestHandler, text: str):
+        # Without alt=sse Gemini streams one JSON array, written an element at a time
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        for index, word in enumerate(text.split(" ")):
+            separator = "[" if index == 0 else ",\r\n"
+            handler.wfile.write((separator + json.dumps(self.gemini_response(word + " "))).encode("utf-8"))
+        handler.wfile.write(b"]")
+        handler.close_connection = True
+
+    def send_openai_stream(self, handler: BaseHTTPRequestHandler, model: str, text: str):
+        events = [(None, {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "model": model,
+                          "choices": [{"index": 0, "delta": {"content": word + " "}}]})
+                  for word in text.split(" ")]
+        self.send_events(handler, events, done_marker=True)
+
+    def send_anthropic_stream(self, handler: BaseHTTPRequestHandler, model: str, text: str):
+        events = [("message_start", {"type": "message_start", "message": {
+            "id": "msg_mock", "type": "message", "role": "assistant", "model": model, "content": [],
+            "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": 10, "output_tokens": 1}}}),
+                  ("content_block_start", {"type": "content_block_start", "index": 0,
+                                           "content_block": {"type": "text", "text": ""}})]
+        events += [("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                            "delta": {"type": "text_delta", "text": word + " "}})
+                   for word in text.split(" ")]
+        events += [("content_block_stop", {"type": "content_block_stop", "index": 0}),
+                   ("message_delta", {"type": "message_delta",
+                                      "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                      "usage": {"output_tokens": self.response_words}}),
+                   ("message_stop", {"type": "message_stop"})]
+        self.send_events(handler, events)
+
+    def send_events(self, handler: BaseHTTPRequestHandler, events: list, done_marker: bool = False):
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Connection", "close")
+        handler.end_headers()
+        for event, data in events:
+            prefix = f"event: {event}\n" if event else ""
+            handler.wfile.write(f"{prefix}data: {json.dumps(data)}\n\n".encode("utf-8"))
+        if done_marker:
+            handler.wfile.write(b"data: [DONE]\n\n")
+        handler.close_connection = True
+
+    def send_json(self, handler: BaseHTTPRequestHandler, status: int, body: dict, headers: Optional[dict] = None):
+        self.send_bytes(handler, status, json.dumps(body).encode("utf-8"), "application/json", headers)
+
+    def send_bytes(self, handler: BaseHTTPRequestHandler, status: int, data: bytes, content_type: str,
+                   headers: Optional[dict] = None):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--response-words", type=int, default=40)
+    args = parser.parse_args()
+
+    mock = MockUpstreams(host=args.host, port=args.port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                         response_words=args.response_words)
+    print(f"Mock upstreams listening on {mock.base_url}")
+    try:
+        mock.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,42 @@
 from modules.Config import Config
-from modules.OpenAIAPIClient import OpenAIAPIClient
-from modules.GoogleAIAPIClient import GoogleAIAPIClient
-from modules.ClaudeAPIClient import ClaudeAPIClient
+from modules.ConversationStore import SQLiteConversationStore
 from modules.Server import Server
-from modules.helpers.logging_helper import logger
+from modules.AsyncServer import AsyncServer
+from modules.WorkerPool import WorkerPool
+from modules.ImageProcessor import get_shared_image_processor
+from modules.helpers.client_helpers import create_api_clients
+from modules.helpers.logging_helper import configure_logging, logger, stop_logging
 
-if __name__ == '__main__':
-    config = Config('config.ini')
-    openai_api_client = OpenAIAPIClient(base_url=config.openai_base_url, path=config.openai_path,
-                                        api_key=config.openai_api_key,
-                           max_conversation_tokens=config.openai_max_conversation_tokens,
-                           max_response_tokens=config.openai_max_response_tokens,
-                           max_dialogues_per_conversation=config.openai_max_dialogues_per_conversation,
-                           conversation_prune_after_seconds=config.openai_conversation_prune_after_seconds,
-                           temperature=config.openai_temperature, system_message=config.openai_system_message)
+CONFIG_PATH = 'config.ini'
 
-    google_api_client = GoogleAIAPIClient(api_key=config.google_api_key,
-                                          model_name=config.google_model,
-                                          conversation_prune_after_seconds=config.openai_conversation_prune_after_seconds,
-                                          max_dialogues_per_conversation=config.openai_max_dialogues_per_conversation)
+if __name__ == '__main__':
+    config = Config(CONFIG_PATH)
+    configure_logging(config)
+    worker_pool = None
+    conversation_store = None
+    if config.workers > 0:
+        # The workers hold the conversations and open the store themselves
+        worker_pool = WorkerPool.from_config(CONFIG_PATH, config)
+        logger.info("Started %d worker processes", config.workers)
+    elif config.persistence_enabled:
+        # One store for all three containers, each keeps its conversations under its own namespace
+        conversation_store = SQLiteConversationStore.from_config(config)
 
-    claude_api_client = ClaudeAPIClient(api_key=config.claude_api_key,
-                                        model_name=config.claude_model,
-                                        conversation_prune_after_seconds=config.openai_conversation_prune_after_seconds,
-                                        max_dialogues_per_conversation=config.openai_max_dialogues_per_conversation)
+    openai_api_client, google_api_client, claude_api_client = create_api_clients(config, conversation_store)
 
-    server = Server(openai_api_client=openai_api_client,
+    server_class = AsyncServer if config.server_mode == 'async' else Server
+    server = server_class(openai_api_client=openai_api_client,
                     google_ai_api_client=google_api_client,
                     claude_api_client=claude_api_client,
-                    config=config)
-    server.run()
+                    config=config,
+                    worker_pool=worker_pool)
+    try:
+        server.run()
+    finally:
+        if worker_pool is not None:
+            worker_pool.close()
+        if conversation_store is not None:
+            # Commit whatever is still pending before exiting
+            conversation_store.close()
+        get_shared_image_processor().close()
+        stop_logging()
@@ -0,0 +1,282 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional, TypeVar
+from modules.Config import Config
+from modules.helpers.logging_helper import logger
+
+T = TypeVar("T")
+
+# Statuses worth another attempt: rate limited, or the provider failing on its side
+RETRYABLE_STATUSES = (408, 409, 429, 500, 502, 503, 504, 529)
+
+
+class ProviderError(Exception):
+    """
+    An upstream call that failed, with what the retry logic needs to know about it. Raised instead of handing the
+    provider's error body back as if it were the answer.
+    """
+    def __init__(self, message: str, provider: str, status: Optional[int] = None, retryable: bool = False,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.provider = provider
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+    def __reduce__(self):
+        # Crosses the worker pipes intact, the default pickling would only pass the message to __init__
+        return type(self), (str(self), self.provider, self.status, self.retryable, self.retry_after)
+
+
+class CircuitOpenError(ProviderError):
+    """The provider's circuit breaker is open, so the call was failed without being sent."""
+
+
+def status_error(provider: str, status: int, message: str, retry_after: Optional[float] = None) -> ProviderError:
+    return ProviderError(f"{provider} returned {status}: {message}", provider, status=status,
+                         retryable=status in RETRYABLE_STATUSES, retry_after=retry_after)
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a Retry-After header, which is either a number of seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failed calls, then fails calls straight away for reset_seconds. After
+    that a single probe call is let through: success closes the breaker again, failure re-opens it.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.times_opened = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if self.failure_threshold <= 0:
+            return True
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.probe_in_flight = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                self.consecutive_failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+
+    def release(self):
+        """The call ended in a way that says nothing about the provider's health."""
+        with self.lock:
+            self.probe_in_flight = False
+
+    def get_retry_after(self) -> float:
+        with self.lock:
+            return max(self.opened_at + self.reset_seconds - time.monotonic(), 0.0)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
+
+
+class ProviderCaller:
+    """
+    The way every API client reaches its provider. A call gets a deadline of timeout_seconds, covering all of its
+    attempts. 429s, 5xxs, timeouts and connection errors are retried with jittered exponential backoff, waiting at
+    least as long as the provider's Retry-After, as long as the wait still fits before the deadline. Failures feed the
+    provider's circuit breaker, so a provider that keeps failing is failed fast instead of holding threads.
+
+    classify turns the exceptions of the provider's SDK into a ProviderError, and returns None for anything that isn't
+    about the provider (those are raised as they are, without retrying).
+    """
+    def __init__(self, provider: str, classify: Callable[[Exception], Optional[ProviderError]],
+                 timeout_seconds: float = 60, max_attempts: int = 3, backoff_base_seconds: float = 0.25,
+                 backoff_max_seconds: float = 5, failure_threshold: int = 5, reset_seconds: float = 30):
+        self.provider = provider
+        self.classify = classify
+        self.timeout_seconds = timeout_seconds
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base_seconds = backoff_base_seconds
+        self.backoff_max_seconds = backoff_max_seconds
+        self.breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_seconds=reset_seconds)
+        self.num_retries = 0
+        self.num_failures = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, provider: str, classify: Callable[[Exception], Optional[ProviderError]],
+                    config: Config) -> "ProviderCaller":
+        return cls(provider, classify, timeout_seconds=config.upstream_timeout_seconds,
+                   max_attempts=config.upstream_max_attempts,
+                   backoff_base_seconds=config.upstream_backoff_base_ms / 1000,
+                   backoff_max_seconds=config.upstream_backoff_max_ms / 1000,
+                   failure_threshold=config.upstream_breaker_failure_threshold,
+                   reset_seconds=config.upstream_breaker_reset_seconds)
+
+    def get_deadline(self, deadline: Optional[float]) -> float:
+        """
+        The time.monotonic() by which a call must be done: deadline, the end of the request's budget, when there is
+        one and it comes before timeout_seconds from now.
+        """
+        timeout_deadline = time.monotonic() + self.timeout_seconds
+        return timeout_deadline if deadline is None else min(deadline, timeout_deadline)
+
+    def begin_attempt(self, deadline: float) -> float:
+        """Seconds the attempt may take, or raises when the breaker is open or the deadline has passed."""
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ProviderError(f"{self.provider} did not answer before the deadline", self.provider)
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.provider} is failing, not calling it for another "
+                                   f"{self.breaker.get_retry_after():.0f} seconds", self.provider)
+        return remaining
+
+    def handle_failure(self, e: Exception, attempt: int, deadline: float, retry: bool = True) -> float:
+        """Seconds to wait before the next attempt, or raises when the call shouldn't be tried again."""
+        error = e if isinstance(e, ProviderError) else self.classify(e)
+        if error is None:
+            self.breaker.release()
+            raise e
+        cause = None if error is e else e
+        if not error.retryable:
+            # The provider answered, it just didn't like the request
+            self.breaker.record_success()
+            raise error from cause
+
+        self.breaker.record_failure()
+        with self.lock:
+            self.num_failures += 1
+        if not retry or attempt >= self.max_attempts or self.breaker.state == CircuitBreaker.OPEN:
+            raise error from cause
+        delay = random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** (attempt - 1)))
+        if error.retry_after is not None:
+            delay = max(delay, error.retry_after)
+        if time.monotonic() + delay >= deadline:
+            raise error from cause
+        with self.lock:
+            self.num_retries += 1
+        logger.warning("%s call failed (attempt %d of %d), retrying in %.2f seconds: %s", self.provider, attempt,
+                       self.max_attempts, delay, error)
+        return delay
+
+    def call(self, attempt: Callable[[float], T], deadline: Optional[float] = None) -> T:
+        """
+        Run attempt(timeout_seconds) until it succeeds, or raise the ProviderError that ended the call. deadline, a
+        time.monotonic(), cuts the call short when the request that needs it is due sooner than timeout_seconds.
+        """
+        deadline = self.get_deadline(deadline)
+        for number in range(1, self.max_attempts + 1):
+            timeout = self.begin_attempt(deadline)
+            try:
+                result = attempt(timeout)
+            except Exception as e:
+                time.sleep(self.handle_failure(e, number, deadline))
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def call_async(self, attempt: Callable[[float], Awaitable[T]], deadline: Optional[float] = None) -> T:
+        deadline = self.get_deadline(deadline)
+        for number in range(1, self.max_attempts + 1):
+            timeout = self.begin_attempt(deadline)
+            try:
+                result = await attempt(timeout)
+            except asyncio.CancelledError:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                await asyncio.sleep(self.handle_failure(e, number, deadline))
+                continue
+            self.breaker.record_success()
+            return result
+
+    def stream(self, attempt: Callable[[float], Iterator[T]], deadline: Optional[float] = None) -> Iterator[T]:
+        """Like call, for a stream. It is only retried while nothing has been yielded from it yet."""
+        deadline = self.get_deadline(deadline)
+        for number in range(1, self.max_attempts + 1):
+            timeout = self.begin_attempt(deadline)
+            started = False
+            try:
+                for chunk in attempt(timeout):
+                    started = True
+                    yield chunk
+            except GeneratorExit:
+                self.breaker.release()
+                raise
+            except Exception as e:
+                time.sleep(self.handle_failure(e, number, deadline, retry=not started))
+                continue
+            self.breaker.record_success()
+            return
+
+    async def stream_async(self, attempt: Callable[[float], AsyncIterator[T]],
+                           deadline: Optional[float] = None) -> AsyncIterator[T]:
+        deadline = self.get_deadline(deadline)
+        for number in range(1, self.max_attempts + 1):
+            timeout = self.begin_attempt(deadline)
+            started = False
+            try:
+                async for chunk in attempt(timeout):
+                    started = True
+                    yield chunk
+            except (GeneratorExit, asyncio.CancelledError):
+                self.breaker.release()
+                raise
+            except Exception as e:
+                await asyncio.sleep(self.handle_failure(e, number, deadline, retry=not started))
+                continue
+            self.breaker.record_success()
+            return
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            num_retries, num_failures = self.num_retries, self.num_failures
+        return {
+            "circuit": self.breaker.get_stats(),
+            "retries": num_retries,
+            "failures": num_failures,
+        }
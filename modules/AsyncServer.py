@@ -0,0 +1,378 @@
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs
+from modules.APIClient import ProviderError
+from modules.Server import Server, PromptRequestError, FanOutResult
+from modules.OpenAIAPIClient import OpenAIAPIClient
+from modules.GoogleAIAPIClient import GoogleAIAPIClient
+from modules.ClaudeAPIClient import ClaudeAPIClient
+from modules.Config import Config
+from modules.WorkerPool import WorkerPool
+from modules.helpers.logging_helper import Truncated, logger
+
+
+class AsyncServer(Server):
+    """
+    ASGI front end for the /prompt route. All upstream calls are driven through the clients' async
+    transports on a single event loop, so waiting on LLM latency costs a coroutine rather than a thread.
+    """
+    def __init__(self, openai_api_client: OpenAIAPIClient,
+                 google_ai_api_client: GoogleAIAPIClient,
+                 claude_api_client: ClaudeAPIClient,
+                 config: Config,
+                 worker_pool: Optional[WorkerPool] = None):
+        super().__init__(openai_api_client=openai_api_client,
+                         google_ai_api_client=google_ai_api_client,
+                         claude_api_client=claude_api_client,
+                         config=config,
+                         worker_pool=worker_pool)
+        # Bounds upstream calls in flight across every request served by the event loop
+        self.upstream_semaphore = asyncio.Semaphore(config.max_concurrent_upstream_requests)
+        self.background_tasks = set()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.handle_lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        routes = {
+            "/prompt": ("POST", self.handle_prompt_async),
+            "/stats": ("GET", self.handle_stats_async),
+            "/metrics": ("GET", self.handle_metrics_async),
+        }
+        if scope["path"] not in routes:
+            await self.send_response(send, {"error": "Not found"}, 404)
+            return
+        method, handler = routes[scope["path"]]
+        if scope["method"] != method:
+            await self.send_response(send, {"error": "Method not allowed"}, 405)
+            return
+
+        await handler(scope, receive, send)
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                logger.info("Async server started on %s:%s", self.config.host, self.config.port)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def read_body(self, receive) -> bytes:
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        return b"".join(chunks)
+
+    async def send_response(self, send, body, status: int, headers: Optional[Dict[str, str]] = None,
+                            content_type: Optional[bytes] = None):
+        if isinstance(body, dict):
+            payload = json.dumps(body).encode("utf-8")
+            content_type = content_type or b"application/json"
+        else:
+            payload = body.encode("utf-8")
+            content_type = content_type or b"text/plain; charset=utf-8"
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type),
+                        (b"content-length", str(len(payload)).encode("ascii"))] +
+                       [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in (headers or {}).items()],
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+    def get_caller(self, scope) -> Optional[str]:
+        return scope["client"][0] if scope.get("client") else None
+
+    async def handle_stats_async(self, scope, receive, send):
+        try:
+            self.check_whitelist(self.get_caller(scope))
+        except PromptRequestError as e:
+            await self.send_response(send, e.body, e.status)
+            return
+        # Asking the workers for their stats blocks, keep it off the event loop
+        await self.send_response(send, await asyncio.to_thread(self.get_stats), 200)
+
+    def get_upstream_queue_depth(self) -> int:
+        # Upstream calls waiting on the semaphore
+        return len(self.upstream_semaphore._waiters or ())
+
+    async def handle_metrics_async(self, scope, receive, send):
+        try:
+            self.check_whitelist(self.get_caller(scope))
+        except PromptRequestError as e:
+            await self.send_response(send, e.body, e.status)
+            return
+        metrics = await asyncio.to_thread(self.get_metrics)
+        await self.send_response(send, metrics, 200, content_type=b"text/plain; version=0.0.4; charset=utf-8")
+
+    async def handle_prompt_async(self, scope, receive, send):
+        self.metrics.requests_in_flight.inc()
+        try:
+            await self.serve_prompt_async(scope, receive, send)
+        finally:
+            self.metrics.requests_in_flight.dec()
+
+    async def serve_prompt_async(self, scope, receive, send):
+        caller = self.get_caller(scope)
+        query = parse_qs(scope.get("query_string", b"").decode("utf-8"))
+        args = {key: values[0] for key, values in query.items()}
+        data = await self.read_body(receive)
+
+        try:
+            prompt_request = self.parse_prompt_request(caller=caller, args=args, data=data)
+        except PromptRequestError as e:
+            await self.send_response(send, e.body, e.status, e.headers)
+            return
+
+        if prompt_request.stream:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                # No content-length, so the server falls back to chunked transfer encoding
+                "headers": [(b"content-type", b"text/plain; charset=utf-8")],
+            })
+            async for chunk in self.stream_prompt_async(models=prompt_request.models,
+                                                        text=prompt_request.text,
+                                                        image_url=prompt_request.image_url,
+                                                        conversation_id=prompt_request.conversation_id):
+                await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        result = await self.fan_out_async(models=prompt_request.models,
+                                          text=prompt_request.text,
+                                          image_url=prompt_request.image_url,
+                                          conversation_id=prompt_request.conversation_id,
+                                          strategy=prompt_request.strategy,
+                                          deadline_ms=prompt_request.deadline_ms)
+
+        await self.send_response(send, result.text, 200, result.get_headers())
+
+    async def get_cache_key_async(self, model: str, text: str, image_url: str,
+                                  conversation_id: Optional[str]) -> Optional[tuple]:
+        if image_url and self.response_cache is not None and conversation_id is None:
+            # Keying on the image content may need a download, which is blocking
+            return await asyncio.to_thread(self.get_cache_key, model, text, image_url, conversation_id)
+        return self.get_cache_key(model, text, image_url, conversation_id)
+
+    async def call_model_async(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                               deadline: Optional[float] = None) -> str:
+        async with self.upstream_semaphore:
+            if self.worker_pool is not None:
+                return await self.worker_pool.send_prompt_async(model, text, image_url, conversation_id, deadline)
+            if model == self.config.google_model:
+                return await self.google_ai_api_client.send_prompt_async(
+                    prompt=text, image_url=image_url, conversation_id=conversation_id, deadline=deadline
+                )
+            elif model == self.config.claude_model:
+                return await self.claude_api_client.send_prompt_async(
+                    prompt=text, image_url=image_url, conversation_id=conversation_id, deadline=deadline
+                )
+            elif model in self.config.openai_models:
+                return await self.openai_api_client.send_prompt_async(
+                    prompt=text, image_url=image_url, conversation_id=conversation_id, model=model, deadline=deadline
+                )
+        raise ValueError(f"Invalid model: {model}")
+
+    async def send_to_model_async(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                                  deadline: Optional[float] = None) -> Tuple[str, str, bool]:
+        try:
+            cache_key = await self.get_cache_key_async(model, text, image_url, conversation_id)
+            if cache_key is not None:
+                cached_response = self.response_cache.get(cache_key)
+                if cached_response is not None:
+                    logger.info("Serving cached response for model %s", model)
+                    return model, cached_response, True
+
+            async def call_and_cache() -> str:
+                start = time.monotonic()
+                self.metrics.upstream_in_flight.inc()
+                try:
+                    response = await self.call_model_async(model, text, image_url, conversation_id, deadline)
+                finally:
+                    self.metrics.upstream_in_flight.dec()
+                latency = time.monotonic() - start
+                self.model_latencies.record(model, latency)
+                self.metrics.upstream_latency.observe(latency, model)
+                if cache_key is not None:
+                    self.response_cache.put(cache_key, response)
+                return response
+
+            flight_key = self.get_flight_key(model, text, image_url, conversation_id, cache_key, deadline)
+            if flight_key is None:
+                response = await call_and_cache()
+            else:
+                response = await self.single_flight.do_async(flight_key, call_and_cache)
+            logger.info("Got response from model %s (%d chars)", model, len(response))
+            logger.debug("Response from model %s: %s", model, Truncated(response))
+            return model, response, True
+        except Exception as e:
+            self.metrics.upstream_errors.inc(model, type(e).__name__)
+            # The reason a provider failed is in the message, the traceback is only worth logging for our own bugs
+            logger.error("Failed to send prompt to model '%s': %s", model, e,
+                         exc_info=not isinstance(e, ProviderError))
+            return model, f"Failed to send prompt to model '{model}': {e}", False
+
+    async def send_prompt_async(self, models: List[str], text: str, image_url: str,
+                                conversation_id: Optional[str]) -> str:
+        return (await self.fan_out_async(models, text, image_url, conversation_id)).text
+
+    async def fan_out_async(self, models: List[str], text: str, image_url: str, conversation_id: Optional[str],
+                            strategy: str = "all", deadline_ms: Optional[int] = None) -> FanOutResult:
+        logger.info("Sending prompt to %d models with strategy '%s': %s", len(models), strategy, models)
+        start = time.monotonic()
+        if strategy == "race":
+            result = await self.fan_out_hedged_async(models, text, image_url, conversation_id, hedge=False)
+        elif strategy == "hedged":
+            result = await self.fan_out_hedged_async(models, text, image_url, conversation_id, hedge=True)
+        elif strategy == "deadline":
+            result = await self.fan_out_deadline_async(models, text, image_url, conversation_id, deadline_ms)
+        else:
+            results = await asyncio.gather(*(self.send_to_model_async(model, text, image_url, conversation_id)
+                                             for model in models))
+            responses = {model: response for model, response, _ in results}
+            result = FanOutResult(self.combine_responses(models, responses), "all", list(models))
+        self.strategy_latencies.record(strategy, time.monotonic() - start)
+        return result
+
+    async def fan_out_hedged_async(self, models: List[str], text: str, image_url: str, conversation_id: Optional[str],
+                                   hedge: bool) -> FanOutResult:
+        """Same as fan_out_hedged, except that models still running when a winner is found are cancelled too."""
+        strategy = "hedged" if hedge else "race"
+        task_to_model: Dict[asyncio.Task, str] = {}
+        pending: Set[asyncio.Task] = set()
+        failures: Dict[str, str] = {}
+
+        try:
+            for index, model in enumerate(models):
+                task = asyncio.ensure_future(self.send_to_model_async(model, text, image_url, conversation_id))
+                task_to_model[task] = model
+                pending.add(task)
+                if hedge and index < len(models) - 1:
+                    wait_until = time.monotonic() + self.get_hedge_delay(model)
+                elif index < len(models) - 1:
+                    continue
+                else:
+                    wait_until = None
+
+                while pending:
+                    timeout = None if wait_until is None else wait_until - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        break
+                    done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    if not done:
+                        break
+                    for finished in sorted(done, key=lambda t: models.index(task_to_model[t])):
+                        finished_model, response, succeeded = finished.result()
+                        if succeeded:
+                            return FanOutResult(response, strategy, [finished_model])
+                        failures[finished_model] = response
+        finally:
+            # Covers the winner returning as well as the request itself being cancelled
+            for loser in pending:
+                loser.cancel()
+
+        return FanOutResult(self.combine_responses(models, failures), strategy, [])
+
+    async def fan_out_deadline_async(self, models: List[str], text: str, image_url: str,
+                                     conversation_id: Optional[str], deadline_ms: int) -> FanOutResult:
+        # The upstream calls get the request's deadline, so they aren't retried once it has given up on them
+        deadline = time.monotonic() + deadline_ms / 1000
+        tasks = {asyncio.ensure_future(self.send_to_model_async(model, text, image_url, conversation_id, deadline)):
+                 model for model in models}
+        done, late = await asyncio.wait(tasks, timeout=deadline_ms / 1000)
+        for task in late:
+            # Kept until they fail at the deadline, or land an answer that arrived just in time
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+        responses = {}
+        for task in done:
+            model, response, _ = task.result()
+            responses[model] = response
+        return self.deadline_result(models, responses, deadline_ms)
+
+    def get_model_stream_async(self, model: str, text: str, image_url: str,
+                               conversation_id: Optional[str]) -> AsyncIterator[str]:
+        if self.worker_pool is not None:
+            return self.worker_pool.stream_prompt_async(model, text, image_url, conversation_id)
+        if model == self.config.google_model:
+            return self.google_ai_api_client.stream_prompt_async(
+                prompt=text, image_url=image_url, conversation_id=conversation_id
+            )
+        elif model == self.config.claude_model:
+            return self.claude_api_client.stream_prompt_async(
+                prompt=text, image_url=image_url, conversation_id=conversation_id
+            )
+        elif model in self.config.openai_models:
+            return self.openai_api_client.stream_prompt_async(
+                prompt=text, image_url=image_url, conversation_id=conversation_id, model=model
+            )
+        return self.single_chunk(f"Invalid model: {model}")
+
+    async def single_chunk(self, text: str) -> AsyncIterator[str]:
+        yield text
+
+    async def stream_to_model_async(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                                    chunks: asyncio.Queue):
+        try:
+            cache_key = await self.get_cache_key_async(model, text, image_url, conversation_id)
+            if cache_key is not None:
+                cached_response = self.response_cache.get(cache_key)
+                if cached_response is not None:
+                    chunks.put_nowait(cached_response)
+                    return
+
+            response_chunks = []
+            async with self.upstream_semaphore:
+                async for chunk in self.get_model_stream_async(model, text, image_url, conversation_id):
+                    response_chunks.append(chunk)
+                    chunks.put_nowait(chunk)
+            logger.info("Finished streaming response from model %s", model)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, "".join(response_chunks))
+        except Exception as e:
+            self.metrics.upstream_errors.inc(model, type(e).__name__)
+            logger.error("Failed to stream prompt to model '%s': %s", model, e,
+                         exc_info=not isinstance(e, ProviderError))
+            chunks.put_nowait(f"Failed to send prompt to model '{model}': {e}")
+        finally:
+            chunks.put_nowait(None)
+
+    async def stream_prompt_async(self, models: List[str], text: str, image_url: str,
+                                  conversation_id: Optional[str]) -> AsyncIterator[str]:
+        """Async twin of Server.stream_prompt."""
+        logger.info("Streaming prompt to %d models: %s", len(models), models)
+        queues = {model: asyncio.Queue() for model in models}
+        for model in models:
+            task = asyncio.create_task(self.stream_to_model_async(model, text, image_url, conversation_id,
+                                                                  queues[model]))
+            # Keep a reference so the task isn't garbage collected if the caller disconnects
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+
+        for index, model in enumerate(models):
+            if len(models) > 1:
+                yield ("\n\n\n" if index > 0 else "") + f"Response from model '{model}':\n"
+            while True:
+                chunk = await queues[model].get()
+                if chunk is None:
+                    break
+                yield chunk
+
+    def run(self):
+        try:
+            import uvicorn
+        except ImportError:
+            raise Exception("server mode 'async' requires uvicorn, install it with `pip install uvicorn`")
+        uvicorn.run(self, host=self.config.host, port=self.config.port)
@@ -1,88 +1,266 @@
 import time
+import asyncio
 import logging
-from modules.helpers.network_helpers import get_image_from_url, get_base64_from_image_url
-from modules.ConversationContainer import ClaudeConversationContainer
+from modules.APIClient import ProviderCaller, ProviderError, parse_retry_after, status_error
+from modules.helpers.network_helpers import get_provider_image_from_url
+from modules.helpers.logging_helper import Truncated
+from modules.ConversationContainer import ClaudeConversationContainer, MemoryBudget
+from modules.Compactor import Compactor
+from modules.ConversationStore import ConversationStore
+from modules.Dialogue import ClaudeDialogue, estimate_size_bytes, split_usage
+from modules.ImageStore import get_shared_image_store, render_claude_messages
+from modules.Metrics import get_shared_metrics
+from modules.TurnStore import get_shared_turn_store
 import PIL.Image
 import anthropic
+from typing import AsyncIterator, Iterator, Optional
 
 logger = logging.getLogger(__name__)
 
+# A prompt cache breakpoint: the request up to and including the marked block is cached for a few minutes
+CACHE_BREAKPOINT = {"type": "ephemeral"}
+
+
 class ClaudeAPIClient:
     def __init__(self, api_key: str, model_name: str, conversation_prune_after_seconds: int,
-                 max_dialogues_per_conversation: int, json_response: bool = False):
+                 max_dialogues_per_conversation: int, json_response: bool = False, max_conversations: int = 0,
+                 memory_budget: MemoryBudget = None, sweep_interval_seconds: float = 0,
+                 conversation_store: ConversationStore = None, base_url: str = None,
+                 caller: ProviderCaller = None, max_conversation_tokens: int = 0, compactor: Compactor = None,
+                 system_message: str = None, prompt_caching: bool = True, image_history_turns: int = None):
         self.api_key = api_key
         self.model_name = model_name
+        self.prompt_caching = prompt_caching
+        # Built once, so every request sends the same system block ahead of the conversation
+        self.system_blocks = None
+        if system_message:
+            self.system_blocks = [{"type": "text", "text": system_message}]
+            if prompt_caching:
+                self.system_blocks[0]["cache_control"] = CACHE_BREAKPOINT
+        # Older dialogues are left out once the prompt and its history would reach this many tokens, 0 sends them all
+        self.max_conversation_tokens = max_conversation_tokens
 
         self.conversations = ClaudeConversationContainer(conversation_prune_after_seconds=conversation_prune_after_seconds,
                                                    max_dialogues_per_conversation=max_dialogues_per_conversation,
-                                                   model=model_name)
+                                                   model=model_name,
+                                                   max_conversations=max_conversations,
+                                                   memory_budget=memory_budget,
+                                                   sweep_interval_seconds=sweep_interval_seconds,
+                                                   store=conversation_store,
+                                                   compactor=compactor,
+                                                   image_history_turns=image_history_turns)
 
-        self.model = anthropic.Anthropic(api_key=api_key)
+        # Retries are left to the caller, which shares its deadline and circuit breaker with the other providers'
+        self.model = anthropic.Anthropic(api_key=api_key, base_url=base_url, max_retries=0)
+        self.async_model = anthropic.AsyncAnthropic(api_key=api_key, base_url=base_url, max_retries=0)
+        self.caller = caller if caller is not None else ProviderCaller("claude", self.classify_error)
 
-        logger.info(f"Claude API client initialized with model {model_name}")
+        logger.info("Claude API client initialized with model %s", model_name)
         return
 
-    def send_prompt(self, prompt: str, image_url: str = None, conversation_id: str = None) -> str:
-        logger.info(f"Sending prompt to Claude API with model {self.model_name}: '{prompt[:50]}...'")
+    @staticmethod
+    def classify_error(e: Exception) -> Optional[ProviderError]:
+        if isinstance(e, anthropic.APIStatusError):
+            return status_error("claude", e.status_code, e.message,
+                                retry_after=parse_retry_after(e.response.headers.get("retry-after")))
+        if isinstance(e, anthropic.APIConnectionError):
+            # Timeouts included
+            return ProviderError(f"Could not reach claude: {e!r}", "claude", retryable=True)
+        return None
+
+    def build_messages(self, prompt: str, image_url: str = None, image: tuple = None, conversation_id: str = None):
+        """
+        image is the (bytes, media type) of the image at image_url, prepared for Claude. Returns the new turn as
+        (turn, stored image), for add_dialogue.
+        """
+        # The same turn as the other models asked this prompt, and the image kept as the stored image. The base64
+        # source is only rendered for the request
+        turn = get_shared_turn_store().get_turn(prompt, image_url)
+        stored_image = get_shared_image_store().intern(*image) if image is not None else None
+        new_user_message = ClaudeDialogue.render_prompt(turn, stored_image)
 
         conversation = None
         messages = []
-
+        prompt_tokens = None
         if conversation_id is None:
             # No conversation ID, so there is no context to add to the prompt
             pass
         else:
             conversation = self.conversations.get_conversation(conversation_id=conversation_id, model=self.model_name)
+            # The new prompt is counted on its own for its dialogue, see split_usage
+            prompt_tokens = ClaudeDialogue.estimate_prompt_tokens(turn, stored_image, self.model_name)
+            if self.max_conversation_tokens > 0:
+                conversation.trim(prompt_tokens=prompt_tokens, token_limit=self.max_conversation_tokens)
             previous_messages = conversation.get_messages_for_api()
             # Add the previous prompts and responses to the message list
-            for message in previous_messages:
-                messages.append(message)
+            messages.extend(previous_messages)
+
+        messages.append(new_user_message)
+        messages = render_claude_messages(messages)
+        if self.prompt_caching:
+            # The next turn finds this request's prefix in the cache by looking back from its own breakpoint
+            messages[-1] = with_cache_breakpoint(messages[-1])
+        get_shared_metrics().upstream_request_bytes.observe(
+            estimate_size_bytes(messages) + estimate_size_bytes(self.system_blocks), self.model_name)
+        return conversation, messages, (turn, stored_image), prompt_tokens
+
+    def build_request_kwargs(self, messages: list, timeout: float) -> dict:
+        kwargs = {"model": self.model_name, "max_tokens": 1024, "messages": messages, "timeout": timeout}
+        if self.system_blocks is not None:
+            kwargs["system"] = self.system_blocks
+        return kwargs
+
+    def handle_response(self, response, conversation, new_turn: tuple, prompt_tokens: Optional[int]) -> str:
+        response_text = ""
+        for response_content in response.content:
+            response_text += response_content.text
+
+        usage = self.record_usage(response.usage)
+        self.add_dialogue(conversation, new_turn, response_text, usage, prompt_tokens)
+        return response_text
+
+    def add_dialogue(self, conversation, new_turn: tuple, response_text: str, usage: tuple, prompt_tokens: Optional[int]):
+        if conversation is not None:
+            prompt_num_tokens, response_num_tokens = split_usage(*usage, prompt_tokens)
+            turn, image = new_turn
+            conversation.add(turn=turn, response_text=response_text, image=image,
+                             prompt_num_tokens=prompt_num_tokens, response_num_tokens=response_num_tokens)
+
+    def record_usage(self, usage) -> tuple:
+        """Counts the usage in the metrics and returns it as (input tokens, output tokens)."""
+        if usage is None:
+            return None, None
+        cache_read_tokens = usage.cache_read_input_tokens or 0
+        cache_write_tokens = usage.cache_creation_input_tokens or 0
+        # input_tokens leaves out the tokens read from or written to the cache
+        input_tokens = usage.input_tokens + cache_read_tokens + cache_write_tokens
+        metrics = get_shared_metrics()
+        metrics.record_tokens(self.model_name, input_tokens, usage.output_tokens, "usage")
+        metrics.record_cached_tokens(self.model_name, cache_read_tokens, cache_write_tokens)
+        return input_tokens, usage.output_tokens
+
+    def send_prompt(self, prompt: str, image_url: str = None, conversation_id: str = None,
+                    deadline: float = None) -> str:
+        logger.info("Sending prompt to Claude API with model %s: %s", self.model_name, Truncated(prompt))
 
         if len(prompt) == 0 and not image_url:
             return "Prompt is empty and no image was provided"
 
-        if len(prompt) > 0:
-            outbound_parts = [{
-                "type": "text",
-                "text": prompt
-            }]
-        else:
-            outbound_parts = []
+        image = None
+        if image_url:
+            image = get_provider_image_from_url(image_url, "claude")
+            if image is None:
+                return f"Failed to download image from {image_url}"
+
+        conversation, messages, new_turn, prompt_tokens = self.build_messages(
+            prompt=prompt, image_url=image_url, image=image, conversation_id=conversation_id)
+
+        response = self.caller.call(lambda timeout: self.model.messages.create(
+            **self.build_request_kwargs(messages, timeout)), deadline)
+
+        return self.handle_response(response, conversation, new_turn, prompt_tokens)
+
+    async def send_prompt_async(self, prompt: str, image_url: str = None, conversation_id: str = None,
+                                deadline: float = None) -> str:
+        logger.info("Sending async prompt to Claude API with model %s: %s", self.model_name, Truncated(prompt))
 
+        if len(prompt) == 0 and not image_url:
+            return "Prompt is empty and no image was provided"
+
+        image = None
         if image_url:
+            # The image helpers are blocking, keep them off the event loop
+            image = await asyncio.to_thread(get_provider_image_from_url, image_url, "claude")
+            if image is None:
+                return f"Failed to download image from {image_url}"
 
-            image_file_extension = image_url.split(".")[-1]
+        conversation, messages, new_turn, prompt_tokens = self.build_messages(
+            prompt=prompt, image_url=image_url, image=image, conversation_id=conversation_id)
 
-            outbound_parts.append(
-                {
-                    "type": "image",
-                    "source":
-                        {
+        response = await self.caller.call_async(lambda timeout: self.async_model.messages.create(
+            **self.build_request_kwargs(messages, timeout)), deadline)
 
-                            "type": "base64",
-                            "media_type": f"image/{image_file_extension}",
-                            "data": get_base64_from_image_url(image_url)
-                        }
-                }
-            )
+        return self.handle_response(response, conversation, new_turn, prompt_tokens)
 
-        new_user_message = {'role': 'user',
-                            'content': outbound_parts}
-        messages.append(new_user_message)
+    def stream_prompt(self, prompt: str, image_url: str = None, conversation_id: str = None) -> Iterator[str]:
+        """Yield the response text as it arrives. The full text is added to the conversation once it is complete."""
+        logger.info("Streaming prompt to Claude API with model %s: %s", self.model_name, Truncated(prompt))
 
-        response = self.model.messages.create(
-            model=self.model_name,
-            max_tokens=1024,
-            messages=messages)
+        if len(prompt) == 0 and not image_url:
+            yield "Prompt is empty and no image was provided"
+            return
 
-        response_text = ""
-        for response_content in response.content:
-            response_text += response_content.text
+        image = None
+        if image_url:
+            image = get_provider_image_from_url(image_url, "claude")
+            if image is None:
+                yield f"Failed to download image from {image_url}"
+                return
 
-        if conversation is not None:
-            conversation.add(prompt_contents=new_user_message, response_text=response_text)
+        conversation, messages, new_turn, prompt_tokens = self.build_messages(
+            prompt=prompt, image_url=image_url, image=image, conversation_id=conversation_id)
 
-        return response_text
+        chunks = []
+        usage_reports = []
+        for text in self.caller.stream(lambda timeout: self.stream_text(messages, timeout, usage_reports)):
+            chunks.append(text)
+            yield text
+
+        self.add_dialogue(conversation, new_turn, "".join(chunks),
+                          usage_reports[-1] if usage_reports else (None, None), prompt_tokens)
+
+    async def stream_prompt_async(self, prompt: str, image_url: str = None,
+                                  conversation_id: str = None) -> AsyncIterator[str]:
+        logger.info("Streaming async prompt to Claude API with model %s: %s", self.model_name, Truncated(prompt))
+
+        if len(prompt) == 0 and not image_url:
+            yield "Prompt is empty and no image was provided"
+            return
+
+        image = None
+        if image_url:
+            image = await asyncio.to_thread(get_provider_image_from_url, image_url, "claude")
+            if image is None:
+                yield f"Failed to download image from {image_url}"
+                return
+
+        conversation, messages, new_turn, prompt_tokens = self.build_messages(
+            prompt=prompt, image_url=image_url, image=image, conversation_id=conversation_id)
+
+        chunks = []
+        usage_reports = []
+        async for text in self.caller.stream_async(lambda timeout: self.stream_text_async(messages, timeout,
+                                                                                          usage_reports)):
+            chunks.append(text)
+            yield text
+
+        self.add_dialogue(conversation, new_turn, "".join(chunks),
+                          usage_reports[-1] if usage_reports else (None, None), prompt_tokens)
+
+    def stream_text(self, messages: list, timeout: float = None, usage_reports: list = None) -> Iterator[str]:
+        """One attempt at streaming the response. Its usage is appended to usage_reports once it has finished."""
+        with self.model.messages.stream(**self.build_request_kwargs(messages, timeout)) as stream:
+            yield from stream.text_stream
+            usage = self.record_usage(stream.get_final_message().usage)
+        if usage_reports is not None:
+            usage_reports.append(usage)
+
+    async def stream_text_async(self, messages: list, timeout: float = None,
+                                usage_reports: list = None) -> AsyncIterator[str]:
+        async with self.async_model.messages.stream(**self.build_request_kwargs(messages, timeout)) as stream:
+            async for text in stream.text_stream:
+                yield text
+            usage = self.record_usage((await stream.get_final_message()).usage)
+        if usage_reports is not None:
+            usage_reports.append(usage)
+
+def with_cache_breakpoint(message: dict) -> dict:
+    """
+    A copy of the message with a cache breakpoint on its last block. The message itself is kept in the conversation,
+    and a breakpoint left on every stored turn would soon exceed the four a request may have.
+    """
+    content = message["content"]
+    return {**message, "content": content[:-1] + [{**content[-1], "cache_control": CACHE_BREAKPOINT}]}
 
 
 if __name__ == "__main__":
@@ -97,24 +275,24 @@ if __name__ == "__main__":
                       max_dialogues_per_conversation=config.openai_max_dialogues_per_conversation)
 
     #response = google_api_client.send_prompt(prompt="Describe the image", image_url="https://agentlegoodbye.com/wp-content/uploads/photo-gallery/thumb/Purrito-4.jpg")
-    #logger.info(f"Got response: {response}")
+    #logger.info("Got response: %s", response)
 
     response = claude_api_client.send_prompt(prompt="What model are you? What is the capital of France?", conversation_id="test")
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
     # response = google_api_client.send_prompt(prompt="And Germany?", conversation_id="test")
-    # logger.info(f"Got response: {response}")
+    # logger.info("Got response: %s", response)
     # response = google_api_client.send_prompt(prompt="How about Spain?", conversation_id="test")
-    # logger.info(f"Got response: {response}")
+    # logger.info("Got response: %s", response)
 
     response = claude_api_client.send_prompt(prompt="Describe the image in 1 sentence without describing the thing the cat is lying on.",
                                              image_url="https://agentlegoodbye.com/wp-content/uploads/photo-gallery/thumb/Purrito-4.jpg",
                                              conversation_id="test")
 
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
     response = claude_api_client.send_prompt(prompt="Now tell me the color of the thing the cat is lying on", conversation_id="test")
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
 
 
     response = claude_api_client.send_prompt(prompt="What were the last things we spoke about?", conversation_id="test2")
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
     pass
\ No newline at end of file
@@ -0,0 +1,112 @@
+import queue
+import threading
+from typing import Callable, List, Optional
+from modules.Config import Config
+from modules.helpers.logging_helper import logger
+from modules.helpers.prompt_helpers import get_num_tokens_from_string
+
+SUMMARY_INSTRUCTIONS = ("Update the summary of an ongoing conversation with the turns below. Keep the names, facts, "
+                        "decisions and open questions a reader would need to continue the conversation, in at most "
+                        "{max_words} words. Reply with the updated summary only.")
+
+
+class Compactor:
+    """
+    Folds the dialogues a conversation evicts into a running summary, so a long conversation keeps its context
+    while its prompts stay about the same size.
+
+    Conversations hand evicted dialogues to on_dialogue_evicted, which only queues them. A background thread
+    summarizes them with send_prompt, one call per conversation for everything evicted from it since the last call,
+    and leaves the result with the conversation, for the next request to apply. Requests never wait on a summary: one
+    that arrives before the summary is ready is sent with the previous one. When the queue is full, or the summarizing model fails, the evicted
+    dialogues are dropped and counted, as they were before compaction existed.
+    """
+    def __init__(self, model: str, max_summary_words: int = 200, queue_size: int = 1000):
+        self.model = model
+        self.max_summary_words = max_summary_words
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.send_prompt: Optional[Callable[[str], str]] = None
+        self.num_compacted = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+        self.lock = threading.Lock()
+        self.worker = None
+
+    @classmethod
+    def from_config(cls, config: Config) -> "Compactor":
+        return cls(model=config.compaction_model, max_summary_words=config.compaction_max_summary_words,
+                   queue_size=config.compaction_queue_size)
+
+    def start(self, send_prompt: Callable[[str], str]):
+        """send_prompt sends a stateless prompt to the summarizing model and returns its answer."""
+        if self.worker is not None:
+            return
+        self.send_prompt = send_prompt
+        self.worker = threading.Thread(target=self.run, name="compactor", daemon=True)
+        self.worker.start()
+
+    def on_dialogue_evicted(self, conversation, dialogue):
+        try:
+            self.queue.put_nowait((conversation, dialogue))
+        except queue.Full:
+            with self.lock:
+                self.num_dropped += 1
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            # Everything evicted meanwhile goes along, grouped per conversation in the order it was evicted
+            batches = {}
+            stop = False
+            while item is not None:
+                conversation, dialogue = item
+                batches.setdefault(id(conversation), (conversation, []))[1].append(dialogue)
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                stop = item is None
+            for conversation, dialogues in batches.values():
+                self.compact(conversation, dialogues)
+            if stop:
+                return
+
+    def compact(self, conversation, dialogues: List):
+        # A summary no request has applied yet is the latest one
+        pending = conversation.pending_summary
+        previous_summary = pending[0] if pending is not None else conversation.summary
+        try:
+            summary = self.send_prompt(self.build_prompt(previous_summary, dialogues)).strip()
+        except Exception as e:
+            logger.warning("Could not summarize %d dialogues with %s: %s", len(dialogues), self.model, e)
+            with self.lock:
+                self.num_failed += len(dialogues)
+            return
+        # Only handed over, the conversation may be in use by a request on another thread
+        conversation.pending_summary = (summary, get_num_tokens_from_string(summary, conversation.model))
+        with self.lock:
+            self.num_compacted += len(dialogues)
+
+    def build_prompt(self, summary: Optional[str], dialogues: List) -> str:
+        lines = [SUMMARY_INSTRUCTIONS.format(max_words=self.max_summary_words), "",
+                 "Summary so far:", summary or "(none yet)", "", "New turns:"]
+        for dialogue in dialogues:
+            lines.append(f"User: {dialogue.prompt_text}")
+            lines.append(f"Assistant: {dialogue.response_text}")
+        return "\n".join(lines)
+
+    def close(self):
+        if self.worker is not None:
+            self.queue.put(None)
+            self.worker.join(timeout=5)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "queued": self.queue.qsize(),
+                "compacted": self.num_compacted,
+                "dropped": self.num_dropped,
+                "failed": self.num_failed,
+            }
@@ -27,9 +27,21 @@ class Config:
 
         self.google_api_key = self.config['google_api_client']['api_key']
         self.google_model = self.config['google_api_client']['model']
+        # Empty uses the provider's endpoint, set to reach a proxy or the mock upstreams in benchmarks/
+        self.google_base_url = self.config.get('google_api_client', 'base_url', fallback='').strip() or None
+        # Older dialogues are dropped from the context sent with a prompt to keep it under this many tokens
+        self.google_max_conversation_tokens = self.config.getint('google_api_client', 'max_conversation_tokens',
+                                                                 fallback=32000)
 
         self.claude_api_key = self.config['claude_api_client']['api_key']
         self.claude_model = self.config['claude_api_client']['model']
+        self.claude_base_url = self.config.get('claude_api_client', 'base_url', fallback='').strip() or None
+        # Falls back to the OpenAI system message, so both providers are told the same thing by default
+        self.claude_system_message = (self.config.get('claude_api_client', 'system_message', fallback='').strip()
+                                      or self.openai_system_message)
+        self.claude_prompt_caching = self.config.getboolean('claude_api_client', 'prompt_caching', fallback=True)
+        self.claude_max_conversation_tokens = self.config.getint('claude_api_client', 'max_conversation_tokens',
+                                                                 fallback=32000)
 
         self.whitelist_enabled = self.config['server']['whitelist_enabled'].lower() == 'true'
         self.whitelist = [item.strip() for item in self.config['server']['whitelist'].split(',') if self.whitelist_enabled]
@@ -39,3 +51,113 @@ class Config:
 
         self.host = self.config['server']['host']
         self.port = int(self.config['server']['port'])
+
+        # 'sync' serves with Flask, 'async' serves the ASGI app with uvicorn
+        self.server_mode = self.config.get('server', 'mode', fallback='sync').strip().lower()
+        if self.server_mode not in ('sync', 'async'):
+            raise Exception(f"Invalid server mode '{self.server_mode}', expected 'sync' or 'async'")
+        self.max_concurrent_upstream_requests = self.config.getint('server', 'max_concurrent_upstream_requests',
+                                                                   fallback=32)
+        # Worker processes running the upstream calls and holding the conversations, 0 runs them in-process
+        self.workers = self.config.getint('server', 'workers', fallback=0)
+
+        self.http_pool_size = self.config.getint('http', 'pool_size', fallback=20)
+        self.http_keepalive_expiry_seconds = self.config.getfloat('http', 'keepalive_expiry_seconds', fallback=30.0)
+        self.http2_enabled = self.config.getboolean('http', 'http2', fallback=False)
+        self.http_connect_timeout_seconds = self.config.getfloat('http', 'connect_timeout_seconds', fallback=5.0)
+        self.http_read_timeout_seconds = self.config.getfloat('http', 'read_timeout_seconds', fallback=120.0)
+
+        # Limits for the conversations kept in memory by each model's container, 0 disables a limit
+        self.max_conversations = self.config.getint('conversations', 'max_conversations', fallback=10000)
+        self.max_conversation_memory_bytes = int(self.config.getfloat('conversations', 'max_memory_mb', fallback=512) * 1024 * 1024)
+        self.conversation_sweep_interval_seconds = self.config.getfloat('conversations', 'sweep_interval_seconds', fallback=60)
+        # "model: tokens" pairs overriding the max_conversation_tokens of the model's client section
+        self.model_max_conversation_tokens = {}
+        for item in self.config.get('conversations', 'max_tokens_per_model', fallback='').split(','):
+            if item.strip():
+                model, tokens = item.rsplit(':', 1)
+                self.model_max_conversation_tokens[model.strip()] = int(tokens)
+
+        # Dialogues evicted from conversations are summarized by this model in the background instead of forgotten
+        self.compaction_enabled = self.config.getboolean('compaction', 'enabled', fallback=False)
+        self.compaction_model = self.config.get('compaction', 'model', fallback='gpt-4o-mini').strip()
+        self.compaction_max_summary_words = self.config.getint('compaction', 'max_summary_words', fallback=200)
+        self.compaction_queue_size = self.config.getint('compaction', 'queue_size', fallback=1000)
+        if self.compaction_enabled and self.compaction_model not in (*self.openai_models, self.google_model,
+                                                                     self.claude_model):
+            raise Exception(f"Invalid compaction model '{self.compaction_model}', it must be one of the models served")
+
+        self.image_cache_max_bytes = int(self.config.getfloat('images', 'cache_max_mb', fallback=64) * 1024 * 1024)
+        self.image_cache_ttl_seconds = self.config.getfloat('images', 'cache_ttl_seconds', fallback=600)
+        # Images are sent again with only this many later turns of a conversation, negative sends them with all
+        self.image_history_turns = self.config.getint('images', 'history_turns', fallback=1)
+        if self.image_history_turns < 0:
+            self.image_history_turns = None
+        # Images are scaled down and recompressed to these limits before they are sent to Claude and Gemini
+        self.image_processing_processes = self.config.getint('images', 'processing_processes', fallback=2)
+        self.claude_image_max_edge = self.config.getint('images', 'claude_max_edge', fallback=1568)
+        self.claude_image_max_bytes = int(self.config.getfloat('images', 'claude_max_kb', fallback=1024) * 1024)
+        self.google_image_max_edge = self.config.getint('images', 'google_max_edge', fallback=1536)
+        self.google_image_max_bytes = int(self.config.getfloat('images', 'google_max_kb', fallback=1024) * 1024)
+
+        # Opt-in cache of responses to prompts sent without a conversation_id
+        self.response_cache_enabled = self.config.getboolean('response_cache', 'enabled', fallback=False)
+        self.response_cache_max_entries = self.config.getint('response_cache', 'max_entries', fallback=1000)
+        self.response_cache_max_bytes = int(self.config.getfloat('response_cache', 'max_mb', fallback=16) * 1024 * 1024)
+        self.response_cache_ttl_seconds = self.config.getfloat('response_cache', 'ttl_seconds', fallback=300)
+
+        # "model: cost" pairs, models not listed cost 1
+        self.rate_limit_model_costs = {}
+        for item in self.config.get('rate_limit', 'model_costs', fallback='').split(','):
+            if item.strip():
+                model, cost = item.rsplit(':', 1)
+                self.rate_limit_model_costs[model.strip()] = float(cost)
+        served_model_costs = [self.rate_limit_model_costs.get(model, 1.0)
+                              for model in (*self.openai_models, self.google_model, self.claude_model)]
+
+        # Token buckets per caller and per model, 0 requests per minute disables a bucket. Without a [rate_limit]
+        # section, callers get the old behaviour of one request per min_seconds_between_requests_per_user, with a
+        # burst that covers asking every model at once
+        legacy_requests_per_minute = 60 / self.min_seconds_between_requests_per_user if self.min_seconds_between_requests_per_user > 0 else 0
+        self.rate_limit_caller_requests_per_minute = self.config.getfloat('rate_limit', 'caller_requests_per_minute',
+                                                                          fallback=legacy_requests_per_minute)
+        self.rate_limit_caller_burst = self.config.getfloat('rate_limit', 'caller_burst', fallback=sum(served_model_costs))
+        # Requests costing more than the burst are rejected, so it must at least cover asking any one model
+        if self.rate_limit_caller_requests_per_minute > 0 and self.rate_limit_caller_burst < max(served_model_costs):
+            raise Exception(f"Invalid rate_limit caller_burst {self.rate_limit_caller_burst:g}, it must be at least "
+                            f"the largest model cost {max(served_model_costs):g}")
+        self.rate_limit_model_requests_per_minute = self.config.getfloat('rate_limit', 'model_requests_per_minute',
+                                                                         fallback=0)
+        self.rate_limit_model_burst = self.config.getfloat('rate_limit', 'model_burst', fallback=10)
+
+        # How /prompt fans out to multiple models when the request doesn't pass a strategy
+        self.fan_out_default_strategy = self.config.get('fan_out', 'default_strategy', fallback='all').strip().lower()
+        if self.fan_out_default_strategy not in ('all', 'race', 'hedged', 'deadline'):
+            raise Exception(f"Invalid fan-out strategy '{self.fan_out_default_strategy}', expected 'all', 'race', 'hedged' or 'deadline'")
+        self.fan_out_hedge_delay_ms = self.config.getfloat('fan_out', 'hedge_delay_ms', fallback=3000)
+        self.fan_out_deadline_ms = self.config.getint('fan_out', 'deadline_ms', fallback=10000)
+
+        # Conversations written behind to SQLite, so they survive restarts and eviction from memory
+        self.persistence_enabled = self.config.getboolean('persistence', 'enabled', fallback=False)
+        self.persistence_path = self.config.get('persistence', 'path', fallback='conversations.sqlite3')
+        self.persistence_batch_size = self.config.getint('persistence', 'batch_size', fallback=256)
+        self.persistence_flush_interval_seconds = self.config.getfloat('persistence', 'flush_interval_seconds',
+                                                                       fallback=1.0)
+
+        # Every upstream call gets timeout_seconds for all of its attempts. Each provider has a circuit breaker that
+        # opens after breaker_failure_threshold failures in a row, 0 disables it
+        self.upstream_timeout_seconds = self.config.getfloat('upstream', 'timeout_seconds', fallback=60)
+        self.upstream_max_attempts = self.config.getint('upstream', 'max_attempts', fallback=3)
+        self.upstream_backoff_base_ms = self.config.getfloat('upstream', 'backoff_base_ms', fallback=250)
+        self.upstream_backoff_max_ms = self.config.getfloat('upstream', 'backoff_max_ms', fallback=5000)
+        self.upstream_breaker_failure_threshold = self.config.getint('upstream', 'breaker_failure_threshold',
+                                                                     fallback=5)
+        self.upstream_breaker_reset_seconds = self.config.getfloat('upstream', 'breaker_reset_seconds', fallback=30)
+
+        # Records are written by a background thread, a full queue drops records instead of blocking requests
+        self.log_level = self.config.get('logging', 'level', fallback='INFO').strip().upper()
+        if self.log_level not in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'):
+            raise Exception(f"Invalid log level '{self.log_level}'")
+        self.log_queue_size = self.config.getint('logging', 'queue_size', fallback=10000)
+        self.log_max_payload_chars = self.config.getint('logging', 'max_payload_chars', fallback=300)
+        self.log_debug_sample_rate = self.config.getint('logging', 'debug_sample_rate', fallback=1)
@@ -1,99 +1,272 @@
 import time
 from modules.Dialogue import OpenAIDialogue, GoogleAIDialogue, ClaudeDialogue
-from typing import List
+from modules.TurnStore import Turn
+from modules.helpers.json_helpers import encode_messages
+from typing import List, Optional, Callable, Tuple
 from abc import ABC, abstractmethod
 
+# How the summary of the evicted dialogues is put in front of the ones still kept
+SUMMARY_PREFIX = "Summary of the earlier part of this conversation: "
+SUMMARY_ACKNOWLEDGEMENT = "Understood."
+
 
 class Conversation(ABC):
+    """
+    One model's branch of a conversation: its answers to the turns, which are shared with the branches of the other
+    models asked the same prompts. The provider's messages are rendered from them when a request is built.
+    """
+    # Tens of thousands of these can be alive at once, so no per-instance __dict__
+    __slots__ = ("max_length", "update_epoch", "dialogues", "model", "size_bytes", "size_listener",
+                 "version", "messages_cache", "conversation_id", "total_tokens", "summary", "summary_tokens",
+                 "eviction_listener", "image_history_turns", "last_used", "pending_summary")
+    # Set by each subclass, used to restore dialogues from their dicts
+    dialogue_class = None
+
+    def __init__(self, max_length: int, model: str):
+        self.max_length = max_length
+        self.update_epoch = time.time()
+        # Oldest first. A list rather than a deque: conversations hold a handful of dialogues, where evicting from
+        # the front of a list is as quick, and an empty deque alone takes 760 bytes against a list's 56
+        self.dialogues: List = []
+        self.model = model
+        # Approximate memory held by the dialogues, reported to the owning container as it changes
+        self.size_bytes = 0
+        self.size_listener: Optional[Callable[["Conversation", int], None]] = None
+        # Bumped on every add and eviction. get_messages_for_api caches its output as (version, messages)
+        # and only rebuilds it once the version has moved on. A change drops the cache, so the rendered messages
+        # only stay alive while requests are using them
+        self.version = 0
+        self.messages_cache: Optional[Tuple[int, List[dict]]] = None
+        # Set by the owning container, which persists the conversation under it
+        self.conversation_id: Optional[str] = None
+        # Running sum of total_num_tokens over self.dialogues, kept in step on every add and pop
+        self.total_tokens = 0
+        # Running summary of the evicted dialogues, written by the compactor when one is set as eviction_listener
+        self.summary: Optional[str] = None
+        self.summary_tokens = 0
+        self.eviction_listener: Optional[Callable[["Conversation", object], None]] = None
+        # (summary, tokens) from the compactor's thread, applied by the next request, see apply_pending_summary
+        self.pending_summary: Optional[Tuple[str, int]] = None
+        # Images are only sent with the newest this many dialogues, the older ones get a placeholder. None keeps them
+        self.image_history_turns: Optional[int] = None
+        # Stamped by the owning container on every use, orders conversations across containers sharing a budget
+        self.last_used = 0
+
     @abstractmethod
-    def add(self, prompt_message, response_message):
+    def add(self, turn: Turn, response_text: str):
         pass
 
     @abstractmethod
-    def get_messages_for_api(self):
+    def build_messages_for_api(self, dialogues: Tuple) -> List[dict]:
         pass
 
+    @abstractmethod
+    def build_summary_messages(self, summary: str) -> List[dict]:
+        pass
 
-class OpenAIConversation(Conversation):
-    def __init__(self, max_length: int, model: str):
-        self.max_length = max_length
-        self.update_epoch = time.time()
-        self.dialogues: List[OpenAIDialogue] = []
-        self.model = model
+    def get_messages_for_api(self) -> List[dict]:
+        """The returned list is shared between requests, callers must copy it rather than modify it."""
+        cache = self.messages_cache
+        version = self.version
+        if cache is not None and cache[0] == version:
+            return cache[1]
+        # Copying the list is a single C call, so another request appending meanwhile can't break the iteration
+        messages = self.build_messages_for_api(tuple(self.dialogues))
+        summary = self.summary
+        if summary:
+            messages = self.build_summary_messages(summary) + messages
+        self.messages_cache = (version, messages)
+        return messages
 
-    def add(self, prompt_message: dict, response_message: dict):
-        dialogue = OpenAIDialogue(prompt_message, response_message, self.model)
+    def to_dict(self) -> dict:
+        """
+        Snapshot for persistence. The texts and images are shared rather than copied, they are never modified once
+        added, so the snapshot stays valid while the conversation moves on.
+        """
+        return {
+            "model": self.model,
+            "update_epoch": self.update_epoch,
+            "dialogues": self.dialogues_to_dicts(tuple(self.dialogues)),
+            "summary": self.summary,
+            "summary_tokens": self.summary_tokens,
+        }
+
+    def dialogues_to_dicts(self, dialogues: Tuple) -> List[dict]:
+        return [dialogue.to_dict() for dialogue in dialogues]
+
+    @classmethod
+    def from_dict(cls, data: dict, max_length: int) -> "Conversation":
+        conversation = cls(max_length=max_length, model=data["model"])
+        for dialogue_data in data["dialogues"]:
+            conversation.append_dialogue(cls.dialogue_class.from_dict(dialogue_data, conversation.model))
+        # Conversations saved before compaction existed have no summary
+        if data.get("summary"):
+            conversation.set_summary(data["summary"], data["summary_tokens"])
+        conversation.update_epoch = data["update_epoch"]
+        return conversation
+
+    def changed(self):
+        self.version += 1
+        self.messages_cache = None
+
+    def resize(self, delta_bytes: int):
+        listener = self.size_listener
+        if listener is None:
+            self.size_bytes += delta_bytes
+        else:
+            # The container applies the change under its own lock so its totals never drift
+            listener(self, delta_bytes)
+
+    def append_dialogue(self, dialogue):
         if len(self.dialogues) == self.max_length:
-            self.dialogues.pop(0)
+            self.pop_oldest()
         self.dialogues.append(dialogue)
+        self.total_tokens += dialogue.total_num_tokens
+        delta_bytes = dialogue.size_bytes
+        if self.image_history_turns is not None:
+            delta_bytes -= self.strip_old_images()
+        self.changed()
+        # Updated before the listener hears about the change, so a persisted snapshot carries the new epoch
         self.update_epoch = time.time()
+        self.resize(delta_bytes)
 
-    def get_messages_for_api(self):
-        messages = []
-        for dialogue in self.dialogues:
-            messages.append(dialogue.prompt_message)
-            messages.append(dialogue.response_message)
-        return messages
+    def strip_old_images(self) -> int:
+        """Replace the images of dialogues outside the image window, returns the bytes that freed."""
+        removed_bytes = 0
+        dialogues = tuple(self.dialogues)
+        for dialogue in dialogues[:max(len(dialogues) - self.image_history_turns, 0)]:
+            dialogue_tokens, dialogue_bytes = dialogue.strip_images()
+            self.total_tokens -= dialogue_tokens
+            removed_bytes += dialogue_bytes
+        return removed_bytes
+
+    def pop_oldest(self):
+        dialogue = self.dialogues.pop(0)
+        self.total_tokens -= dialogue.total_num_tokens
+        self.changed()
+        self.resize(-dialogue.size_bytes)
+        listener = self.eviction_listener
+        if listener is not None:
+            listener(self, dialogue)
+        return dialogue
+
+    def set_summary(self, summary: str, num_tokens: int):
+        delta_bytes = len(summary) - len(self.summary or "")
+        self.summary = summary
+        self.summary_tokens = num_tokens
+        self.changed()
+        self.resize(delta_bytes)
+
+    def apply_pending_summary(self):
+        """
+        Take on the summary the compactor left, on the thread of a request using the conversation. Applying it from the
+        compactor's thread could race a request trimming the conversation or building its messages.
+        """
+        pending = self.pending_summary
+        if pending is None:
+            return
+        self.pending_summary = None
+        self.set_summary(*pending)
 
     def get_total_tokens(self):
-        return sum([dialogue.total_num_tokens for dialogue in self.dialogues])
+        return self.total_tokens + self.summary_tokens
 
     def trim(self, prompt_tokens: int, token_limit: int):
         # Remove dialogues until the total number of the prompt and saved dialogues is less than the token limit
         while len(self.dialogues) > 0 and self.get_total_tokens() + prompt_tokens >= token_limit:
-            self.dialogues.pop(0)
+            self.pop_oldest()
+
+
+class OpenAIConversation(Conversation):
+    __slots__ = ()
+    dialogue_class = OpenAIDialogue
+
+    def __init__(self, max_length: int, model: str):
+        super().__init__(max_length=max_length, model=model)
+
+    def add(self, turn: Turn, response_text: str, prompt_num_tokens: Optional[int] = None):
+        dialogue = OpenAIDialogue(turn, response_text, self.model, prompt_num_tokens=prompt_num_tokens)
+        self.append_dialogue(dialogue)
+
+    def build_messages_for_api(self, dialogues: Tuple) -> List[dict]:
+        messages = []
+        for dialogue in dialogues:
+            messages.append(dialogue.prompt_message)
+            messages.append(dialogue.response_message)
+        return messages
+
+    def build_summary_messages(self, summary: str) -> List[dict]:
+        return [{"role": "system", "content": SUMMARY_PREFIX + summary}]
+
+    def dialogues_to_dicts(self, dialogues: Tuple) -> List[dict]:
+        # The responses are only kept encoded, read them all back with a single decode
+        responses = OpenAIDialogue.decode_responses(dialogues)
+        return [dialogue.to_dict(response) for dialogue, response in zip(dialogues, responses)]
+
+    def get_encoded_messages(self) -> Tuple[List[bytes], int]:
+        """
+        The JSON encoded form of get_messages_for_api, as fragments to splice into a request body (see
+        EncodedMessages), and the number of messages they hold. Only the summary is encoded here, every dialogue
+        was encoded once when it was added.
+        """
+        dialogues = tuple(self.dialogues)
+        fragments = [dialogue.encoded_messages for dialogue in dialogues]
+        count = 2 * len(dialogues)
+        summary = self.summary
+        if summary:
+            summary_messages = self.build_summary_messages(summary)
+            fragments.insert(0, encode_messages(summary_messages))
+            count += len(summary_messages)
+        return fragments, count
 
 
 class GoogleAIConversation(Conversation):
+    __slots__ = ()
+    dialogue_class = GoogleAIDialogue
+
     def __init__(self, max_length: int, model: str):
-        self.max_length = max_length
-        self.update_epoch = time.time()
-        self.dialogues: List[GoogleAIDialogue] = []
-        self.model = model
+        super().__init__(max_length=max_length, model=model)
 
-    def add(self, prompt_contents: dict, response_text: str):
-        dialogue = GoogleAIDialogue(prompt_contents, response_text)
-        if len(self.dialogues) == self.max_length:
-            self.dialogues.pop(0)
-        self.dialogues.append(dialogue)
-        self.update_epoch = time.time()
+    def add(self, turn: Turn, response_text: str, image=None, prompt_num_tokens: Optional[int] = None,
+            response_num_tokens: Optional[int] = None):
+        self.append_dialogue(GoogleAIDialogue(turn, response_text, self.model, image=image,
+                                              prompt_num_tokens=prompt_num_tokens,
+                                              response_num_tokens=response_num_tokens))
 
-    def get_messages_for_api(self):
+    def build_messages_for_api(self, dialogues: Tuple) -> List[dict]:
         messages = []
-        for dialogue in self.dialogues:
+        for dialogue in dialogues:
             messages.append(dialogue.prompt_contents)
-            messages.append({
-                "role": "model",
-                "parts": [dialogue.response_text]
-            })
+            messages.append(dialogue.response_message)
         return messages
 
+    def build_summary_messages(self, summary: str) -> List[dict]:
+        # Gemini wants the turns to alternate, so the summary is a user turn the model has acknowledged
+        return [{"role": "user", "parts": [SUMMARY_PREFIX + summary]},
+                {"role": "model", "parts": [SUMMARY_ACKNOWLEDGEMENT]}]
+
 
 class ClaudeConversation(Conversation):
+    __slots__ = ()
+    dialogue_class = ClaudeDialogue
+
     def __init__(self, max_length: int, model: str):
-        self.max_length = max_length
-        self.update_epoch = time.time()
-        self.dialogues: List[ClaudeDialogue] = []
-        self.model = model
+        super().__init__(max_length=max_length, model=model)
 
-    def add(self, prompt_contents: dict, response_text: str):
-        dialogue = ClaudeDialogue(prompt_contents, response_text)
-        if len(self.dialogues) == self.max_length:
-            self.dialogues.pop(0)
-        self.dialogues.append(dialogue)
-        self.update_epoch = time.time()
+    def add(self, turn: Turn, response_text: str, image=None, prompt_num_tokens: Optional[int] = None,
+            response_num_tokens: Optional[int] = None):
+        self.append_dialogue(ClaudeDialogue(turn, response_text, self.model, image=image,
+                                            prompt_num_tokens=prompt_num_tokens,
+                                            response_num_tokens=response_num_tokens))
 
-    def get_messages_for_api(self):
+    def build_messages_for_api(self, dialogues: Tuple) -> List[dict]:
         messages = []
-        for dialogue in self.dialogues:
+        for dialogue in dialogues:
             messages.append(dialogue.prompt_contents)
-            messages.append({
-                "role": "assistant",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": dialogue.response_text
-                    }
-                ]
-            })
-        return messages
\ No newline at end of file
+            messages.append(dialogue.response_message)
+        return messages
+
+    def build_summary_messages(self, summary: str) -> List[dict]:
+        # Claude wants the first turn to be the user's and the turns to alternate
+        return [{"role": "user", "content": [{"type": "text", "text": SUMMARY_PREFIX + summary}]},
+                {"role": "assistant", "content": [{"type": "text", "text": SUMMARY_ACKNOWLEDGEMENT}]}]
@@ -1,52 +1,319 @@
 from modules.Conversation import Conversation, OpenAIConversation, GoogleAIConversation, ClaudeConversation
+from modules.Compactor import Compactor
+from modules.ConversationStore import ConversationStore
+from modules.helpers.logging_helper import logger
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+import itertools
+import threading
+import time
+import weakref
+
+
+class MemoryBudget:
+    """
+    Byte budget shared by every container, so the cap applies to all conversations held by the server. When it is
+    exceeded, the least recently used conversation of all the containers sharing it is evicted first, whichever
+    container's growth crossed it.
+    """
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+        self.containers: "weakref.WeakSet[ConversationContainer]" = weakref.WeakSet()
+        # Use stamps, ordering the conversations of every container on one clock
+        self.clock = itertools.count(1)
+        # Held while evicting, taken before any container's lock and never while holding one
+        self.eviction_lock = threading.Lock()
+
+    def register(self, container: "ConversationContainer"):
+        self.containers.add(container)
+
+    def tick(self) -> int:
+        return next(self.clock)
+
+    def adjust(self, delta_bytes: int):
+        with self.lock:
+            self.used_bytes += delta_bytes
+
+    def is_exceeded(self) -> bool:
+        return self.max_bytes > 0 and self.used_bytes > self.max_bytes
+
+    def enforce(self, keep: Conversation):
+        """Evict the least recently used conversations of all containers until within budget, except keep."""
+        if not self.is_exceeded():
+            return
+        with self.eviction_lock:
+            while self.is_exceeded():
+                oldest = None
+                for container in list(self.containers):
+                    candidate = container.get_least_recently_used(keep)
+                    if candidate is not None and (oldest is None or candidate[2] < oldest[3]):
+                        oldest = (container,) + candidate
+                if oldest is None:
+                    # Only the conversation being served is left
+                    return
+                container, conversation_id, conversation, last_used = oldest
+                container.evict(conversation_id, conversation, last_used, "max_bytes")
 
 
 class ConversationContainer(ABC):
+    """
+    Holds conversations in least-recently-used order. Conversations idle for longer than
+    conversation_prune_after_seconds expire, and the least recently used ones are evicted whenever
+    max_conversations or the memory budget is exceeded. Both only ever look at the front of the
+    ordering, so eviction is amortized O(1) rather than a scan of every conversation.
+
+    With a store, every change to a conversation is saved to it and conversations missing from memory are looked up
+    there, so evicted ones and ones from before a restart come back on their next request. Only expiry deletes a
+    conversation from the store.
+
+    With a compactor, the dialogues a conversation evicts to stay within its limits are folded into its summary
+    instead of being forgotten.
+    """
+    # Namespace of this container's conversations in the store
+    store_namespace = None
+
+    def __init__(self, conversation_prune_after_seconds: int, max_dialogues_per_conversation: int,
+                 max_conversations: int = 0, memory_budget: Optional[MemoryBudget] = None,
+                 sweep_interval_seconds: float = 0, store: Optional[ConversationStore] = None,
+                 compactor: Optional[Compactor] = None, image_history_turns: Optional[int] = None):
+        self.conversation_prune_after_seconds = conversation_prune_after_seconds
+        self.max_dialogues_per_conversation = max_dialogues_per_conversation
+        self.max_conversations = max_conversations
+        self.memory_budget = memory_budget if memory_budget is not None else MemoryBudget()
+        self.memory_budget.register(self)
+        self.conversations: OrderedDict[str, Conversation] = OrderedDict()
+        self.lock = threading.RLock()
+        self.total_bytes = 0
+        self.evictions = {"expired": 0, "max_conversations": 0, "max_bytes": 0}
+        self.store = store
+        self.num_restored = 0
+        # Summarizes the dialogues conversations evict, None drops them
+        self.compactor = compactor
+        # Images are only sent with this many of a conversation's newest dialogues, None sends them with every turn
+        self.image_history_turns = image_history_turns
+
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self.stop_sweeping = threading.Event()
+        self.sweeper = None
+        if sweep_interval_seconds > 0 and conversation_prune_after_seconds > 0:
+            self.sweeper = threading.Thread(target=self.sweep, name=f"{type(self).__name__}-sweeper", daemon=True)
+            self.sweeper.start()
+
     @abstractmethod
-    def get_conversation(self, conversation_id: str, model: str) -> Conversation:
+    def create_conversation(self, model: str) -> Conversation:
+        pass
+
+    @abstractmethod
+    def restore_conversation(self, record: dict) -> Conversation:
         pass
 
+    def load_conversation(self, conversation_id: str, now: float) -> Optional[Conversation]:
+        record = self.store.load(self.store_namespace, conversation_id)
+        if record is None:
+            return None
+        try:
+            conversation = self.restore_conversation(record)
+        except Exception as e:
+            logger.error("Failed to restore conversation %s for %s: %s", conversation_id, self.store_namespace, e)
+            return None
+        if self.is_expired(conversation, now):
+            self.store.delete(self.store_namespace, conversation_id)
+            return None
+        return conversation
+
+    def get_conversation(self, conversation_id: str, model: str) -> Conversation:
+        loaded = None
+        if self.store is not None:
+            with self.lock:
+                in_memory = conversation_id in self.conversations
+            if not in_memory:
+                # Read outside the lock so a slow lookup doesn't hold up every other request
+                loaded = self.load_conversation(conversation_id, time.time())
+
+        with self.lock:
+            now = time.time()
+            conversation = self.conversations.get(conversation_id)
+            if conversation is not None and self.is_expired(conversation, now):
+                self.remove(conversation_id, "expired")
+                conversation = None
+
+            if conversation is None:
+                if loaded is not None:
+                    conversation = loaded
+                    self.num_restored += 1
+                else:
+                    # Create a new conversation if it doesn't exist
+                    conversation = self.create_conversation(model)
+                conversation.conversation_id = conversation_id
+                conversation.size_listener = self.on_conversation_resized
+                if self.compactor is not None:
+                    conversation.eviction_listener = self.compactor.on_dialogue_evicted
+                conversation.image_history_turns = self.image_history_turns
+                self.conversations[conversation_id] = conversation
+                self.total_bytes += conversation.size_bytes
+                self.memory_budget.adjust(conversation.size_bytes)
+            else:
+                self.conversations.move_to_end(conversation_id)
+            conversation.last_used = self.memory_budget.tick()
+
+            self.prune_expired(now)
+            self.enforce_limits()
+        # Outside this container's lock, applying the summary reports its size to the container
+        conversation.apply_pending_summary()
+        # Outside this container's lock, the budget may evict from any container sharing it
+        self.memory_budget.enforce(keep=conversation)
+        return conversation
+
+    def is_expired(self, conversation: Conversation, now: float) -> bool:
+        return (self.conversation_prune_after_seconds > 0
+                and now - conversation.update_epoch > self.conversation_prune_after_seconds)
+
+    def remove(self, conversation_id: str, reason: str):
+        conversation = self.conversations.pop(conversation_id)
+        # Requests still holding the conversation may keep adding to it, they no longer count against the budget
+        conversation.size_listener = None
+        conversation.eviction_listener = None
+        self.total_bytes -= conversation.size_bytes
+        self.memory_budget.adjust(-conversation.size_bytes)
+        self.evictions[reason] += 1
+        if reason == "expired" and self.store is not None:
+            self.store.delete(self.store_namespace, conversation_id)
+
+    def on_conversation_resized(self, conversation: Conversation, delta_bytes: int):
+        if self.store is not None:
+            # Only the conversation is queued. Its snapshot is taken, serialized and written on the store's writer
+            # thread, off the request path
+            self.store.save(self.store_namespace, conversation.conversation_id, conversation)
+        with self.lock:
+            conversation.size_bytes += delta_bytes
+            if conversation.size_listener is None:
+                # Evicted while a request was still adding to it
+                return
+            self.total_bytes += delta_bytes
+            self.memory_budget.adjust(delta_bytes)
+            self.enforce_limits()
+        self.memory_budget.enforce(keep=conversation)
+
+    def prune_expired(self, now: Optional[float] = None) -> int:
+        """Expire idle conversations from the least recently used end, stopping at the first live one."""
+        now = time.time() if now is None else now
+        num_expired = 0
+        with self.lock:
+            while self.conversations:
+                conversation_id, conversation = next(iter(self.conversations.items()))
+                if not self.is_expired(conversation, now):
+                    break
+                self.remove(conversation_id, "expired")
+                num_expired += 1
+        return num_expired
+
+    def enforce_limits(self):
+        with self.lock:
+            # The most recently used conversation is always kept, it is the one being served right now
+            while self.max_conversations > 0 and len(self.conversations) > self.max_conversations:
+                self.remove(next(iter(self.conversations)), "max_conversations")
+
+    def get_least_recently_used(self, keep: Conversation):
+        """(conversation_id, conversation, last_used) of the least recently used conversation other than keep."""
+        with self.lock:
+            for conversation_id, conversation in self.conversations.items():
+                if conversation is not keep:
+                    return conversation_id, conversation, conversation.last_used
+            return None
+
+    def evict(self, conversation_id: str, conversation: Conversation, last_used: int, reason: str):
+        """Remove the conversation, unless it was replaced or used again since it was picked."""
+        with self.lock:
+            if self.conversations.get(conversation_id) is conversation and conversation.last_used == last_used:
+                self.remove(conversation_id, reason)
+
+    def sweep(self):
+        while not self.stop_sweeping.wait(self.sweep_interval_seconds):
+            try:
+                num_expired = self.prune_expired()
+                if num_expired > 0:
+                    logger.info("%s expired %d idle conversations", type(self).__name__, num_expired)
+                if self.store is not None:
+                    # Conversations that expired while not in memory are only ever found here
+                    self.store.delete_older_than(self.store_namespace,
+                                                 time.time() - self.conversation_prune_after_seconds)
+            except Exception:
+                # A failed sweep is retried on the next interval, the sweeper must not die with it
+                logger.exception("%s failed to sweep expired conversations", type(self).__name__)
+
+    def close(self):
+        self.stop_sweeping.set()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "conversations": len(self.conversations),
+                "bytes": self.total_bytes,
+                "evictions": dict(self.evictions),
+                "restored": self.num_restored,
+            }
+
 
 class OpenAIConversationContainer(ConversationContainer):
-    def __init__(self, conversation_prune_after_seconds: int, max_dialogues_per_conversation: int):
-        self.conversation_prune_after_seconds = conversation_prune_after_seconds
-        self.max_dialogues_per_conversation = max_dialogues_per_conversation
-        self.conversations = {}
+    store_namespace = "openai"
+
+    def __init__(self, conversation_prune_after_seconds: int, max_dialogues_per_conversation: int,
+                 max_conversations: int = 0, memory_budget: Optional[MemoryBudget] = None,
+                 sweep_interval_seconds: float = 0, store: Optional[ConversationStore] = None,
+                 compactor: Optional[Compactor] = None, image_history_turns: Optional[int] = None):
+        super().__init__(conversation_prune_after_seconds=conversation_prune_after_seconds,
+                         max_dialogues_per_conversation=max_dialogues_per_conversation,
+                         max_conversations=max_conversations, memory_budget=memory_budget,
+                         sweep_interval_seconds=sweep_interval_seconds, store=store, compactor=compactor,
+                         image_history_turns=image_history_turns)
+
+    def create_conversation(self, model: str) -> OpenAIConversation:
+        return OpenAIConversation(max_length=self.max_dialogues_per_conversation, model=model)
 
-    def get_conversation(self, conversation_id: str, model: str) -> OpenAIConversation:
-        if conversation_id not in self.conversations:
-            # Create a new conversation if it doesn't exist
-            self.conversations[conversation_id] = OpenAIConversation(max_length=self.max_dialogues_per_conversation,
-                                                                     model=model)
-        return self.conversations[conversation_id]
+    def restore_conversation(self, record: dict) -> OpenAIConversation:
+        return OpenAIConversation.from_dict(record, max_length=self.max_dialogues_per_conversation)
 
 
 class GoogleConversationContainer(ConversationContainer):
-    def __init__(self, conversation_prune_after_seconds: int, max_dialogues_per_conversation: int, model: str):
-        self.conversation_prune_after_seconds = conversation_prune_after_seconds
-        self.max_dialogues_per_conversation = max_dialogues_per_conversation
-        self.conversations = {}
+    store_namespace = "google"
+
+    def __init__(self, conversation_prune_after_seconds: int, max_dialogues_per_conversation: int, model: str,
+                 max_conversations: int = 0, memory_budget: Optional[MemoryBudget] = None,
+                 sweep_interval_seconds: float = 0, store: Optional[ConversationStore] = None,
+                 compactor: Optional[Compactor] = None, image_history_turns: Optional[int] = None):
+        super().__init__(conversation_prune_after_seconds=conversation_prune_after_seconds,
+                         max_dialogues_per_conversation=max_dialogues_per_conversation,
+                         max_conversations=max_conversations, memory_budget=memory_budget,
+                         sweep_interval_seconds=sweep_interval_seconds, store=store, compactor=compactor,
+                         image_history_turns=image_history_turns)
         self.model = model
 
-    def get_conversation(self, conversation_id: str, model: str) -> GoogleAIConversation:
-        if conversation_id not in self.conversations:
-            # Create a new conversation if it doesn't exist
-            self.conversations[conversation_id] = GoogleAIConversation(max_length=self.max_dialogues_per_conversation,
-                                                                       model=model)
-        return self.conversations[conversation_id]
+    def create_conversation(self, model: str) -> GoogleAIConversation:
+        return GoogleAIConversation(max_length=self.max_dialogues_per_conversation, model=model)
+
+    def restore_conversation(self, record: dict) -> GoogleAIConversation:
+        return GoogleAIConversation.from_dict(record, max_length=self.max_dialogues_per_conversation)
 
 
 class ClaudeConversationContainer(ConversationContainer):
-    def __init__(self, conversation_prune_after_seconds: int, max_dialogues_per_conversation: int, model: str):
-        self.conversation_prune_after_seconds = conversation_prune_after_seconds
-        self.max_dialogues_per_conversation = max_dialogues_per_conversation
-        self.conversations = {}
+    store_namespace = "claude"
+
+    def __init__(self, conversation_prune_after_seconds: int, max_dialogues_per_conversation: int, model: str,
+                 max_conversations: int = 0, memory_budget: Optional[MemoryBudget] = None,
+                 sweep_interval_seconds: float = 0, store: Optional[ConversationStore] = None,
+                 compactor: Optional[Compactor] = None, image_history_turns: Optional[int] = None):
+        super().__init__(conversation_prune_after_seconds=conversation_prune_after_seconds,
+                         max_dialogues_per_conversation=max_dialogues_per_conversation,
+                         max_conversations=max_conversations, memory_budget=memory_budget,
+                         sweep_interval_seconds=sweep_interval_seconds, store=store, compactor=compactor,
+                         image_history_turns=image_history_turns)
         self.model = model
 
-    def get_conversation(self, conversation_id: str, model: str) -> ClaudeConversation:
-        if conversation_id not in self.conversations:
-            # Create a new conversation if it doesn't exist
-            self.conversations[conversation_id] = ClaudeConversation(max_length=self.max_dialogues_per_conversation,
-                                                                       model=model)
-        return self.conversations[conversation_id]
+    def create_conversation(self, model: str) -> ClaudeConversation:
+        return ClaudeConversation(max_length=self.max_dialogues_per_conversation, model=model)
+
+    def restore_conversation(self, record: dict) -> ClaudeConversation:
+        return ClaudeConversation.from_dict(record, max_length=self.max_dialogues_per_conversation)
@@ -0,0 +1,269 @@
+import base64
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+import PIL.Image
+from modules.Config import Config
+from modules.ImageStore import StoredImage, get_shared_image_store
+from modules.helpers.logging_helper import logger
+
+
+def encode_value(value):
+    """json.dumps hook for the non-JSON values a conversation can hold, the images in its prompts."""
+    if isinstance(value, StoredImage):
+        return {"__stored_image__": base64.b64encode(value.data).decode("ascii"), "media_type": value.media_type}
+    if isinstance(value, bytes):
+        return {"__bytes__": base64.b64encode(value).decode("ascii")}
+    if isinstance(value, PIL.Image.Image):
+        buffered = BytesIO()
+        value.save(buffered, format=value.format or "PNG")
+        return {"__image__": base64.b64encode(buffered.getvalue()).decode("ascii")}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def get_record(record) -> dict:
+    """The dict to persist for what was passed to save(), a record or a conversation not yet snapshotted."""
+    return record if isinstance(record, dict) else record.to_dict()
+
+
+def decode_object(value: dict):
+    if "__stored_image__" in value:
+        # Back in the shared store, so conversations loaded with the same image hold a single copy again
+        return get_shared_image_store().intern(base64.b64decode(value["__stored_image__"]), value["media_type"])
+    if "__bytes__" in value:
+        return base64.b64decode(value["__bytes__"])
+    # Written before Gemini images were kept as their encoded bytes
+    if "__image__" in value:
+        return PIL.Image.open(BytesIO(base64.b64decode(value["__image__"])))
+    return value
+
+
+class ConversationStore(ABC):
+    """
+    Durable home of conversations outside the process. Conversations are addressed by a namespace, one per
+    container, and their conversation_id. Records are the dicts produced by Conversation.to_dict. save() also takes
+    the conversation itself, to be snapshotted when it is written rather than by the request that changed it.
+    """
+    @abstractmethod
+    def load(self, namespace: str, conversation_id: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    def save(self, namespace: str, conversation_id: str, record):
+        pass
+
+    @abstractmethod
+    def delete(self, namespace: str, conversation_id: str):
+        pass
+
+    @abstractmethod
+    def delete_older_than(self, namespace: str, update_epoch: float):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_stats(self) -> dict:
+        return {}
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Conversations in a single SQLite table, written behind the request path. save() and delete() only record the
+    latest state per conversation in memory; a writer thread commits everything pending in one transaction once
+    batch_size changes have piled up or flush_interval_seconds have passed. A conversation updated several times
+    between flushes is written once. Nothing is read at startup, conversations are loaded when first asked for.
+    """
+    def __init__(self, path: str, batch_size: int = 256, flush_interval_seconds: float = 1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+
+        # (namespace, conversation_id) -> record or conversation, see get_record, or None for a pending delete
+        self.pending: Dict[Tuple[str, str], object] = {}
+        # namespace -> update_epoch, the rows last updated before it are deleted with the next batch
+        self.pending_expiries: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.wake_writer = threading.Event()
+        self.flushed = threading.Condition(self.lock)
+        self.stopping = False
+        # The batch the writer has taken out of pending but not yet committed
+        self.writing: Dict[Tuple[str, str], object] = {}
+        self.writing_expiries: Dict[str, float] = {}
+        self.num_written = 0
+        self.num_batches = 0
+        self.num_loads = 0
+        self.num_load_hits = 0
+        self.num_write_failures = 0
+
+        self.read_connection = self.connect()
+        self.read_connection.execute("CREATE TABLE IF NOT EXISTS conversations ("
+                                     "namespace TEXT NOT NULL, "
+                                     "conversation_id TEXT NOT NULL, "
+                                     "update_epoch REAL NOT NULL, "
+                                     "data TEXT NOT NULL, "
+                                     "PRIMARY KEY (namespace, conversation_id))")
+        self.read_connection.execute("CREATE INDEX IF NOT EXISTS conversations_by_epoch "
+                                     "ON conversations (namespace, update_epoch)")
+        self.read_connection.commit()
+        self.read_lock = threading.Lock()
+
+        self.writer = threading.Thread(target=self.write_behind, name="conversation-store-writer", daemon=True)
+        self.writer.start()
+
+    @classmethod
+    def from_config(cls, config: Config) -> "SQLiteConversationStore":
+        return cls(path=config.persistence_path, batch_size=config.persistence_batch_size,
+                   flush_interval_seconds=config.persistence_flush_interval_seconds)
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        # WAL lets loads read while the writer commits, and NORMAL only syncs at checkpoints
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def load(self, namespace: str, conversation_id: str) -> Optional[dict]:
+        key = (namespace, conversation_id)
+        unwritten_record = None
+        with self.lock:
+            self.num_loads += 1
+            for unwritten in (self.pending, self.writing):
+                if key in unwritten:
+                    # Not committed yet, so newer than anything in the database
+                    unwritten_record = unwritten[key]
+                    if unwritten_record is None:
+                        return None
+                    self.num_load_hits += 1
+                    break
+        if unwritten_record is not None:
+            # Snapshotted outside the lock, a conversation can take a while
+            return get_record(unwritten_record)
+
+        with self.read_lock:
+            row = self.read_connection.execute(
+                "SELECT data FROM conversations WHERE namespace = ? AND conversation_id = ?", key).fetchone()
+        if row is None:
+            return None
+        with self.lock:
+            self.num_load_hits += 1
+        return json.loads(row[0], object_hook=decode_object)
+
+    def save(self, namespace: str, conversation_id: str, record):
+        self.set_pending((namespace, conversation_id), record)
+
+    def delete(self, namespace: str, conversation_id: str):
+        self.set_pending((namespace, conversation_id), None)
+
+    def set_pending(self, key: Tuple[str, str], record):
+        with self.lock:
+            self.pending[key] = record
+            if len(self.pending) >= self.batch_size:
+                self.wake_writer.set()
+
+    def delete_older_than(self, namespace: str, update_epoch: float):
+        # Run by the writer with its next batch, a second connection writing meanwhile would find the database locked
+        with self.lock:
+            self.pending_expiries[namespace] = max(update_epoch, self.pending_expiries.get(namespace, update_epoch))
+            self.wake_writer.set()
+
+    def write_behind(self):
+        connection = self.connect()
+        while True:
+            self.wake_writer.wait(self.flush_interval_seconds)
+            self.wake_writer.clear()
+            with self.lock:
+                batch, self.pending = self.pending, {}
+                expiries, self.pending_expiries = self.pending_expiries, {}
+                stopping = self.stopping
+                self.writing = batch
+                self.writing_expiries = expiries
+            if batch or expiries:
+                self.write_batch(connection, batch, expiries)
+            with self.lock:
+                self.writing = {}
+                self.writing_expiries = {}
+                self.flushed.notify_all()
+            if stopping:
+                connection.close()
+                return
+
+    def write_batch(self, connection: sqlite3.Connection, batch: Dict[Tuple[str, str], object],
+                    expiries: Optional[Dict[str, float]] = None):
+        expiries = expiries or {}
+        upserts: List[tuple] = []
+        deletes: List[Tuple[str, str]] = []
+        for (namespace, conversation_id), record in batch.items():
+            if record is None:
+                deletes.append((namespace, conversation_id))
+                continue
+            try:
+                record = get_record(record)
+                data = json.dumps(record, default=encode_value, separators=(",", ":"))
+            except Exception as e:
+                logger.error("Failed to serialize conversation %s for %s: %s", conversation_id, namespace, e)
+                with self.lock:
+                    self.num_write_failures += 1
+                continue
+            upserts.append((namespace, conversation_id, record["update_epoch"], data))
+
+        try:
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO conversations "
+                                       "(namespace, conversation_id, update_epoch, data) VALUES (?, ?, ?, ?)",
+                                       upserts)
+                connection.executemany("DELETE FROM conversations WHERE namespace = ? AND conversation_id = ?",
+                                       deletes)
+                connection.executemany("DELETE FROM conversations WHERE namespace = ? AND update_epoch < ?",
+                                       list(expiries.items()))
+        except sqlite3.Error as e:
+            logger.error("Failed to write %d conversations to %s: %s", len(batch), self.path, e)
+            with self.lock:
+                self.num_write_failures += len(batch)
+                # Put the batch back unless newer state has arrived meanwhile, the next flush retries it
+                for key, record in batch.items():
+                    self.pending.setdefault(key, record)
+                for namespace, update_epoch in expiries.items():
+                    self.pending_expiries.setdefault(namespace, update_epoch)
+            return
+
+        with self.lock:
+            self.num_written += len(upserts) + len(deletes)
+            self.num_batches += 1
+
+    def flush(self, timeout_seconds: float = 30):
+        """Block until everything saved so far has been committed."""
+        deadline = time.monotonic() + timeout_seconds
+        with self.lock:
+            while ((self.pending or self.pending_expiries or self.writing or self.writing_expiries)
+                   and self.writer.is_alive()):
+                self.wake_writer.set()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self.flushed.wait(remaining):
+                    break
+
+    def close(self):
+        with self.lock:
+            self.stopping = True
+        self.wake_writer.set()
+        self.writer.join()
+        with self.read_lock:
+            self.read_connection.close()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "written": self.num_written,
+                "batches": self.num_batches,
+                "loads": self.num_loads,
+                "load_hits": self.num_load_hits,
+                "write_failures": self.num_write_failures,
+            }
@@ -1,4 +1,49 @@
-from modules.helpers.prompt_helpers import get_num_tokens_from_string
+from modules.ImageStore import StoredImage
+from modules.TurnStore import Turn, get_shared_turn_store
+from modules.helpers.json_helpers import encode_messages, loads
+from modules.helpers.prompt_helpers import get_num_tokens_from_string, get_num_tokens_from_strings
+from typing import List, Optional, Tuple
+import PIL.Image
+
+# Rough per-dialogue cost of the Python objects around the text (object headers, dicts, lists)
+DIALOGUE_OVERHEAD_BYTES = 256
+# Stands in for an image once it is no longer sent with its turn, so the model still knows there was one
+IMAGE_PLACEHOLDER = "[An image was attached here]"
+
+
+def estimate_size_bytes(value) -> int:
+    """Approximate memory held by a message payload, dominated by its text and image data."""
+    if value is None:
+        return 0
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, dict):
+        return 64 + sum(estimate_size_bytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return 32 + sum(estimate_size_bytes(item) for item in value)
+    if isinstance(value, StoredImage):
+        # Shared with every other dialogue holding the same image, counted in full here all the same
+        return len(value.data)
+    if isinstance(value, PIL.Image.Image):
+        # Decoded images keep their full uncompressed buffer alive
+        return value.width * value.height * len(value.getbands())
+    return 16
+
+def split_usage(input_tokens: Optional[int], output_tokens: Optional[int],
+                prompt_tokens: Optional[int]) -> Tuple[Optional[int], Optional[int]]:
+    """
+    A dialogue's prompt and response tokens from a provider's usage report and prompt_tokens, our count of the new
+    prompt. The reported input also covers the system message, the history and the framing of every message, and the
+    history is only known by our own counts, so taking those off would leave their errors on the new dialogue. The
+    prompt is counted on its own instead, capped at the reported input, and the output, which is the response alone,
+    is taken as reported. None leaves a count to the dialogue's own estimate.
+    """
+    if prompt_tokens is not None and input_tokens is not None:
+        prompt_tokens = max(min(prompt_tokens, input_tokens), 1)
+    return prompt_tokens, output_tokens
+
 
 # class Dialogue:
 #     def __init__(self, prompt_message: dict, response_message: dict, model: str):
@@ -11,25 +56,305 @@ from modules.helpers.prompt_helpers import get_num_tokens_from_string
 #         self.total_num_tokens = self.prompt_num_tokens + self.response_num_tokens
 
 
+def estimate_turn_size_bytes(turn: Turn) -> int:
+    # Shared by the dialogues of every model asked in the turn, counted in full by each all the same
+    return len(turn.text) + len(turn.image_url or "")
+
+
+def parse_legacy_prompt(texts: List[str], images: list) -> Tuple[str, object, bool]:
+    """(text, image, image stripped) of a prompt saved in a provider's message format, before turns were shared."""
+    image_stripped = IMAGE_PLACEHOLDER in texts
+    texts = [text for text in texts if text != IMAGE_PLACEHOLDER]
+    return (texts[0] if texts else ""), (images[0] if images else None), image_stripped
+
+
+def strip_image(dialogue) -> Tuple[int, int]:
+    """Drop a Gemini or Claude dialogue's image for the placeholder, and take the image off its counts."""
+    if dialogue.image is None:
+        return 0, 0
+    removed_bytes = estimate_size_bytes(dialogue.image)
+    dialogue.image = None
+    dialogue.image_stripped = True
+    removed_tokens = min(dialogue.image_num_tokens, dialogue.prompt_num_tokens - 1)
+    dialogue.prompt_num_tokens -= removed_tokens
+    dialogue.total_num_tokens -= removed_tokens
+    dialogue.size_bytes -= removed_bytes
+    return removed_tokens, removed_bytes
+
 
 class OpenAIDialogue:
-    def __init__(self, prompt_message: dict, response_message: dict, model: str):
-        self.prompt_message = prompt_message
-        self.prompt_text = prompt_message["content"][0]["text"].strip()
-        self.response_message = response_message
-        self.response_text = response_message["content"].strip()
-        self.prompt_num_tokens = get_num_tokens_from_string(self.prompt_text, model)
-        self.response_num_tokens = get_num_tokens_from_string(self.response_text, model)
+    """
+    One model's answer to a turn. The turn is shared with the other models asked in the same request. The dialogue's
+    messages are kept JSON encoded, as encoded_messages, which requests splice into their body as is. That is the only
+    copy of the response, it is read back from them when needed.
+    """
+    __slots__ = ("turn", "image_stripped", "prompt_num_tokens", "response_num_tokens", "total_num_tokens",
+                 "encoded_messages", "size_bytes")
+
+    def __init__(self, turn: Turn, response: str, model: str, prompt_num_tokens: Optional[int] = None):
+        self.turn = turn
+        self.image_stripped = False
+        if prompt_num_tokens is None:
+            # Count both sides in one call so the encoding is only looked up once
+            self.prompt_num_tokens, self.response_num_tokens = get_num_tokens_from_strings(
+                [self.prompt_text, response.strip()], model)
+        else:
+            # The client already counted the prompt when trimming, don't encode it twice
+            self.prompt_num_tokens = prompt_num_tokens
+            self.response_num_tokens = get_num_tokens_from_string(response.strip(), model)
         self.total_num_tokens = self.prompt_num_tokens + self.response_num_tokens
+        self.encoded_messages = self.encode(response)
+        self.size_bytes = DIALOGUE_OVERHEAD_BYTES + estimate_turn_size_bytes(turn) + len(self.encoded_messages)
+
+    @staticmethod
+    def render_prompt(turn: Turn, image_stripped: bool = False) -> dict:
+        content = [{"type": "text", "text": turn.text}]
+        if image_stripped:
+            content.append({"type": "text", "text": IMAGE_PLACEHOLDER})
+        elif turn.image_url:
+            content.append({"type": "image_url", "image_url": {"url": turn.image_url}})
+        return {"role": "user", "content": content}
+
+    @staticmethod
+    def render_response(response: str) -> dict:
+        return {"role": "assistant", "content": response}
+
+    @property
+    def prompt_message(self) -> dict:
+        return self.render_prompt(self.turn, self.image_stripped)
+
+    @property
+    def response_message(self) -> dict:
+        return self.render_response(self.response)
+
+    @property
+    def response(self) -> str:
+        return loads(b"[" + self.encoded_messages + b"]")[1]["content"]
+
+    @staticmethod
+    def decode_responses(dialogues) -> List[str]:
+        """The responses of dialogues, decoded together rather than one dialogue at a time."""
+        if not dialogues:
+            return []
+        messages = loads(b"[" + b",".join(dialogue.encoded_messages for dialogue in dialogues) + b"]")
+        return [message["content"] for message in messages[1::2]]
+
+    def encode(self, response: str) -> bytes:
+        return encode_messages([self.prompt_message, self.render_response(response)])
+
+    def to_dict(self, response: Optional[str] = None) -> dict:
+        """response saves decoding it again when the caller already has it, see decode_responses."""
+        return {
+            "text": self.turn.text,
+            "image_url": self.turn.image_url,
+            "image_stripped": self.image_stripped,
+            "response_text": self.response if response is None else response,
+            "prompt_num_tokens": self.prompt_num_tokens,
+            "response_num_tokens": self.response_num_tokens,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict, model: str = None) -> "OpenAIDialogue":
+        if "prompt_message" in data:
+            # Saved as messages, before turns were shared between the models
+            content = data["prompt_message"]["content"]
+            text, image_url, image_stripped = parse_legacy_prompt(
+                [part["text"] for part in content if part["type"] == "text"],
+                [part["image_url"]["url"] for part in content if part["type"] == "image_url"])
+            response = data["response_message"]["content"]
+        else:
+            text, image_url, image_stripped = data["text"], data["image_url"], data["image_stripped"]
+            response = data["response_text"]
+        # The stored token counts are reused, restoring a conversation shouldn't encode it all over again
+        dialogue = cls.__new__(cls)
+        dialogue.turn = get_shared_turn_store().get_turn(text, image_url)
+        dialogue.image_stripped = image_stripped
+        dialogue.prompt_num_tokens = data["prompt_num_tokens"]
+        dialogue.response_num_tokens = data["response_num_tokens"]
+        dialogue.total_num_tokens = dialogue.prompt_num_tokens + dialogue.response_num_tokens
+        dialogue.encoded_messages = dialogue.encode(response)
+        dialogue.size_bytes = (DIALOGUE_OVERHEAD_BYTES + estimate_turn_size_bytes(dialogue.turn)
+                               + len(dialogue.encoded_messages))
+        return dialogue
+
+    def strip_images(self) -> Tuple[int, int]:
+        """
+        Stop sending the prompt's images. Returns the tokens and bytes that frees. OpenAI images were never counted,
+        and the URL stays with the turn the other models share, so only the encoded messages change size.
+        """
+        if not self.turn.image_url or self.image_stripped:
+            return 0, 0
+        response = self.response
+        self.image_stripped = True
+        encoded_messages = self.encode(response)
+        removed_bytes = len(self.encoded_messages) - len(encoded_messages)
+        self.encoded_messages = encoded_messages
+        self.size_bytes -= removed_bytes
+        return 0, removed_bytes
+
+    @property
+    def prompt_text(self) -> str:
+        return self.turn.text.strip()
+
+    @property
+    def response_text(self) -> str:
+        return self.response.strip()
 
 
 class GoogleAIDialogue:
-    def __init__(self, prompt_contents: dict, response_text: str):
-        self.prompt_contents = prompt_contents
-        self.response_text = response_text
+    """One model's answer to a shared turn, see OpenAIDialogue. image is the one Gemini was sent, if any."""
+    __slots__ = ("turn", "image", "image_stripped", "response", "prompt_num_tokens", "response_num_tokens",
+                 "total_num_tokens", "size_bytes")
+    # Gemini bills every image at a flat rate
+    image_num_tokens = 258
+
+    def __init__(self, turn: Turn, response: str, model: str, image=None, prompt_num_tokens: Optional[int] = None,
+                 response_num_tokens: Optional[int] = None):
+        self.turn = turn
+        self.image = image
+        self.image_stripped = False
+        self.response = response
+        # Counts from the provider's usage report when there was one, our own estimates otherwise
+        self.prompt_num_tokens = (prompt_num_tokens if prompt_num_tokens is not None
+                                  else self.estimate_prompt_tokens(turn, image, model))
+        self.response_num_tokens = (response_num_tokens if response_num_tokens is not None
+                                    else get_num_tokens_from_string(response, model))
+        self.total_num_tokens = self.prompt_num_tokens + self.response_num_tokens
+        self.size_bytes = (DIALOGUE_OVERHEAD_BYTES + estimate_turn_size_bytes(turn) + estimate_size_bytes(image)
+                           + len(response))
+
+    @classmethod
+    def estimate_prompt_tokens(cls, turn: Turn, image, model: str) -> int:
+        return get_num_tokens_from_string(turn.text, model) + (cls.image_num_tokens if image is not None else 0)
+
+    @staticmethod
+    def render_prompt(turn: Turn, image=None, image_stripped: bool = False) -> dict:
+        parts = []
+        if image_stripped:
+            parts.append(IMAGE_PLACEHOLDER)
+        elif image is not None:
+            parts.append(image)
+        parts.append(turn.text)
+        return {"role": "user", "parts": parts}
+
+    @property
+    def prompt_contents(self) -> dict:
+        return self.render_prompt(self.turn, self.image, self.image_stripped)
+
+    @property
+    def response_message(self) -> dict:
+        return {"role": "model", "parts": [self.response]}
+
+    def strip_images(self) -> Tuple[int, int]:
+        """Stop sending the prompt's image. Returns the tokens and bytes that frees."""
+        return strip_image(self)
+
+    def to_dict(self) -> dict:
+        return {"text": self.turn.text, "image_url": self.turn.image_url, "image": self.image,
+                "image_stripped": self.image_stripped, "response_text": self.response,
+                "prompt_num_tokens": self.prompt_num_tokens, "response_num_tokens": self.response_num_tokens}
+
+    @classmethod
+    def from_dict(cls, data: dict, model: str = None) -> "GoogleAIDialogue":
+        if "prompt_contents" in data:
+            # Saved as messages, before turns were shared between the models
+            parts = data["prompt_contents"]["parts"]
+            text, image, image_stripped = parse_legacy_prompt([part for part in parts if isinstance(part, str)],
+                                                              [part for part in parts if not isinstance(part, str)])
+            image_url = None
+        else:
+            text, image_url, image, image_stripped = (data["text"], data["image_url"], data["image"],
+                                                      data["image_stripped"])
+        # Dialogues saved before token counts were kept get estimates
+        dialogue = cls(get_shared_turn_store().get_turn(text, image_url), data["response_text"], model, image,
+                       data.get("prompt_num_tokens"), data.get("response_num_tokens"))
+        dialogue.image_stripped = image_stripped
+        return dialogue
+
+    @property
+    def prompt_text(self) -> str:
+        return self.turn.text.strip()
+
+    @property
+    def response_text(self) -> str:
+        return self.response
 
 
 class ClaudeDialogue:
-    def __init__(self, prompt_contents: dict, response_text: str):
-        self.prompt_contents = prompt_contents
-        self.response_text = response_text
\ No newline at end of file
+    """One model's answer to a shared turn, see OpenAIDialogue. image is the one Claude was sent, if any."""
+    __slots__ = ("turn", "image", "image_stripped", "response", "prompt_num_tokens", "response_num_tokens",
+                 "total_num_tokens", "size_bytes")
+    # Claude bills an image by its area, about this much for the largest size it takes without scaling it down
+    image_num_tokens = 1600
+
+    def __init__(self, turn: Turn, response: str, model: str, image=None, prompt_num_tokens: Optional[int] = None,
+                 response_num_tokens: Optional[int] = None):
+        self.turn = turn
+        self.image = image
+        self.image_stripped = False
+        self.response = response
+        self.prompt_num_tokens = (prompt_num_tokens if prompt_num_tokens is not None
+                                  else self.estimate_prompt_tokens(turn, image, model))
+        self.response_num_tokens = (response_num_tokens if response_num_tokens is not None
+                                    else get_num_tokens_from_string(response, model))
+        self.total_num_tokens = self.prompt_num_tokens + self.response_num_tokens
+        self.size_bytes = (DIALOGUE_OVERHEAD_BYTES + estimate_turn_size_bytes(turn) + estimate_size_bytes(image)
+                           + len(response))
+
+    @classmethod
+    def estimate_prompt_tokens(cls, turn: Turn, image, model: str) -> int:
+        # Only the text is encoded, an image's data says nothing about what it costs
+        return get_num_tokens_from_string(turn.text, model) + (cls.image_num_tokens if image is not None else 0)
+
+    @staticmethod
+    def render_prompt(turn: Turn, image=None, image_stripped: bool = False) -> dict:
+        content = []
+        if len(turn.text) > 0:
+            content.append({"type": "text", "text": turn.text})
+        if image_stripped:
+            content.append({"type": "text", "text": IMAGE_PLACEHOLDER})
+        elif image is not None:
+            content.append({"type": "image", "source": image})
+        return {"role": "user", "content": content}
+
+    @property
+    def prompt_contents(self) -> dict:
+        return self.render_prompt(self.turn, self.image, self.image_stripped)
+
+    @property
+    def response_message(self) -> dict:
+        return {"role": "assistant", "content": [{"type": "text", "text": self.response}]}
+
+    def strip_images(self) -> Tuple[int, int]:
+        """Stop sending the prompt's image. Returns the tokens and bytes that frees."""
+        return strip_image(self)
+
+    def to_dict(self) -> dict:
+        return {"text": self.turn.text, "image_url": self.turn.image_url, "image": self.image,
+                "image_stripped": self.image_stripped, "response_text": self.response,
+                "prompt_num_tokens": self.prompt_num_tokens, "response_num_tokens": self.response_num_tokens}
+
+    @classmethod
+    def from_dict(cls, data: dict, model: str = None) -> "ClaudeDialogue":
+        if "prompt_contents" in data:
+            # Saved as messages, before turns were shared between the models
+            content = data["prompt_contents"]["content"]
+            text, image, image_stripped = parse_legacy_prompt(
+                [part["text"] for part in content if part["type"] == "text"],
+                [part["source"] for part in content if part["type"] == "image"])
+            image_url = None
+        else:
+            text, image_url, image, image_stripped = (data["text"], data["image_url"], data["image"],
+                                                      data["image_stripped"])
+        dialogue = cls(get_shared_turn_store().get_turn(text, image_url), data["response_text"], model, image,
+                       data.get("prompt_num_tokens"), data.get("response_num_tokens"))
+        dialogue.image_stripped = image_stripped
+        return dialogue
+
+    @property
+    def prompt_text(self) -> str:
+        return self.turn.text.strip()
+
+    @property
+    def response_text(self) -> str:
+        return self.response
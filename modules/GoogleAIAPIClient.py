@@ -1,17 +1,37 @@
 import google.generativeai as genai
+import requests
+from google.api_core import exceptions as google_exceptions
 import time
+import asyncio
 import logging
-from modules.helpers.network_helpers import get_image_from_url
-from modules.ConversationContainer import GoogleConversationContainer
+from modules.APIClient import ProviderCaller, ProviderError, status_error
+from modules.helpers.network_helpers import get_provider_image_from_url
+from modules.helpers.logging_helper import Truncated
+from modules.ConversationContainer import GoogleConversationContainer, MemoryBudget
+from modules.Compactor import Compactor
+from modules.ConversationStore import ConversationStore
+from modules.Dialogue import GoogleAIDialogue, estimate_size_bytes, split_usage
+from modules.ImageStore import get_shared_image_store, render_google_messages
+from modules.Metrics import get_shared_metrics
+from modules.TurnStore import get_shared_turn_store
 import PIL.Image
+from typing import AsyncIterator, Iterator, Optional
 
 logger = logging.getLogger(__name__)
 
 class GoogleAIAPIClient:
     def __init__(self, api_key: str, model_name: str, conversation_prune_after_seconds: int,
-                 max_dialogues_per_conversation: int, json_response: bool = False):
+                 max_dialogues_per_conversation: int, json_response: bool = False, max_conversations: int = 0,
+                 memory_budget: MemoryBudget = None, sweep_interval_seconds: float = 0,
+                 conversation_store: ConversationStore = None, base_url: str = None,
+                 caller: ProviderCaller = None, max_conversation_tokens: int = 0, compactor: Compactor = None,
+                 image_history_turns: int = None):
         self.api_key = api_key
         self.model_name = model_name
+        # Older dialogues are left out once the prompt and its history would reach this many tokens, 0 sends them all
+        self.max_conversation_tokens = max_conversation_tokens
+        self.base_url = base_url
+        self.caller = caller if caller is not None else ProviderCaller("google", self.classify_error)
 
         # See:
         # https://stackoverflow.com/a/78078401/8151234
@@ -38,56 +58,220 @@ class GoogleAIAPIClient:
 
         self.conversations = GoogleConversationContainer(conversation_prune_after_seconds=conversation_prune_after_seconds,
                                                    max_dialogues_per_conversation=max_dialogues_per_conversation,
-                                                   model=model_name)
+                                                   model=model_name,
+                                                   max_conversations=max_conversations,
+                                                   memory_budget=memory_budget,
+                                                   sweep_interval_seconds=sweep_interval_seconds,
+                                                   store=conversation_store,
+                                                   compactor=compactor,
+                                                   image_history_turns=image_history_turns)
 
-        genai.configure(api_key=api_key)
+        if base_url is None:
+            genai.configure(api_key=api_key)
+        else:
+            # Other endpoints are reached over REST, gRPC only talks to Google
+            genai.configure(api_key=api_key, transport="rest", client_options={"api_endpoint": base_url})
 
         if json_response:
             self.model = genai.GenerativeModel(model_name=model_name,
                                                generation_config={"response_mime_type": "application/json"})
         else:
             self.model = genai.GenerativeModel(model_name=model_name)
-        logger.info(f"Google AI API client initialized with model {model_name}")
+        logger.info("Google AI API client initialized with model %s", model_name)
         return
 
-    def send_prompt(self, prompt: str, image_url: str = None, conversation_id: str = None) -> str:
-        logger.info(f"Sending prompt to Google AI API with model {self.model_name}: '{prompt[:50]}...'")
+    @staticmethod
+    def classify_error(e: Exception) -> Optional[ProviderError]:
+        if isinstance(e, google_exceptions.GoogleAPICallError):
+            if e.code is None:
+                return ProviderError(f"google failed: {e}", "google")
+            return status_error("google", int(e.code), e.message)
+        if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            # Raised by the REST transport
+            return ProviderError(f"Could not reach google: {e!r}", "google", retryable=True)
+        return None
+
+    @staticmethod
+    def get_request_options(timeout: float) -> dict:
+        # The caller does the retrying, the client library's own retries would outlast the call's deadline
+        return {"timeout": timeout, "retry": None}
+
+    def build_messages(self, prompt: str, image_url: str = None, image: tuple = None, conversation_id: str = None):
+        """
+        image is the (bytes, media type) of the image at image_url, prepared for Gemini. Returns the new turn as
+        (turn, stored image), for add_dialogue.
+        """
+        # The same turn as the other models asked this prompt. The image is kept as the stored image, and sent as its
+        # encoded bytes. A PIL image would hold its decoded pixels, and be re-encoded as lossless WebP on every request
+        turn = get_shared_turn_store().get_turn(prompt, image_url)
+        stored_image = get_shared_image_store().intern(*image) if image is not None else None
+        new_user_message = GoogleAIDialogue.render_prompt(turn, stored_image)
 
         conversation = None
         messages = []
-
+        prompt_tokens = None
         if conversation_id is None:
             # No conversation ID, so there is no context to add to the prompt
             pass
         else:
             conversation = self.conversations.get_conversation(conversation_id=conversation_id, model=self.model_name)
+            # The new prompt is counted on its own for its dialogue, see split_usage
+            prompt_tokens = GoogleAIDialogue.estimate_prompt_tokens(turn, stored_image, self.model_name)
+            if self.max_conversation_tokens > 0:
+                conversation.trim(prompt_tokens=prompt_tokens, token_limit=self.max_conversation_tokens)
             previous_messages = conversation.get_messages_for_api()
             # Add the previous prompts and responses to the message list
-            for message in previous_messages:
-                messages.append(message)
+            messages.extend(previous_messages)
+
+        messages.append(new_user_message)
+        messages = render_google_messages(messages)
+        get_shared_metrics().upstream_request_bytes.observe(estimate_size_bytes(messages), self.model_name)
+        return conversation, messages, (turn, stored_image), prompt_tokens
+
+    def handle_response(self, response, conversation, new_turn: tuple, prompt_tokens: Optional[int]) -> str:
+        response_text = response.text
+
+        usage = self.record_usage(response)
+        self.add_dialogue(conversation, new_turn, response_text, usage, prompt_tokens)
+        return response_text
 
-        outbound_parts = []
+    def add_dialogue(self, conversation, new_turn: tuple, response_text: str, usage: tuple, prompt_tokens: Optional[int]):
+        if conversation is not None:
+            prompt_num_tokens, response_num_tokens = split_usage(*usage, prompt_tokens)
+            turn, image = new_turn
+            conversation.add(turn=turn, response_text=response_text, image=image,
+                             prompt_num_tokens=prompt_num_tokens, response_num_tokens=response_num_tokens)
+
+    def record_usage(self, response) -> tuple:
+        """Counts the usage in the metrics and returns it as (prompt tokens, response tokens)."""
+        # Streamed responses report the usage of the whole response on their last chunk
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None:
+            return None, None
+        get_shared_metrics().record_tokens(self.model_name, usage.prompt_token_count,
+                                           usage.candidates_token_count, "usage")
+        # Set when Gemini found the start of the prompt in its implicit cache
+        get_shared_metrics().record_cached_tokens(self.model_name, getattr(usage, "cached_content_token_count", None))
+        return usage.prompt_token_count, usage.candidates_token_count
+
+    def send_prompt(self, prompt: str, image_url: str = None, conversation_id: str = None,
+                    deadline: float = None) -> str:
+        logger.info("Sending prompt to Google AI API with model %s: %s", self.model_name, Truncated(prompt))
+
+        image = None
         if image_url:
-            image = get_image_from_url(image_url)
+            image = get_provider_image_from_url(image_url, "google")
             if image is None:
                 return f"Failed to download image from {image_url}"
-            outbound_parts.append(image)
 
-        outbound_parts.append(prompt)
+        conversation, messages, new_turn, prompt_tokens = self.build_messages(
+            prompt=prompt, image_url=image_url, image=image, conversation_id=conversation_id)
 
-        new_user_message = {'role': 'user',
-                            'parts': outbound_parts}
-        messages.append(new_user_message)
+        response = self.caller.call(lambda timeout: self.model.generate_content(
+            messages, safety_settings=self.safe, request_options=self.get_request_options(timeout)), deadline)
 
-        response = self.model.generate_content(messages, safety_settings=self.safe)
+        return self.handle_response(response, conversation, new_turn, prompt_tokens)
 
-        response_text = response.text
+    async def send_prompt_async(self, prompt: str, image_url: str = None, conversation_id: str = None,
+                                deadline: float = None) -> str:
+        logger.info("Sending async prompt to Google AI API with model %s: %s", self.model_name, Truncated(prompt))
 
-        if conversation is not None:
-            conversation.add(prompt_contents=new_user_message, response_text=response_text)
+        image = None
+        if image_url:
+            # The image helpers are blocking, keep them off the event loop
+            image = await asyncio.to_thread(get_provider_image_from_url, image_url, "google")
+            if image is None:
+                return f"Failed to download image from {image_url}"
 
-        return response_text
+        conversation, messages, new_turn, prompt_tokens = self.build_messages(
+            prompt=prompt, image_url=image_url, image=image, conversation_id=conversation_id)
+
+        if self.base_url is None:
+            response = await self.caller.call_async(lambda timeout: self.model.generate_content_async(
+                messages, safety_settings=self.safe, request_options=self.get_request_options(timeout)), deadline)
+        else:
+            # The REST transport has no async client
+            response = await self.caller.call_async(lambda timeout: asyncio.to_thread(
+                self.model.generate_content, messages, safety_settings=self.safe,
+                request_options=self.get_request_options(timeout)), deadline)
+
+        return self.handle_response(response, conversation, new_turn, prompt_tokens)
+
+    def stream_prompt(self, prompt: str, image_url: str = None, conversation_id: str = None) -> Iterator[str]:
+        """Yield the response text as it arrives. The full text is added to the conversation once it is complete."""
+        logger.info("Streaming prompt to Google AI API with model %s: %s", self.model_name, Truncated(prompt))
+
+        image = None
+        if image_url:
+            image = get_provider_image_from_url(image_url, "google")
+            if image is None:
+                yield f"Failed to download image from {image_url}"
+                return
+
+        conversation, messages, new_turn, prompt_tokens = self.build_messages(
+            prompt=prompt, image_url=image_url, image=image, conversation_id=conversation_id)
+
+        chunks = []
+        usage_reports = []
+        for text in self.caller.stream(lambda timeout: self.stream_text(messages, timeout, usage_reports)):
+            chunks.append(text)
+            yield text
 
+        self.add_dialogue(conversation, new_turn, "".join(chunks),
+                          usage_reports[-1] if usage_reports else (None, None), prompt_tokens)
+
+    async def stream_prompt_async(self, prompt: str, image_url: str = None,
+                                  conversation_id: str = None) -> AsyncIterator[str]:
+        logger.info("Streaming async prompt to Google AI API with model %s: %s", self.model_name, Truncated(prompt))
+
+        image = None
+        if image_url:
+            image = await asyncio.to_thread(get_provider_image_from_url, image_url, "google")
+            if image is None:
+                yield f"Failed to download image from {image_url}"
+                return
+
+        conversation, messages, new_turn, prompt_tokens = self.build_messages(
+            prompt=prompt, image_url=image_url, image=image, conversation_id=conversation_id)
+
+        chunks = []
+        usage_reports = []
+        async for text in self.caller.stream_async(lambda timeout: self.stream_text_async(messages, timeout,
+                                                                                          usage_reports)):
+            chunks.append(text)
+            yield text
+
+        self.add_dialogue(conversation, new_turn, "".join(chunks),
+                          usage_reports[-1] if usage_reports else (None, None), prompt_tokens)
+
+    def stream_text(self, messages: list, timeout: float = None, usage_reports: list = None) -> Iterator[str]:
+        """One attempt at streaming the response. Its usage is appended to usage_reports once it has finished."""
+        chunk = None
+        for chunk in self.model.generate_content(messages, safety_settings=self.safe, stream=True,
+                                                 request_options=self.get_request_options(timeout)):
+            yield chunk.text
+        usage = self.record_usage(chunk)
+        if usage_reports is not None:
+            usage_reports.append(usage)
+
+    async def stream_text_async(self, messages: list, timeout: float = None,
+                                usage_reports: list = None) -> AsyncIterator[str]:
+        chunk = None
+        if self.base_url is None:
+            response = await self.model.generate_content_async(messages, safety_settings=self.safe, stream=True,
+                                                               request_options=self.get_request_options(timeout))
+            async for chunk in response:
+                yield chunk.text
+        else:
+            # The REST transport has no async client, so the chunks arrive together once the thread is done
+            response_chunks = await asyncio.to_thread(
+                lambda: list(self.model.generate_content(messages, safety_settings=self.safe, stream=True,
+                                                         request_options=self.get_request_options(timeout))))
+            for chunk in response_chunks:
+                yield chunk.text
+        usage = self.record_usage(chunk)
+        if usage_reports is not None:
+            usage_reports.append(usage)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -101,17 +285,17 @@ if __name__ == "__main__":
                                           max_dialogues_per_conversation=config.openai_max_dialogues_per_conversation)
 
     #response = google_api_client.send_prompt(prompt="Describe the image", image_url="https://agentlegoodbye.com/wp-content/uploads/photo-gallery/thumb/Purrito-4.jpg")
-    #logger.info(f"Got response: {response}")
+    #logger.info("Got response: %s", response)
 
     response = google_api_client.send_prompt(prompt="What is the capital of France?", conversation_id="test")
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
     response = google_api_client.send_prompt(prompt="And Germany?", conversation_id="test")
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
     response = google_api_client.send_prompt(prompt="How about Spain?", conversation_id="test")
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
     response = google_api_client.send_prompt(prompt="Describe the image in 1 sentence without describing the thing the cat is lying on.",
                                              image_url="https://agentlegoodbye.com/wp-content/uploads/photo-gallery/thumb/Purrito-4.jpg",
                                              conversation_id="test")
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
     response = google_api_client.send_prompt(prompt="Now tell me the color of the thing the cat is lying on", conversation_id="test")
-    logger.info(f"Got response: {response}")
\ No newline at end of file
+    logger.info("Got response: %s", response)
\ No newline at end of file
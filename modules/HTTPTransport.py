@@ -0,0 +1,177 @@
+import threading
+import httpx
+from contextlib import contextmanager, asynccontextmanager
+from typing import Optional, Iterator, AsyncIterator
+from modules.Config import Config
+from modules.helpers.logging_helper import logger
+
+
+class HTTPTransport:
+    """
+    Pooled HTTP transport shared by every client that talks HTTP directly (the OpenAI client and the image helpers).
+    Connections are kept alive between requests, and every request gets connect/read deadlines, so a stalled
+    upstream can no longer hold a worker forever.
+    """
+    def __init__(self, pool_size: int = 20, keepalive_expiry_seconds: float = 30.0, http2: bool = False,
+                 connect_timeout_seconds: float = 5.0, read_timeout_seconds: float = 120.0):
+        self.pool_size = pool_size
+        self.limits = httpx.Limits(max_connections=pool_size,
+                                   max_keepalive_connections=pool_size,
+                                   keepalive_expiry=keepalive_expiry_seconds)
+        self.timeout = httpx.Timeout(connect=connect_timeout_seconds,
+                                     read=read_timeout_seconds,
+                                     write=read_timeout_seconds,
+                                     pool=connect_timeout_seconds)
+
+        self.http2 = http2
+        if self.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("HTTP/2 was requested but the 'h2' package is not installed, falling back to HTTP/1.1")
+                self.http2 = False
+
+        self.client = httpx.Client(limits=self.limits, timeout=self.timeout, http2=self.http2)
+        # Created lazily so it binds to the event loop that is actually serving requests
+        self.async_client: Optional[httpx.AsyncClient] = None
+
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_connections_opened = 0
+        self.num_failures = 0
+        self.in_flight = 0
+
+    @classmethod
+    def from_config(cls, config: Config) -> "HTTPTransport":
+        return cls(pool_size=config.http_pool_size,
+                   keepalive_expiry_seconds=config.http_keepalive_expiry_seconds,
+                   http2=config.http2_enabled,
+                   connect_timeout_seconds=config.http_connect_timeout_seconds,
+                   read_timeout_seconds=config.http_read_timeout_seconds)
+
+    def get_timeout(self, seconds: Optional[float]) -> httpx.Timeout:
+        """The configured timeouts, each cut down to the time left before a call's deadline."""
+        if seconds is None:
+            return self.timeout
+        return httpx.Timeout(connect=min(self.timeout.connect, seconds), read=min(self.timeout.read, seconds),
+                             write=min(self.timeout.write, seconds), pool=min(self.timeout.pool, seconds))
+
+    def trace(self, event_name: str, info: dict):
+        # httpcore emits this event only when it has to open a new connection rather than reuse a pooled one
+        if event_name == "connection.connect_tcp.started":
+            with self.lock:
+                self.num_connections_opened += 1
+
+    async def trace_async(self, event_name: str, info: dict):
+        self.trace(event_name, info)
+
+    def begin_request(self):
+        with self.lock:
+            self.num_requests += 1
+            self.in_flight += 1
+
+    def end_request(self, failed: bool):
+        with self.lock:
+            self.in_flight -= 1
+            if failed:
+                self.num_failures += 1
+
+    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        self.begin_request()
+        failed = True
+        try:
+            response = self.client.request(method, url, extensions={"trace": self.trace}, **kwargs)
+            failed = False
+            return response
+        finally:
+            self.end_request(failed)
+
+    async def request_async(self, method: str, url: str, **kwargs) -> httpx.Response:
+        if self.async_client is None:
+            self.async_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+        self.begin_request()
+        failed = True
+        try:
+            response = await self.async_client.request(method, url, extensions={"trace": self.trace_async}, **kwargs)
+            failed = False
+            return response
+        finally:
+            self.end_request(failed)
+
+    @contextmanager
+    def stream(self, method: str, url: str, **kwargs) -> Iterator[httpx.Response]:
+        self.begin_request()
+        failed = True
+        try:
+            with self.client.stream(method, url, extensions={"trace": self.trace}, **kwargs) as response:
+                yield response
+            failed = False
+        finally:
+            self.end_request(failed)
+
+    @asynccontextmanager
+    async def stream_async(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        if self.async_client is None:
+            self.async_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+        self.begin_request()
+        failed = True
+        try:
+            async with self.async_client.stream(method, url, extensions={"trace": self.trace_async},
+                                                **kwargs) as response:
+                yield response
+            failed = False
+        finally:
+            self.end_request(failed)
+
+    def get(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("POST", url, **kwargs)
+
+    async def get_async(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request_async("GET", url, **kwargs)
+
+    async def post_async(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request_async("POST", url, **kwargs)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            num_requests = self.num_requests
+            num_connections_opened = self.num_connections_opened
+            in_flight = self.in_flight
+            num_failures = self.num_failures
+        reused = max(num_requests - num_connections_opened, 0)
+        return {
+            "pool_size": self.pool_size,
+            "http2": self.http2,
+            "requests": num_requests,
+            "failures": num_failures,
+            "connections_opened": num_connections_opened,
+            "reused_requests": reused,
+            "reuse_ratio": reused / num_requests if num_requests > 0 else 0.0,
+            # Over HTTP/1.1 every in-flight request holds exactly one pooled connection
+            "in_use_connections": in_flight,
+        }
+
+    def close(self):
+        self.client.close()
+
+
+shared_transport: Optional[HTTPTransport] = None
+shared_transport_lock = threading.Lock()
+
+
+def get_shared_transport() -> HTTPTransport:
+    global shared_transport
+    if shared_transport is None:
+        with shared_transport_lock:
+            if shared_transport is None:
+                shared_transport = HTTPTransport()
+    return shared_transport
+
+
+def set_shared_transport(transport: HTTPTransport):
+    global shared_transport
+    with shared_transport_lock:
+        shared_transport = transport
@@ -0,0 +1,157 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+from modules.Config import Config
+from modules.Metrics import get_shared_metrics
+from modules.SingleFlight import SingleFlight
+
+
+class ImageCache:
+    """
+    Downloaded images, keyed by URL and stored by content hash. URL entries expire after ttl_seconds, image bytes are
+    evicted least recently used first once max_bytes is exceeded, and identical content behind different URLs is
+    stored once. Concurrent requests for the same URL share a single in-flight download.
+
+    Variants of an image (the same image prepared for a provider) are stored next to it, keyed by its content hash
+    and the variant's name, and count against the same max_bytes.
+    """
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl_seconds: float = 600, max_urls: int = 4096):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_urls = max_urls
+        # url -> (content hash, expiry epoch)
+        self.urls: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        # content hash, or "content hash:variant", -> image bytes
+        self.blobs: OrderedDict[str, bytes] = OrderedDict()
+        # Concurrent downloads of the same URL are collapsed into one, as are builds of the same variant
+        self.downloads = SingleFlight()
+        self.variant_builds = SingleFlight()
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.variant_hits = 0
+        self.variant_misses = 0
+
+    @classmethod
+    def from_config(cls, config: Config) -> "ImageCache":
+        return cls(max_bytes=config.image_cache_max_bytes, ttl_seconds=config.image_cache_ttl_seconds)
+
+    def lookup(self, url: str, now: float) -> Optional[Tuple[str, bytes]]:
+        entry = self.urls.get(url)
+        if entry is None:
+            return None
+        content_hash, expires_at = entry
+        data = self.blobs.get(content_hash)
+        if expires_at < now or data is None:
+            del self.urls[url]
+            return None
+        self.urls.move_to_end(url)
+        self.blobs.move_to_end(content_hash)
+        return content_hash, data
+
+    def store(self, url: str, data: bytes) -> Tuple[str, bytes]:
+        content_hash = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            existing = self.blobs.get(content_hash)
+            if existing is None:
+                self.blobs[content_hash] = data
+                self.total_bytes += len(data)
+            else:
+                # Same content behind another URL, keep the copy we already have
+                data = existing
+                self.blobs.move_to_end(content_hash)
+            self.urls[url] = (content_hash, time.time() + self.ttl_seconds)
+            self.urls.move_to_end(url)
+
+            while len(self.urls) > self.max_urls:
+                self.urls.popitem(last=False)
+            self.evict()
+        return content_hash, data
+
+    def evict(self):
+        # The image just stored is never evicted, even when it alone is larger than the cache
+        while self.total_bytes > self.max_bytes and len(self.blobs) > 1:
+            _, evicted = self.blobs.popitem(last=False)
+            self.total_bytes -= len(evicted)
+            self.evictions += 1
+
+    def get(self, url: str, fetch: Callable[[str], bytes]) -> Tuple[str, bytes]:
+        """
+        Return (content hash, bytes) for the image at url, calling fetch(url) only if no other thread already is.
+        Exceptions raised by fetch are raised in every thread waiting on that download.
+        """
+        with self.lock:
+            cached = self.lookup(url, time.time())
+            if cached is not None:
+                self.hits += 1
+                return cached
+            self.misses += 1
+
+        return self.downloads.do(url, lambda: self.store(url, self.timed_fetch(url, fetch)))
+
+    def get_variant(self, content_hash: str, variant: str, make: Callable[[], bytes]) -> bytes:
+        """
+        Return the variant of the image with content_hash, calling make() to build it only if it isn't stored and no
+        other thread is already building it.
+        """
+        key = f"{content_hash}:{variant}"
+        with self.lock:
+            data = self.blobs.get(key)
+            if data is not None:
+                self.blobs.move_to_end(key)
+                self.variant_hits += 1
+                return data
+            self.variant_misses += 1
+
+        return self.variant_builds.do(key, lambda: self.store_variant(key, make()))
+
+    def store_variant(self, key: str, data: bytes) -> bytes:
+        with self.lock:
+            if key not in self.blobs:
+                self.blobs[key] = data
+                self.total_bytes += len(data)
+            self.evict()
+        return data
+
+    def timed_fetch(self, url: str, fetch: Callable[[str], bytes]) -> bytes:
+        start = time.monotonic()
+        data = fetch(url)
+        get_shared_metrics().image_fetch.observe(time.monotonic() - start)
+        return data
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "urls": len(self.urls),
+                "images": len(self.blobs),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.downloads.get_stats()["collapsed"],
+                "evictions": self.evictions,
+                "variant_hits": self.variant_hits,
+                "variant_misses": self.variant_misses,
+            }
+
+
+shared_image_cache: Optional[ImageCache] = None
+shared_image_cache_lock = threading.Lock()
+
+
+def get_shared_image_cache() -> ImageCache:
+    global shared_image_cache
+    if shared_image_cache is None:
+        with shared_image_cache_lock:
+            if shared_image_cache is None:
+                shared_image_cache = ImageCache()
+    return shared_image_cache
+
+
+def set_shared_image_cache(image_cache: ImageCache):
+    global shared_image_cache
+    with shared_image_cache_lock:
+        shared_image_cache = image_cache
@@ -0,0 +1,169 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+from PIL import Image
+from modules.Config import Config
+from modules.helpers.logging_helper import logger
+
+MEDIA_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "GIF": "image/gif", "WEBP": "image/webp"}
+# The formats each provider takes as they are, anything else is converted. Gemini rejects GIFs
+PROVIDER_IMAGE_FORMATS = {
+    "claude": ("JPEG", "PNG", "GIF", "WEBP"),
+    "google": ("JPEG", "PNG", "WEBP"),
+}
+# Lower qualities are only tried while the image is still larger than its byte limit
+JPEG_QUALITIES = (85, 75, 60, 45)
+
+
+def sniff_image_format(data: bytes) -> Optional[str]:
+    """Identify an image from its magic bytes, using PIL's format names."""
+    if data.startswith(b"\xff\xd8\xff"):
+        return "JPEG"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "PNG"
+    if data.startswith(b"GIF87a") or data.startswith(b"GIF89a"):
+        return "GIF"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def get_media_type(data: bytes) -> str:
+    return MEDIA_TYPES[sniff_image_format(data)]
+
+
+def encode(image: Image.Image, image_format: str, **options) -> bytes:
+    buffered = BytesIO()
+    image.save(buffered, format=image_format, **options)
+    return buffered.getvalue()
+
+
+def needs_processing(data: bytes, max_edge: int, max_bytes: int, formats: Tuple[str, ...]) -> bool:
+    """Whether the image is too large, or in a format other than formats. Raises if PIL can't read it."""
+    if sniff_image_format(data) not in formats or len(data) > max_bytes:
+        return True
+    # Opening only reads the header, so this stays cheap enough for the request threads
+    return max(Image.open(BytesIO(data)).size) > max_edge
+
+
+def process_image(data: bytes, max_edge: int, max_bytes: int) -> bytes:
+    """
+    The image scaled down to at most max_edge pixels on its longer side, and re-encoded as a PNG or JPEG (which every
+    provider takes) until it is at most max_bytes long. Runs in the pool's processes, so it only takes and returns
+    bytes.
+    """
+    image = Image.open(BytesIO(data))
+    # Animations are sent as their first frame, which is where opening leaves them
+    if max(image.size) > max_edge:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    if has_alpha:
+        encoded = encode(image.convert("RGBA"), "PNG", optimize=True)
+        if len(encoded) <= max_bytes:
+            return encoded
+        # Too large as a PNG, flatten it onto white so it can become a JPEG
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image.convert("RGBA"), mask=image.convert("RGBA").getchannel("A"))
+        image = background
+
+    image = image.convert("RGB")
+    while True:
+        for quality in JPEG_QUALITIES:
+            encoded = encode(image, "JPEG", quality=quality, optimize=True)
+            if len(encoded) <= max_bytes:
+                return encoded
+        if max(image.size) <= 64:
+            return encoded
+        # Even the lowest quality is too large, halve the size and start over
+        image = image.resize((max(image.width // 2, 1), max(image.height // 2, 1)), Image.LANCZOS)
+
+
+class ImageProcessor:
+    """
+    Prepares downloaded images for each provider: scaled down to the provider's largest useful size, and
+    recompressed to its byte limit. The decoding, scaling and encoding run in a pool of processes, so they don't
+    hold the GIL the request threads need. Without a pool (num_processes 0, or inside a worker process, which
+    can't start processes of its own) they run on the calling thread.
+
+    limits maps a provider name to its (max_edge, max_bytes), formats to the image formats it takes as they are
+    (PROVIDER_IMAGE_FORMATS by default).
+    """
+    def __init__(self, limits: Dict[str, Tuple[int, int]], num_processes: int = 0,
+                 formats: Optional[Dict[str, Tuple[str, ...]]] = None):
+        self.limits = limits
+        self.formats = formats if formats is not None else PROVIDER_IMAGE_FORMATS
+        self.pool = None
+        if num_processes > 0:
+            if multiprocessing.current_process().daemon:
+                logger.info("Processing images on the request threads, worker processes can't start a pool")
+            else:
+                self.pool = ProcessPoolExecutor(max_workers=num_processes,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        self.num_processed = 0
+        self.num_passed_through = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Config) -> "ImageProcessor":
+        return cls(limits={
+            "claude": (config.claude_image_max_edge, config.claude_image_max_bytes),
+            "google": (config.google_image_max_edge, config.google_image_max_bytes),
+        }, num_processes=config.image_processing_processes)
+
+    def process(self, data: bytes, provider: str) -> bytes:
+        """The image prepared for provider. Raises if the bytes aren't an image PIL can read."""
+        max_edge, max_bytes = self.limits[provider]
+        if not needs_processing(data, max_edge, max_bytes, self.formats.get(provider, ("JPEG", "PNG"))):
+            processed = data
+        elif self.pool is not None:
+            processed = self.pool.submit(process_image, data, max_edge, max_bytes).result()
+        else:
+            processed = process_image(data, max_edge, max_bytes)
+        with self.lock:
+            if processed is data:
+                self.num_passed_through += 1
+            else:
+                self.num_processed += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(processed)
+        return processed
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "processes": self.pool._max_workers if self.pool is not None else 0,
+                "processed": self.num_processed,
+                "passed_through": self.num_passed_through,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
+
+
+shared_image_processor: Optional[ImageProcessor] = None
+shared_image_processor_lock = threading.Lock()
+
+
+def get_shared_image_processor() -> ImageProcessor:
+    global shared_image_processor
+    if shared_image_processor is None:
+        with shared_image_processor_lock:
+            if shared_image_processor is None:
+                shared_image_processor = ImageProcessor(limits={"claude": (1568, 1024 * 1024),
+                                                                "google": (1536, 1024 * 1024)})
+    return shared_image_processor
+
+
+def set_shared_image_processor(image_processor: ImageProcessor):
+    global shared_image_processor
+    with shared_image_processor_lock:
+        previous, shared_image_processor = shared_image_processor, image_processor
+    if previous is not None and previous is not image_processor:
+        previous.close()
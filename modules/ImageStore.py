@@ -0,0 +1,108 @@
+import base64
+import hashlib
+import threading
+import weakref
+from typing import List, Optional
+
+
+class StoredImage:
+    """
+    An image in conversation history: its encoded bytes and media type. Dialogues hold these in place of the
+    provider's form of the image, which is only rendered while a request is built.
+    """
+    __slots__ = ("data", "media_type", "content_hash", "__weakref__")
+
+    def __init__(self, data: bytes, media_type: str, content_hash: str):
+        self.data = data
+        self.media_type = media_type
+        self.content_hash = content_hash
+
+
+class ImageStore:
+    """
+    The images held by conversations, stored once each by content hash. The store only keeps weak references, so
+    an image is reference counted by the dialogues holding it and freed with the last of them, however it was let go
+    (eviction, pruning, stripping).
+    """
+    def __init__(self):
+        self.images: "weakref.WeakValueDictionary[str, StoredImage]" = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+        self.num_stored = 0
+        self.num_shared = 0
+
+    def intern(self, data: bytes, media_type: str) -> StoredImage:
+        """The stored image with data's content, stored now if no dialogue holds it yet."""
+        content_hash = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            image = self.images.get(content_hash)
+            if image is not None:
+                self.num_shared += 1
+                return image
+            image = self.images[content_hash] = StoredImage(data, media_type, content_hash)
+            self.num_stored += 1
+            return image
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            images = list(self.images.values())
+            return {
+                "images": len(images),
+                "bytes": sum(len(image.data) for image in images),
+                "stored": self.num_stored,
+                "shared": self.num_shared,
+            }
+
+
+def render_claude_messages(messages: List[dict]) -> List[dict]:
+    """
+    The messages with each stored image rendered as a base64 image source. Messages without one are shared, not
+    copied, and the base64 text only lives as long as the request.
+    """
+    rendered = []
+    for message in messages:
+        content = message["content"]
+        if any(isinstance(part.get("source"), StoredImage) for part in content):
+            content = [render_claude_part(part) for part in content]
+            message = {**message, "content": content}
+        rendered.append(message)
+    return rendered
+
+
+def render_claude_part(part: dict) -> dict:
+    image = part.get("source")
+    if not isinstance(image, StoredImage):
+        return part
+    return {**part, "source": {"type": "base64", "media_type": image.media_type,
+                               "data": base64.b64encode(image.data).decode("ascii")}}
+
+
+def render_google_messages(messages: List[dict]) -> List[dict]:
+    """The messages with each stored image rendered as an inline blob, which shares the stored bytes."""
+    rendered = []
+    for message in messages:
+        parts = message["parts"]
+        if any(isinstance(part, StoredImage) for part in parts):
+            parts = [{"mime_type": part.media_type, "data": part.data} if isinstance(part, StoredImage) else part
+                     for part in parts]
+            message = {**message, "parts": parts}
+        rendered.append(message)
+    return rendered
+
+
+shared_image_store: Optional[ImageStore] = None
+shared_image_store_lock = threading.Lock()
+
+
+def get_shared_image_store() -> ImageStore:
+    global shared_image_store
+    if shared_image_store is None:
+        with shared_image_store_lock:
+            if shared_image_store is None:
+                shared_image_store = ImageStore()
+    return shared_image_store
+
+
+def set_shared_image_store(image_store: ImageStore):
+    global shared_image_store
+    with shared_image_store_lock:
+        shared_image_store = image_store
@@ -0,0 +1,55 @@
+import threading
+from collections import deque
+from typing import Dict, Optional
+
+
+class LatencyWindow:
+    """The most recent latencies of one kind of call, for percentiles over a sliding window."""
+    def __init__(self, max_samples: int = 512):
+        self.samples = deque(maxlen=max_samples)
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def percentile(self, percent: float, min_samples: int = 1) -> Optional[float]:
+        """Nearest-rank percentile in seconds, or None until min_samples latencies have been recorded."""
+        with self.lock:
+            samples = sorted(self.samples)
+        if len(samples) < max(min_samples, 1):
+            return None
+        index = min(int(len(samples) * percent / 100), len(samples) - 1)
+        return samples[index]
+
+    def get_stats(self) -> dict:
+        stats = {"count": self.count}
+        for percent in (50, 95, 99):
+            value = self.percentile(percent)
+            stats[f"p{percent}_ms"] = round(value * 1000, 1) if value is not None else None
+        return stats
+
+
+class LatencyRegistry:
+    """A LatencyWindow per name, created on first use."""
+    def __init__(self, max_samples: int = 512):
+        self.max_samples = max_samples
+        self.windows: Dict[str, LatencyWindow] = {}
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> LatencyWindow:
+        window = self.windows.get(name)
+        if window is None:
+            with self.lock:
+                window = self.windows.setdefault(name, LatencyWindow(self.max_samples))
+        return window
+
+    def record(self, name: str, seconds: float):
+        self.get(name).record(seconds)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            windows = dict(self.windows)
+        return {name: window.get_stats() for name, window in windows.items()}
@@ -0,0 +1,249 @@
+import bisect
+import math
+import threading
+from collections import namedtuple
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# One metric and its samples, keyed by label values. Plain tuples so worker processes can send them to the front end
+MetricFamily = namedtuple("MetricFamily", ["name", "type", "help", "label_names", "samples"])
+# Per bucket (not cumulative) counts with a final +Inf bucket, the sum and the count of one histogram
+HistogramSample = namedtuple("HistogramSample", ["bucket_counts", "sum", "count"])
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+IMAGE_FETCH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+REQUEST_BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Value:
+    """A number behind its own lock, so updates to different label sets never contend."""
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, amount: float):
+        with self.lock:
+            self.value += amount
+
+
+class HistogramValue:
+    __slots__ = ("buckets", "bucket_counts", "sum", "count", "lock")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.bucket_counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Metric:
+    """
+    A metric with one child per set of label values. Children are created under the metric's lock once, after that
+    recording only takes the child's own lock.
+    """
+    type = None
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def new_child(self):
+        return Value()
+
+    def child(self, label_values: tuple):
+        child = self.children.get(label_values)
+        if child is None:
+            if len(label_values) != len(self.label_names):
+                raise ValueError(f"{self.name} takes labels {self.label_names}, got {label_values}")
+            with self.lock:
+                child = self.children.setdefault(label_values, self.new_child())
+        return child
+
+    def collect(self) -> MetricFamily:
+        with self.lock:
+            children = dict(self.children)
+        return MetricFamily(self.name, self.type, self.help, self.label_names,
+                            {labels: child.value for labels, child in children.items()})
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.child(label_values).add(amount)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.child(label_values).add(amount)
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self.child(label_values).add(-amount)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float, *label_values: str):
+        self.child(label_values).observe(value)
+
+    def collect(self) -> MetricFamily:
+        with self.lock:
+            children = dict(self.children)
+        samples = {}
+        for labels, child in children.items():
+            with child.lock:
+                samples[labels] = HistogramSample(tuple(child.bucket_counts), child.sum, child.count)
+        return MetricFamily(self.name, self.type, self.help, self.label_names, samples)
+
+
+class Metrics:
+    """
+    The Prometheus metrics recorded in this process. Values that already live elsewhere (conversation counts, rate
+    limiter totals, queue depths) aren't duplicated here, the server reads them at scrape time instead.
+    """
+    def __init__(self):
+        self.upstream_latency = Histogram("neosgpt_upstream_latency_seconds",
+                                          "Latency of successful upstream model calls", ["model"])
+        self.upstream_errors = Counter("neosgpt_upstream_errors_total",
+                                       "Failed upstream model calls by exception type", ["model", "type"])
+        self.prompt_tokens = Counter("neosgpt_prompt_tokens_total",
+                                     "Prompt tokens sent, from the provider's usage report when it has one and "
+                                     "from our own count otherwise", ["model", "source"])
+        self.response_tokens = Counter("neosgpt_response_tokens_total",
+                                       "Response tokens received, from the provider's usage report when it has one "
+                                       "and from our own count otherwise", ["model", "source"])
+        self.cached_prompt_tokens = Counter("neosgpt_cached_prompt_tokens_total",
+                                            "Prompt tokens read from the provider's prompt cache, or written to it, "
+                                            "from the provider's usage report", ["model", "operation"])
+        self.upstream_request_bytes = Histogram("neosgpt_upstream_request_bytes",
+                                                "Size of the requests sent to the models, estimated from the messages "
+                                                "for Gemini and Claude", ["model"], buckets=REQUEST_BYTES_BUCKETS)
+        self.image_fetch = Histogram("neosgpt_image_fetch_seconds", "Time to download an image that was not cached",
+                                     buckets=IMAGE_FETCH_BUCKETS)
+        self.requests_in_flight = Gauge("neosgpt_requests_in_flight", "Prompt requests being handled")
+        self.upstream_in_flight = Gauge("neosgpt_upstream_in_flight", "Upstream model calls waiting on a response")
+        self.metrics: List[Metric] = [self.upstream_latency, self.upstream_errors, self.prompt_tokens,
+                                      self.response_tokens, self.cached_prompt_tokens, self.upstream_request_bytes,
+                                      self.image_fetch, self.requests_in_flight, self.upstream_in_flight]
+        self.histogram_buckets = {metric.name: metric.buckets for metric in self.metrics
+                                  if isinstance(metric, Histogram)}
+
+    def record_tokens(self, model: str, prompt_tokens: Optional[int], response_tokens: Optional[int], source: str):
+        if prompt_tokens:
+            self.prompt_tokens.inc(model, source, amount=prompt_tokens)
+        if response_tokens:
+            self.response_tokens.inc(model, source, amount=response_tokens)
+
+    def record_cached_tokens(self, model: str, read_tokens: Optional[int], written_tokens: Optional[int] = None):
+        """Cached tokens are part of the prompt tokens, not in addition to them."""
+        if read_tokens:
+            self.cached_prompt_tokens.inc(model, "read", amount=read_tokens)
+        if written_tokens:
+            self.cached_prompt_tokens.inc(model, "write", amount=written_tokens)
+
+    def collect(self) -> List[MetricFamily]:
+        return [metric.collect() for metric in self.metrics]
+
+    def render(self, families: Iterable[MetricFamily]) -> str:
+        """Prometheus text exposition format 0.0.4."""
+        lines = []
+        for family in families:
+            lines.append(f"# HELP {family.name} {escape_help(family.help)}")
+            lines.append(f"# TYPE {family.name} {family.type}")
+            for label_values, sample in sorted(family.samples.items()):
+                labels = list(zip(family.label_names, label_values))
+                if family.type != "histogram":
+                    lines.append(f"{family.name}{format_labels(labels)} {format_value(sample)}")
+                    continue
+                cumulative = 0
+                bounds = [format_value(bound) for bound in self.histogram_buckets[family.name]] + ["+Inf"]
+                for bound, bucket_count in zip(bounds, sample.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{family.name}_bucket{format_labels(labels + [('le', bound)])} {cumulative}")
+                lines.append(f"{family.name}_sum{format_labels(labels)} {format_value(sample.sum)}")
+                lines.append(f"{family.name}_count{format_labels(labels)} {sample.count}")
+        return "\n".join(lines) + "\n"
+
+
+def merge_families(family_lists: Iterable[List[MetricFamily]]) -> List[MetricFamily]:
+    """Sum the same metrics collected in several processes, label set by label set."""
+    merged: Dict[str, MetricFamily] = {}
+    for families in family_lists:
+        for family in families:
+            existing = merged.get(family.name)
+            if existing is None:
+                merged[family.name] = family._replace(samples=dict(family.samples))
+                continue
+            for labels, sample in family.samples.items():
+                previous = existing.samples.get(labels)
+                if previous is None:
+                    existing.samples[labels] = sample
+                elif family.type == "histogram":
+                    existing.samples[labels] = HistogramSample(
+                        tuple(a + b for a, b in zip(previous.bucket_counts, sample.bucket_counts)),
+                        previous.sum + sample.sum, previous.count + sample.count)
+                else:
+                    existing.samples[labels] = previous + sample
+    return list(merged.values())
+
+
+def escape_help(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("\n", "\\n")
+
+
+def format_labels(labels: List[Tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if value.is_integer():
+            return str(int(value))
+    return repr(value)
+
+
+shared_metrics: Optional[Metrics] = None
+shared_metrics_lock = threading.Lock()
+
+
+def get_shared_metrics() -> Metrics:
+    global shared_metrics
+    if shared_metrics is None:
+        with shared_metrics_lock:
+            if shared_metrics is None:
+                shared_metrics = Metrics()
+    return shared_metrics
+
+
+def set_shared_metrics(metrics: Metrics):
+    global shared_metrics
+    with shared_metrics_lock:
+        shared_metrics = metrics
@@ -0,0 +1,94 @@
+from typing import Iterator, Optional
+from modules.OpenAIAPIClient import OpenAIAPIClient
+from modules.GoogleAIAPIClient import GoogleAIAPIClient
+from modules.ClaudeAPIClient import ClaudeAPIClient
+from modules.Config import Config
+
+
+class ModelRouter:
+    """Sends a prompt for a model name to the client serving that model."""
+    def __init__(self, openai_api_client: OpenAIAPIClient,
+                 google_ai_api_client: GoogleAIAPIClient,
+                 claude_api_client: ClaudeAPIClient,
+                 config: Config):
+        self.config = config
+        self.openai_api_client = openai_api_client
+        self.google_ai_api_client = google_ai_api_client
+        self.claude_api_client = claude_api_client
+        # Shared by all three containers, like the store
+        self.compactor = openai_api_client.conversations.compactor
+        if self.compactor is not None:
+            self.compactor.start(self.send_summary_prompt)
+
+    def get_provider(self, model: str) -> Optional[str]:
+        """The provider whose conversation container holds model's branch of a conversation, None if none serves it."""
+        if model == self.config.google_model:
+            return "google"
+        elif model == self.config.claude_model:
+            return "claude"
+        elif model in self.config.openai_models:
+            return "openai"
+        return None
+
+    def send_prompt(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                    deadline: Optional[float] = None) -> str:
+        """deadline is the time.monotonic() by which the request needs the answer, if it has a budget."""
+        if model == self.config.google_model:
+            return self.google_ai_api_client.send_prompt(
+                prompt=text, image_url=image_url, conversation_id=conversation_id, deadline=deadline
+            )
+        elif model == self.config.claude_model:
+            return self.claude_api_client.send_prompt(
+                prompt=text, image_url=image_url, conversation_id=conversation_id, deadline=deadline
+            )
+        elif model in self.config.openai_models:
+            return self.openai_api_client.send_prompt(
+                prompt=text, image_url=image_url, conversation_id=conversation_id, model=model, deadline=deadline
+            )
+        raise ValueError(f"Invalid model: {model}")
+
+    def send_summary_prompt(self, text: str) -> str:
+        return self.send_prompt(self.compactor.model, text, image_url=None, conversation_id=None)
+
+    def stream_prompt(self, model: str, text: str, image_url: str, conversation_id: Optional[str]) -> Iterator[str]:
+        if model == self.config.google_model:
+            return self.google_ai_api_client.stream_prompt(
+                prompt=text, image_url=image_url, conversation_id=conversation_id
+            )
+        elif model == self.config.claude_model:
+            return self.claude_api_client.stream_prompt(
+                prompt=text, image_url=image_url, conversation_id=conversation_id
+            )
+        elif model in self.config.openai_models:
+            return self.openai_api_client.stream_prompt(
+                prompt=text, image_url=image_url, conversation_id=conversation_id, model=model
+            )
+        return iter([f"Invalid model: {model}"])
+
+    def get_stats(self) -> dict:
+        return {
+            "openai": self.openai_api_client.conversations.get_stats(),
+            "google": self.google_ai_api_client.conversations.get_stats(),
+            "claude": self.claude_api_client.conversations.get_stats(),
+        }
+
+    def get_upstream_stats(self) -> dict:
+        """Retries and circuit breaker state per provider."""
+        return {
+            "openai": self.openai_api_client.caller.get_stats(),
+            "google": self.google_ai_api_client.caller.get_stats(),
+            "claude": self.claude_api_client.caller.get_stats(),
+        }
+
+    def get_compaction_stats(self) -> Optional[dict]:
+        return self.compactor.get_stats() if self.compactor is not None else None
+
+    def close(self):
+        if self.compactor is not None:
+            self.compactor.close()
+        for client in (self.openai_api_client, self.google_ai_api_client, self.claude_api_client):
+            client.conversations.close()
+        store = self.openai_api_client.conversations.store
+        if store is not None:
+            # Shared by all three containers, commits whatever is still pending
+            store.close()
@@ -1,35 +1,81 @@
-import requests
-import json
-from modules.helpers.logging_helper import logger
-from modules.ConversationContainer import OpenAIConversationContainer
+import httpx
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+from modules.APIClient import ProviderCaller, ProviderError, parse_retry_after, status_error
+from modules.helpers.logging_helper import Truncated, logger
+from modules.ConversationContainer import OpenAIConversationContainer, MemoryBudget
+from modules.Compactor import Compactor
+from modules.ConversationStore import ConversationStore
+from modules.helpers.json_helpers import EncodedMessages, dumps_body, encode_messages, loads
 from modules.helpers.prompt_helpers import get_num_tokens_from_string
+from modules.HTTPTransport import HTTPTransport, get_shared_transport
+from modules.Metrics import get_shared_metrics
+from modules.Dialogue import OpenAIDialogue
+from modules.TurnStore import Turn, get_shared_turn_store
 import logging
 
 class OpenAIAPIClient:
     def __init__(self, base_url: str, path: str, api_key: str, max_conversation_tokens: int,
                  max_response_tokens: int, max_dialogues_per_conversation: int, conversation_prune_after_seconds: int,
-                 temperature: float, system_message: str = None):
+                 temperature: float, system_message: str = None, transport: HTTPTransport = None,
+                 max_conversations: int = 0, memory_budget: MemoryBudget = None, sweep_interval_seconds: float = 0,
+                 conversation_store: ConversationStore = None, caller: ProviderCaller = None,
+                 model_max_conversation_tokens: Dict[str, int] = None, compactor: Compactor = None,
+                 image_history_turns: int = None):
         self.base_url = base_url
         self.path = path
         self.api_key = api_key
         self.max_conversation_tokens = max_conversation_tokens
+        # Budgets for single models, the others get max_conversation_tokens
+        self.model_max_conversation_tokens = model_max_conversation_tokens or {}
         self.max_response_tokens = max_response_tokens
         self.temperature = temperature
         self.system_message = system_message
+        # Built once and shared by every request, so each one starts with the same bytes and the provider's prompt
+        # cache can match the system message and the history that follows it
+        self.system_message_dict = None
+        self.encoded_system_message = b""
+        if system_message is not None:
+            self.system_message_dict = {"role": "system", "content": [{"type": "text", "text": system_message}]}
+            self.encoded_system_message = encode_messages([self.system_message_dict])
         self.conversations = OpenAIConversationContainer(conversation_prune_after_seconds=conversation_prune_after_seconds,
-                                                         max_dialogues_per_conversation=max_dialogues_per_conversation)
+                                                         max_dialogues_per_conversation=max_dialogues_per_conversation,
+                                                         max_conversations=max_conversations,
+                                                         memory_budget=memory_budget,
+                                                         sweep_interval_seconds=sweep_interval_seconds,
+                                                         store=conversation_store,
+                                                         compactor=compactor,
+                                                         image_history_turns=image_history_turns)
+        self.transport = transport if transport is not None else get_shared_transport()
+        self.caller = caller if caller is not None else ProviderCaller("openai", self.classify_error)
 
-    def send_prompt(self, prompt: str, model: str, image_url: str = None, conversation_id: str = None) -> str:
+    @staticmethod
+    def classify_error(e: Exception) -> Optional[ProviderError]:
+        if isinstance(e, httpx.TimeoutException):
+            return ProviderError(f"openai timed out: {e!r}", "openai", retryable=True)
+        if isinstance(e, httpx.TransportError):
+            return ProviderError(f"Could not reach openai: {e!r}", "openai", retryable=True)
+        return None
+
+    def raise_for_status(self, response: httpx.Response, text: str):
+        if response.status_code == 200:
+            return
+        try:
+            message = loads(text)["error"]["message"]
+        except Exception:
+            message = text[:200]
+        raise status_error("openai", response.status_code, message,
+                           retry_after=parse_retry_after(response.headers.get("retry-after")))
+
+    def build_request(self, prompt: str, model: str, image_url: str = None, conversation_id: str = None):
         headers = {
             'Authorization': 'Bearer ' + self.api_key,
             'Content-Type': 'application/json',
         }
 
-        messages = []
+        # The messages are spliced together from their encoded forms, only the new prompt is encoded here
+        fragments = [self.encoded_system_message]
+        num_messages = 1 if self.system_message_dict is not None else 0
         conversation = None
-        if self.system_message is not None:
-            system_message_content = [{"type": "text", "text": self.system_message}]
-            messages.append({"role": "system", "content": system_message_content})
 
         prompt_tokens = get_num_tokens_from_string(prompt, model)
         if conversation_id is None:
@@ -37,21 +83,20 @@ class OpenAIAPIClient:
             pass
         else:
             conversation = self.conversations.get_conversation(conversation_id=conversation_id, model=model)
-            conversation.trim(prompt_tokens=prompt_tokens, token_limit=self.max_conversation_tokens)
-            previous_messages = conversation.get_messages_for_api()
-            # Add the previous prompts and responses to the message list
-            for message in previous_messages:
-                messages.append(message)
-
-        # Finally, add the new prompt
-        prompt_content_list = []
-        prompt_content_list.append({"type": "text", "text": prompt})
-        if image_url:
-            prompt_content_list.append({"type": "image_url", "image_url": {"url": image_url}})
-        prompt_message = {"role": "user", "content": prompt_content_list}
-        messages.append(prompt_message)
-
-        logger.info(f"Using specified model: {model}")
+            conversation.trim(prompt_tokens=prompt_tokens,
+                              token_limit=self.model_max_conversation_tokens.get(model, self.max_conversation_tokens))
+            # Add the previous prompts and responses, encoded when they were added
+            previous_fragments, num_previous_messages = conversation.get_encoded_messages()
+            fragments.extend(previous_fragments)
+            num_messages += num_previous_messages
+
+        # Finally, add the new prompt, as the same turn as the other models asked it
+        turn = get_shared_turn_store().get_turn(prompt, image_url)
+        prompt_message = OpenAIDialogue.render_prompt(turn)
+        fragments.append(encode_messages([prompt_message]))
+        messages = EncodedMessages(fragments, num_messages + 1, prompt_message)
+
+        logger.debug("Using specified model: %s", model)
 
         body = {
             "model": model,
@@ -59,29 +104,152 @@ class OpenAIAPIClient:
             "max_tokens": self.max_response_tokens,
             "temperature": self.temperature
         }
+        return headers, body, conversation, turn, prompt_tokens
 
-        logger.info(f"Sending API request to {self.path} with body: {body}")
-
-        response = self.post(body=body, headers=headers, path=self.path)
-        logger.info(f"Got response: {response}")
-        response_json = json.loads(response)
+    def handle_response(self, response: str, conversation, turn: Turn, prompt_tokens: int, model: str) -> str:
+        logger.debug("Got response: %s", Truncated(response))
+        response_json = loads(response)
 
         try:
             response_message = response_json["choices"][0]["message"]
-        except:
-            return response
+        except (KeyError, IndexError, TypeError):
+            raise ProviderError(f"openai returned no answer: {response[:200]}", "openai")
 
         response_text = response_message["content"].strip()
 
         if conversation is not None:
-            conversation.add(prompt_message=prompt_message, response_message=response_message)
+            conversation.add(turn=turn, response_text=response_message["content"], prompt_num_tokens=prompt_tokens)
+
+        usage = response_json.get("usage")
+        if usage:
+            get_shared_metrics().record_tokens(model, usage.get("prompt_tokens"), usage.get("completion_tokens"),
+                                               "usage")
+            # Prompts of 1024 tokens and more are cached automatically, this is how much of the prefix was found
+            get_shared_metrics().record_cached_tokens(
+                model, (usage.get("prompt_tokens_details") or {}).get("cached_tokens"))
+        else:
+            self.record_estimated_tokens(model, conversation, prompt_tokens)
 
         return response_text
 
-    def post(self, body: dict, headers: dict, path: str):
-        response = requests.post(self.base_url + path, headers=headers, data=json.dumps(body))
+    def record_estimated_tokens(self, model: str, conversation, prompt_tokens: int):
+        """Token metrics from our own counts, the conversation's newest dialogue has both sides counted already."""
+        if conversation is not None and conversation.dialogues:
+            dialogue = conversation.dialogues[-1]
+            get_shared_metrics().record_tokens(model, dialogue.prompt_num_tokens, dialogue.response_num_tokens,
+                                               "estimate")
+        else:
+            get_shared_metrics().record_tokens(model, prompt_tokens, None, "estimate")
+
+    def log_request(self, action: str, body: dict):
+        # The body holds the whole conversation, only its size is logged unless DEBUG asks for (a summary of) it
+        logger.info("%s to %s for model %s with %d messages", action, self.path, body["model"], len(body["messages"]))
+        logger.debug("Request body: %s", Truncated(body))
+
+    def send_prompt(self, prompt: str, model: str, image_url: str = None, conversation_id: str = None,
+                    deadline: float = None) -> str:
+        headers, body, conversation, turn, prompt_tokens = self.build_request(
+            prompt=prompt, model=model, image_url=image_url, conversation_id=conversation_id)
+        self.log_request("Sending API request", body)
+        response = self.caller.call(lambda timeout: self.post(body=body, headers=headers, path=self.path,
+                                                              timeout=timeout), deadline)
+        return self.handle_response(response, conversation, turn, prompt_tokens, model)
+
+    async def send_prompt_async(self, prompt: str, model: str, image_url: str = None,
+                                conversation_id: str = None, deadline: float = None) -> str:
+        headers, body, conversation, turn, prompt_tokens = self.build_request(
+            prompt=prompt, model=model, image_url=image_url, conversation_id=conversation_id)
+        self.log_request("Sending async API request", body)
+        response = await self.caller.call_async(lambda timeout: self.post_async(body=body, headers=headers,
+                                                                                path=self.path, timeout=timeout),
+                                                deadline)
+        return self.handle_response(response, conversation, turn, prompt_tokens, model)
+
+    def parse_stream_line(self, line: str) -> Optional[str]:
+        # Server-sent events, one 'data: {json}' line per chunk and a final 'data: [DONE]'
+        if not line.startswith("data:"):
+            return None
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            return None
+        choices = loads(data).get("choices")
+        if not choices:
+            return None
+        return choices[0].get("delta", {}).get("content")
+
+    def commit_streamed_response(self, conversation, turn: Turn, prompt_tokens: int, chunks: List[str], model: str):
+        if conversation is not None:
+            conversation.add(turn=turn, response_text="".join(chunks), prompt_num_tokens=prompt_tokens)
+        # Streams carry no usage report
+        self.record_estimated_tokens(model, conversation, prompt_tokens)
+
+    def stream_prompt(self, prompt: str, model: str, image_url: str = None,
+                      conversation_id: str = None) -> Iterator[str]:
+        """Yield the response text as it arrives. The full text is added to the conversation once it is complete."""
+        headers, body, conversation, turn, prompt_tokens = self.build_request(
+            prompt=prompt, model=model, image_url=image_url, conversation_id=conversation_id)
+        body["stream"] = True
+        self.log_request("Sending streaming API request", body)
+
+        chunks = []
+        for text in self.caller.stream(lambda timeout: self.stream_chunks(body=body, headers=headers,
+                                                                           timeout=timeout)):
+            chunks.append(text)
+            yield text
+        self.commit_streamed_response(conversation, turn, prompt_tokens, chunks, model)
+
+    def stream_chunks(self, body: dict, headers: dict, timeout: float = None) -> Iterator[str]:
+        with self.transport.stream("POST", self.base_url + self.path, headers=headers, content=self.encode_body(body),
+                                   timeout=self.transport.get_timeout(timeout)) as response:
+            if response.status_code != 200:
+                self.raise_for_status(response, response.read().decode("utf-8"))
+            for line in response.iter_lines():
+                text = self.parse_stream_line(line)
+                if text:
+                    yield text
+
+    async def stream_prompt_async(self, prompt: str, model: str, image_url: str = None,
+                                  conversation_id: str = None) -> AsyncIterator[str]:
+        headers, body, conversation, turn, prompt_tokens = self.build_request(
+            prompt=prompt, model=model, image_url=image_url, conversation_id=conversation_id)
+        body["stream"] = True
+        self.log_request("Sending async streaming API request", body)
+
+        chunks = []
+        async for text in self.caller.stream_async(lambda timeout: self.stream_chunks_async(body=body, headers=headers,
+                                                                                            timeout=timeout)):
+            chunks.append(text)
+            yield text
+        self.commit_streamed_response(conversation, turn, prompt_tokens, chunks, model)
+
+    async def stream_chunks_async(self, body: dict, headers: dict, timeout: float = None) -> AsyncIterator[str]:
+        async with self.transport.stream_async("POST", self.base_url + self.path, headers=headers,
+                                               content=self.encode_body(body),
+                                               timeout=self.transport.get_timeout(timeout)) as response:
+            if response.status_code != 200:
+                self.raise_for_status(response, (await response.aread()).decode("utf-8"))
+            async for line in response.aiter_lines():
+                text = self.parse_stream_line(line)
+                if text:
+                    yield text
+
+    def encode_body(self, body: dict) -> bytes:
+        content = dumps_body(body)
+        get_shared_metrics().upstream_request_bytes.observe(len(content), body["model"])
+        return content
+
+    def post(self, body: dict, headers: dict, path: str, timeout: float = None):
+        response = self.transport.post(self.base_url + path, headers=headers, content=self.encode_body(body),
+                                       timeout=self.transport.get_timeout(timeout))
+        self.raise_for_status(response, response.text)
         return response.text
 
+    async def post_async(self, body: dict, headers: dict, path: str, timeout: float = None):
+        response = await self.transport.post_async(self.base_url + path, headers=headers,
+                                                   content=self.encode_body(body),
+                                                   timeout=self.transport.get_timeout(timeout))
+        self.raise_for_status(response, response.text)
+        return response.text
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -100,14 +268,14 @@ if __name__ == '__main__':
     model = config.openai_models[0]
 
     response = openai_api_client.send_prompt(prompt="What is the capital of France?", conversation_id="test", model=model)
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
     response = openai_api_client.send_prompt(prompt="And Germany?", conversation_id="test", model=model)
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
     response = openai_api_client.send_prompt(prompt="How about Spain?", conversation_id="test", model=model)
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
     response = openai_api_client.send_prompt(prompt="Describe the image in 1 sentence without describing the thing the cat is lying on.",
                                              image_url="https://agentlegoodbye.com/wp-content/uploads/photo-gallery/thumb/Purrito-4.jpg",
                                              conversation_id="test", model=model)
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
     response = openai_api_client.send_prompt(prompt="Now tell me the color of the thing the cat is lying on", conversation_id="test", model=model)
-    logger.info(f"Got response: {response}")
+    logger.info("Got response: %s", response)
@@ -0,0 +1,126 @@
+import heapq
+import math
+import threading
+import time
+from typing import Dict, Hashable, List, Optional, Tuple
+from modules.Config import Config
+
+
+class TokenBucket:
+    """Holds up to burst tokens, refilled continuously at rate tokens per second."""
+    __slots__ = ("rate", "burst", "tokens", "updated_at")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def seconds_until(self, amount: float) -> float:
+        return max(amount - self.tokens, 0.0) / self.rate
+
+    def full_at(self) -> float:
+        """When the bucket will be full again, after which it is indistinguishable from a new one."""
+        return self.updated_at + (self.burst - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Token buckets per caller and per model. A request costs the caller the sum of its models' weights, and each model
+    one token of that model's bucket, and is only admitted when every bucket it touches can pay. Buckets that have
+    refilled completely are dropped through an expiry heap, so idle callers cost nothing and nothing is ever scanned.
+    A rate of 0 disables that kind of bucket.
+    """
+    def __init__(self, caller_rate: float = 0.0, caller_burst: float = 1.0, model_rate: float = 0.0,
+                 model_burst: float = 1.0, model_costs: Optional[Dict[str, float]] = None):
+        self.caller_rate = caller_rate
+        self.caller_burst = caller_burst
+        self.model_rate = model_rate
+        self.model_burst = model_burst
+        self.model_costs = model_costs or {}
+
+        self.buckets: Dict[Hashable, TokenBucket] = {}
+        # (full at, key), entries for buckets that have since been used again are skipped when popped
+        self.expiry_heap: List[Tuple[float, Hashable]] = []
+        self.lock = threading.Lock()
+        self.num_allowed = 0
+        self.num_limited = 0
+
+    @classmethod
+    def from_config(cls, config: Config) -> "RateLimiter":
+        return cls(caller_rate=config.rate_limit_caller_requests_per_minute / 60,
+                   caller_burst=config.rate_limit_caller_burst,
+                   model_rate=config.rate_limit_model_requests_per_minute / 60,
+                   model_burst=config.rate_limit_model_burst,
+                   model_costs=config.rate_limit_model_costs)
+
+    def get_cost(self, models: List[str]) -> float:
+        return sum(self.model_costs.get(model, 1.0) for model in models)
+
+    def exceeds_burst(self, models: List[str]) -> bool:
+        """Whether a request to models costs more than a full caller bucket holds, so it could never be admitted."""
+        return self.caller_rate > 0 and self.get_cost(models) > self.caller_burst
+
+    def get_bucket(self, key: Hashable, rate: float, burst: float, now: float) -> TokenBucket:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst, now)
+            self.buckets[key] = bucket
+        else:
+            bucket.refill(now)
+        return bucket
+
+    def expire(self, now: float):
+        while self.expiry_heap and self.expiry_heap[0][0] <= now:
+            _, key = heapq.heappop(self.expiry_heap)
+            bucket = self.buckets.get(key)
+            if bucket is not None and bucket.full_at() <= now:
+                del self.buckets[key]
+
+    def acquire(self, caller: str, models: List[str], now: Optional[float] = None) -> float:
+        """
+        Take the tokens for a request from caller to models. Returns 0 if the request is admitted, otherwise the
+        number of seconds until it would be, in which case no bucket is charged. Requests that exceed the burst are
+        expected to have been turned away before.
+        """
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.expire(now)
+
+            charges: List[Tuple[Hashable, TokenBucket, float]] = []
+            if self.caller_rate > 0:
+                key = ("caller", caller)
+                charges.append((key, self.get_bucket(key, self.caller_rate, self.caller_burst, now),
+                                self.get_cost(models)))
+            if self.model_rate > 0:
+                for model in set(models):
+                    key = ("model", model)
+                    charges.append((key, self.get_bucket(key, self.model_rate, self.model_burst, now), 1.0))
+
+            retry_after = max((bucket.seconds_until(amount) for _, bucket, amount in charges), default=0.0)
+            if retry_after > 0:
+                self.num_limited += 1
+                return retry_after
+
+            for key, bucket, amount in charges:
+                bucket.tokens -= amount
+                heapq.heappush(self.expiry_heap, (bucket.full_at(), key))
+            self.num_allowed += 1
+            return 0.0
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "buckets": len(self.buckets),
+                "allowed": self.num_allowed,
+                "limited": self.num_limited,
+            }
+
+
+def format_retry_after(seconds: float) -> str:
+    # Retry-After only takes whole seconds, rounding down would invite a retry that is rejected again
+    return str(max(math.ceil(seconds), 1))
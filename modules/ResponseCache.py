@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from modules.Config import Config
+
+# Rough cost of an entry beyond its text (key tuple, value tuple, dict slot)
+ENTRY_OVERHEAD_BYTES = 200
+
+
+class ResponseCache:
+    """
+    Exact-match cache of responses to stateless prompts. Entries expire after ttl_seconds, and the least recently
+    used ones are evicted once max_entries or max_bytes is exceeded.
+    """
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 16 * 1024 * 1024, ttl_seconds: float = 300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # key -> (response, expiry epoch, size in bytes)
+        self.entries: OrderedDict[tuple, Tuple[str, float, int]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_config(cls, config: Config) -> "ResponseCache":
+        return cls(max_entries=config.response_cache_max_entries,
+                   max_bytes=config.response_cache_max_bytes,
+                   ttl_seconds=config.response_cache_ttl_seconds)
+
+    @staticmethod
+    def make_key(model: str, prompt: str, image_hash: Optional[str], temperature: Optional[float],
+                 system_message: Optional[str]) -> tuple:
+        # Whitespace differences between otherwise identical prompts shouldn't cause a miss
+        normalized_prompt = " ".join(prompt.split())
+        return model, normalized_prompt, image_hash, temperature, system_message
+
+    def get(self, key: tuple) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            response, expires_at, size = entry
+            if expires_at < time.time():
+                self.remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, key: tuple, response: str):
+        size = ENTRY_OVERHEAD_BYTES + len(key[1]) + len(response)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            self.entries[key] = (response, time.time() + self.ttl_seconds, size)
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def remove(self, key: tuple):
+        _, _, size = self.entries.pop(key)
+        self.total_bytes -= size
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups > 0 else 0.0,
+                "evictions": self.evictions,
+            }
@@ -1,34 +1,104 @@
-from flask import Flask, request, jsonify
-import time
+from flask import Flask, Response, request, jsonify
 import re
+import queue
+import time
+from modules.APIClient import ProviderError
 from modules.OpenAIAPIClient import OpenAIAPIClient
 from modules.GoogleAIAPIClient import GoogleAIAPIClient
 from modules.ClaudeAPIClient import ClaudeAPIClient
 from modules.Config import Config
-from modules.helpers.logging_helper import logger
-import traceback
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Optional
+from modules.HTTPTransport import get_shared_transport
+from modules.ImageCache import get_shared_image_cache
+from modules.ImageProcessor import get_shared_image_processor
+from modules.ImageStore import get_shared_image_store
+from modules.TurnStore import get_shared_turn_store
+from modules.LatencyStats import LatencyRegistry
+from modules.Metrics import MetricFamily, get_shared_metrics, merge_families
+from modules.ModelRouter import ModelRouter
+from modules.RateLimiter import RateLimiter, format_retry_after
+from modules.ResponseCache import ResponseCache
+from modules.SingleFlight import SingleFlight
+from modules.WorkerPool import WorkerPool
+from modules.helpers.network_helpers import get_image_bytes_and_hash_from_url
+from modules.helpers.logging_helper import Truncated, get_logging_stats, logger
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Union, Iterator, Tuple, Set
+
+
+@dataclass
+class PromptRequest:
+    models: List[str]
+    text: str
+    image_url: Optional[str]
+    conversation_id: Optional[str]
+    stream: bool = False
+    strategy: str = "all"
+    deadline_ms: Optional[int] = None
+
+
+@dataclass
+class FanOutResult:
+    text: str
+    strategy: str
+    # Models whose responses are in text, in request order. Empty when every model failed in race/hedged mode
+    answered_models: List[str]
+
+    def get_headers(self) -> Dict[str, str]:
+        return {"X-Fan-Out-Strategy": self.strategy, "X-Answered-Models": ",".join(self.answered_models)}
+
+
+class PromptRequestError(Exception):
+    def __init__(self, body: Union[dict, str], status: int, headers: Optional[Dict[str, str]] = None):
+        super().__init__(body)
+        self.body = body
+        self.status = status
+        self.headers = headers or {}
+
+
+# all: wait for every model. race: first successful answer. hedged: fire the next model only if the previous one is
+# slower than its p95 latency. deadline: whatever has answered within deadline_ms.
+FAN_OUT_STRATEGIES = ("all", "race", "hedged", "deadline")
+# Model latencies recorded before hedged mode trusts the p95 over the configured delay
+MIN_HEDGE_SAMPLES = 20
+
 
 class Server:
     def __init__(self, openai_api_client: OpenAIAPIClient,
                  google_ai_api_client: GoogleAIAPIClient,
                  claude_api_client: ClaudeAPIClient,
-                 config: Config):
+                 config: Config,
+                 worker_pool: Optional[WorkerPool] = None):
 
         self.config = config
         self.openai_api_client = openai_api_client
         self.google_ai_api_client = google_ai_api_client
         self.claude_api_client = claude_api_client
+        self.router = ModelRouter(openai_api_client=openai_api_client, google_ai_api_client=google_ai_api_client,
+                                  claude_api_client=claude_api_client, config=config)
+        # When set, upstream calls and the conversations they touch live in the pool's worker processes
+        self.worker_pool = worker_pool
 
-        self.min_seconds_between_requests_per_user = config.min_seconds_between_requests_per_user
-        self.callers = {}
+        self.rate_limiter = RateLimiter.from_config(config)
         self.valid_models = config.openai_models + [config.google_model] + [config.claude_model]
-        logger.info(f"Valid models: {self.valid_models} ({len(self.valid_models)} total)")
+        logger.info("Valid models: %s (%d total)", self.valid_models, len(self.valid_models))
+
+        # One executor for the whole server bounds the number of upstream calls in flight
+        self.executor = ThreadPoolExecutor(max_workers=config.max_concurrent_upstream_requests,
+                                           thread_name_prefix="upstream")
+        self.response_cache = ResponseCache.from_config(config) if config.response_cache_enabled else None
+        # Identical stateless requests arriving together share one upstream call
+        self.single_flight = SingleFlight()
+        # Upstream latency per model feeds the hedge delay, latency per strategy is reported in the stats
+        self.model_latencies = LatencyRegistry()
+        self.strategy_latencies = LatencyRegistry()
+        self.metrics = get_shared_metrics()
 
         # Using Flask synchronously
         self.app = Flask(__name__)
         self.app.route("/prompt", methods=["POST"])(self.handle_prompt)
+        self.app.route("/stats", methods=["GET"])(self.handle_stats)
+        self.app.route("/metrics", methods=["GET"])(self.handle_metrics)
 
     def is_valid_guid(self, guid):
         # Check length
@@ -39,95 +109,409 @@ class Server:
             return False
         return True
 
-    def handle_prompt(self):
-        caller = request.remote_addr
-        current_time = time.time()
-
+    def check_whitelist(self, caller: str):
         if caller not in self.config.whitelist and self.config.whitelist_enabled:
-            return jsonify({"error": "Your IP is not whitelisted"}), 403
+            raise PromptRequestError({"error": "Your IP is not whitelisted"}, 403)
 
-        if caller in self.callers:
-            time_diff = current_time - self.callers[caller]
-            if time_diff < self.min_seconds_between_requests_per_user:
-                return jsonify({"error": "Too many requests"}), 429
+    def parse_prompt_request(self, caller: str, args, data: bytes) -> PromptRequest:
+        """
+        Validate an incoming /prompt request. Shared by the Flask and ASGI front ends, so both apply
+        the same whitelist, rate limiting and argument checks.
+        """
+        self.check_whitelist(caller)
 
-        conversation_id = request.args.get("conversation_id")
+        conversation_id = args.get("conversation_id")
         if conversation_id is not None and not self.is_valid_guid(conversation_id):
-            return jsonify({"error": "Invalid conversation_id"}), 400
+            raise PromptRequestError({"error": "Invalid conversation_id"}, 400)
 
-        models_str = request.args.get("models")
+        models_str = args.get("models")
         models = [item.strip() for item in models_str.split(',')]
 
         for model in models:
             if model not in self.valid_models:
-                return jsonify({"error": f"Invalid model: {model} - Valid models are: {self.valid_models}"}), 400
+                raise PromptRequestError({"error": f"Invalid model: {model} - Valid models are: {self.valid_models}"}, 400)
 
-        if self.min_seconds_between_requests_per_user > 0:
-            self.callers[caller] = current_time
+        if self.rate_limiter.exceeds_burst(models):
+            raise PromptRequestError({"error": f"Too many models in one request, they cost "
+                                               f"{self.rate_limiter.get_cost(models):g} tokens but at most "
+                                               f"{self.rate_limiter.caller_burst:g} are allowed"}, 400)
+        retry_after = self.rate_limiter.acquire(caller, models)
+        if retry_after > 0:
+            raise PromptRequestError({"error": "Too many requests"}, 429,
+                                     headers={"Retry-After": format_retry_after(retry_after)})
 
-        text = request.data.decode("utf-8")
+        text = data.decode("utf-8")
         if len(text) > self.config.openai_max_prompt_chars:
             text = text[:self.config.openai_max_prompt_chars]
 
-        logger.info(f"Received prompt: {text}")
-        image_url = request.args.get("image_url")
+        logger.info("Received prompt (%d chars): %s", len(text), Truncated(text))
+        image_url = args.get("image_url")
 
         if image_url:
             if "{" in image_url or "}" in image_url:
-                return f"Invalid image_url: {image_url}", 400
-            logger.info(f"An image_url was included: {image_url}")
+                raise PromptRequestError(f"Invalid image_url: {image_url}", 400)
             # Replace all "|" with "/" in the image URL
             image_url = image_url.replace("|", "/")
-            logger.info(f"Image URL after replacing | with /: {image_url}")
+            logger.info("An image_url was included: %s", Truncated(image_url))
 
             if text == "":
                 text = "Describe the image in detail"
 
-        response = self.send_prompt(models=models,
-                         text=text,
-                         image_url=image_url,
-                         conversation_id=conversation_id)
+        stream = args.get("stream", "").strip().lower() in ("1", "true", "yes")
+
+        strategy = args.get("strategy", self.config.fan_out_default_strategy).strip().lower()
+        if strategy not in FAN_OUT_STRATEGIES:
+            raise PromptRequestError({"error": f"Invalid strategy: {strategy} - Valid strategies are: {list(FAN_OUT_STRATEGIES)}"}, 400)
+        if stream and strategy != "all":
+            raise PromptRequestError({"error": "Streamed prompts only support the 'all' strategy"}, 400)
+
+        deadline_ms = None
+        if strategy == "deadline":
+            try:
+                deadline_ms = int(args.get("deadline_ms", self.config.fan_out_deadline_ms))
+            except ValueError:
+                raise PromptRequestError({"error": "Invalid deadline_ms"}, 400)
+            if deadline_ms <= 0:
+                raise PromptRequestError({"error": "Invalid deadline_ms"}, 400)
+
+        return PromptRequest(models=models, text=text, image_url=image_url, conversation_id=conversation_id,
+                             stream=stream, strategy=strategy, deadline_ms=deadline_ms)
+
+    def handle_prompt(self):
+        self.metrics.requests_in_flight.inc()
+        streaming = False
+        try:
+            try:
+                prompt_request = self.parse_prompt_request(caller=request.remote_addr, args=request.args,
+                                                           data=request.data)
+            except PromptRequestError as e:
+                body = jsonify(e.body) if isinstance(e.body, dict) else e.body
+                return body, e.status, e.headers
+
+            if prompt_request.stream:
+                chunks = self.stream_prompt(models=prompt_request.models,
+                                            text=prompt_request.text,
+                                            image_url=prompt_request.image_url,
+                                            conversation_id=prompt_request.conversation_id)
+                response = Response(chunks, status=200, mimetype="text/plain")
+                # The stream outlives this handler, it is no longer in flight once werkzeug closes it
+                response.call_on_close(self.metrics.requests_in_flight.dec)
+                streaming = True
+                return response
+
+            result = self.fan_out(models=prompt_request.models,
+                                  text=prompt_request.text,
+                                  image_url=prompt_request.image_url,
+                                  conversation_id=prompt_request.conversation_id,
+                                  strategy=prompt_request.strategy,
+                                  deadline_ms=prompt_request.deadline_ms)
+
+            return result.text, 200, result.get_headers()
+        finally:
+            if not streaming:
+                self.metrics.requests_in_flight.dec()
+
+    def get_stats(self) -> dict:
+        return {
+            "http_pool": get_shared_transport().get_stats(),
+            "image_cache": get_shared_image_cache().get_stats(),
+            "image_processing": get_shared_image_processor().get_stats(),
+            "image_store": get_shared_image_store().get_stats(),
+            "turns": get_shared_turn_store().get_stats(),
+            "rate_limit": self.rate_limiter.get_stats(),
+            "response_cache": self.response_cache.get_stats() if self.response_cache is not None else None,
+            "coalescing": self.single_flight.get_stats(),
+            "latency": {
+                "models": self.model_latencies.get_stats(),
+                "strategies": self.strategy_latencies.get_stats(),
+            },
+            "persistence": (self.openai_api_client.conversations.store.get_stats()
+                            if self.openai_api_client.conversations.store is not None else None),
+            "workers": self.worker_pool.get_stats() if self.worker_pool is not None else None,
+            "logging": get_logging_stats(),
+            # Retries and circuit breakers per provider, one entry per worker when there are workers
+            "upstreams": (self.worker_pool.get_worker_upstream_stats() if self.worker_pool is not None
+                          else self.router.get_upstream_stats()),
+            "compaction": (self.worker_pool.get_worker_compaction_stats() if self.worker_pool is not None
+                           else self.router.get_compaction_stats()),
+            # One entry per worker when there are workers, they hold the conversations
+            "conversations": (self.worker_pool.get_worker_stats() if self.worker_pool is not None
+                              else self.router.get_stats()),
+        }
+
+    def handle_stats(self):
+        try:
+            self.check_whitelist(request.remote_addr)
+        except PromptRequestError as e:
+            return jsonify(e.body), e.status
+        return jsonify(self.get_stats()), 200
+
+    def get_upstream_queue_depth(self) -> int:
+        # Upstream calls and streams submitted to the executor that are waiting for a free thread
+        return self.executor._work_queue.qsize()
+
+    def get_metrics(self) -> str:
+        """The metrics of this process and its workers in Prometheus text format."""
+        families = self.metrics.collect()
+        if self.worker_pool is not None:
+            # The clients run in the workers, so that's where tokens and image downloads are counted
+            worker_families = [worker for worker in self.worker_pool.get_worker_metrics() if worker is not None]
+            families = merge_families([families] + worker_families)
 
-        self.delete_old_callers()
+        conversations = {}
+        worker_stats = self.worker_pool.get_worker_stats() if self.worker_pool is not None else [self.router.get_stats()]
+        for stats in worker_stats:
+            for provider, container_stats in (stats or {}).items():
+                conversations[(provider,)] = conversations.get((provider,), 0) + container_stats["conversations"]
 
-        return response, 200
+        families += [
+            MetricFamily("neosgpt_conversations", "gauge", "Conversations held in memory per provider",
+                         ("provider",), conversations),
+            MetricFamily("neosgpt_rate_limited_total", "counter", "Prompt requests rejected by the rate limiter",
+                         (), {(): self.rate_limiter.get_stats()["limited"]}),
+            MetricFamily("neosgpt_upstream_queue_depth", "gauge", "Upstream calls waiting for a free slot",
+                         (), {(): self.get_upstream_queue_depth()}),
+        ]
+        return self.metrics.render(families)
+
+    def handle_metrics(self):
+        try:
+            self.check_whitelist(request.remote_addr)
+        except PromptRequestError as e:
+            return jsonify(e.body), e.status
+        return Response(self.get_metrics(), status=200, mimetype="text/plain; version=0.0.4")
+
+    def get_cache_key(self, model: str, text: str, image_url: str, conversation_id: Optional[str]) -> Optional[tuple]:
+        """Key for the response cache, or None when the request can't be served from it."""
+        if self.response_cache is None or conversation_id is not None:
+            # Prompts within a conversation depend on its history, only stateless ones are cached
+            return None
+        image_hash = None
+        if image_url:
+            image = get_image_bytes_and_hash_from_url(image_url)
+            if image is None:
+                return None
+            image_hash = image[1]
+        if model in self.config.openai_models:
+            temperature, system_message = self.config.openai_temperature, self.config.openai_system_message
+        else:
+            temperature, system_message = None, None
+        return ResponseCache.make_key(model=model, prompt=text, image_hash=image_hash, temperature=temperature,
+                                      system_message=system_message)
+
+    def get_flight_key(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                       cache_key: Optional[tuple], deadline: Optional[float] = None) -> Optional[tuple]:
+        """Key under which concurrent identical requests are coalesced, or None when they must each run."""
+        if conversation_id is not None:
+            # Every prompt in a conversation is appended to its history, so none of them are interchangeable
+            return None
+        # Also keys on the image content and the sampling settings
+        key = cache_key if cache_key is not None else (model, text, image_url)
+        if deadline is not None:
+            # A call cut short at one request's deadline mustn't fail the requests without one that joined it
+            key = ("deadline",) + key
+        return key
+
+    def call_model(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                   deadline: Optional[float] = None) -> str:
+        if self.worker_pool is not None:
+            return self.worker_pool.send_prompt(model, text, image_url, conversation_id, deadline)
+        return self.router.send_prompt(model, text, image_url, conversation_id, deadline)
+
+    def send_to_model(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                      deadline: Optional[float] = None) -> Tuple[str, str, bool]:
+        """
+        Returns (model, response, succeeded). On failure the response is the error message. deadline is the
+        time.monotonic() the request stops waiting at, the upstream call isn't retried past it.
+        """
+        try:
+            cache_key = self.get_cache_key(model, text, image_url, conversation_id)
+            if cache_key is not None:
+                cached_response = self.response_cache.get(cache_key)
+                if cached_response is not None:
+                    logger.info("Serving cached response for model %s", model)
+                    return model, cached_response, True
+
+            def call_and_cache() -> str:
+                start = time.monotonic()
+                self.metrics.upstream_in_flight.inc()
+                try:
+                    response = self.call_model(model, text, image_url, conversation_id, deadline)
+                finally:
+                    self.metrics.upstream_in_flight.dec()
+                latency = time.monotonic() - start
+                self.model_latencies.record(model, latency)
+                self.metrics.upstream_latency.observe(latency, model)
+                if cache_key is not None:
+                    self.response_cache.put(cache_key, response)
+                return response
+
+            flight_key = self.get_flight_key(model, text, image_url, conversation_id, cache_key, deadline)
+            if flight_key is None:
+                response = call_and_cache()
+            else:
+                response = self.single_flight.do(flight_key, call_and_cache)
+            logger.info("Got response from model %s (%d chars)", model, len(response))
+            logger.debug("Response from model %s: %s", model, Truncated(response))
+            return model, response, True
+        except Exception as e:
+            self.metrics.upstream_errors.inc(model, type(e).__name__)
+            # The reason a provider failed is in the message, the traceback is only worth logging for our own bugs
+            logger.error("Failed to send prompt to model '%s': %s", model, e,
+                         exc_info=not isinstance(e, ProviderError))
+            return model, f"Failed to send prompt to model '{model}': {e}", False
 
     def send_prompt(self, models: List[str], text: str, image_url: str, conversation_id: Optional[str]) -> str:
-        logger.info(f"Sending prompt to {len(models)} models: {models}")
+        return self.fan_out(models, text, image_url, conversation_id).text
+
+    def get_hedge_delay(self, model: str) -> float:
+        """Seconds to wait on model before hedging: its p95 latency once known, the configured delay until then."""
+        p95 = self.model_latencies.get(model).percentile(95, min_samples=MIN_HEDGE_SAMPLES)
+        return p95 if p95 is not None else self.config.fan_out_hedge_delay_ms / 1000
+
+    def fan_out(self, models: List[str], text: str, image_url: str, conversation_id: Optional[str],
+                strategy: str = "all", deadline_ms: Optional[int] = None) -> FanOutResult:
+        logger.info("Sending prompt to %d models with strategy '%s': %s", len(models), strategy, models)
+        start = time.monotonic()
+        if strategy == "race":
+            result = self.fan_out_hedged(models, text, image_url, conversation_id, hedge=False)
+        elif strategy == "hedged":
+            result = self.fan_out_hedged(models, text, image_url, conversation_id, hedge=True)
+        elif strategy == "deadline":
+            result = self.fan_out_deadline(models, text, image_url, conversation_id, deadline_ms)
+        else:
+            result = self.fan_out_all(models, text, image_url, conversation_id)
+        self.strategy_latencies.record(strategy, time.monotonic() - start)
+        return result
+
+    def fan_out_all(self, models: List[str], text: str, image_url: str, conversation_id: Optional[str]) -> FanOutResult:
         responses = {}
 
-        # Define a function to send the request for a specific model
-        def send_to_model(model: str):
-            try:
-                if model == self.config.google_model:
-                    response = self.google_ai_api_client.send_prompt(
-                        prompt=text, image_url=image_url, conversation_id=conversation_id
-                    )
-                elif model == self.config.claude_model:
-                    response = self.claude_api_client.send_prompt(
-                        prompt=text, image_url=image_url, conversation_id=conversation_id
-                    )
-                elif model in self.config.openai_models:
-                    response = self.openai_api_client.send_prompt(
-                        prompt=text, image_url=image_url, conversation_id=conversation_id, model=model
-                    )
-                else:
-                    response = f"Invalid model: {model}"
-                logger.info(f"Got response from model {model}: {response}")
-                return model, response
-            except Exception as e:
-                traceback_str = traceback.format_exc()
-                logger.error(f"Failed to send prompt to model '{model}': {traceback_str}")
-                return model, f"Failed to send prompt to model '{model}': {e}"
-
-        # Use ThreadPoolExecutor to send requests concurrently
-        with ThreadPoolExecutor() as executor:
-            future_to_model = {executor.submit(send_to_model, model): model for model in models}
-            for future in as_completed(future_to_model):
-                model, response = future.result()
-                responses[model] = response
-
-        # Combine responses
+        # Fan out on the shared, bounded executor so concurrent requests don't each spin up their own threads
+        future_to_model = {self.executor.submit(self.send_to_model, model, text, image_url, conversation_id): model
+                           for model in models}
+        for future in as_completed(future_to_model):
+            model, response, _ = future.result()
+            responses[model] = response
+
+        return FanOutResult(self.combine_responses(models, responses), "all", list(models))
+
+    def fan_out_hedged(self, models: List[str], text: str, image_url: str, conversation_id: Optional[str],
+                       hedge: bool) -> FanOutResult:
+        """
+        Return the first successful response. Racing starts every model at once, hedging starts them one after
+        another, each only once the previous one has been slower than its hedge delay or has failed. Models that
+        haven't started when a winner is found are cancelled, ones already running finish in the background.
+        """
+        strategy = "hedged" if hedge else "race"
+        future_to_model: Dict[Future, str] = {}
+        pending: Set[Future] = set()
+        failures: Dict[str, str] = {}
+
+        for index, model in enumerate(models):
+            future = self.executor.submit(self.send_to_model, model, text, image_url, conversation_id)
+            future_to_model[future] = model
+            pending.add(future)
+            if hedge and index < len(models) - 1:
+                wait_until = time.monotonic() + self.get_hedge_delay(model)
+            elif index < len(models) - 1:
+                continue
+            else:
+                wait_until = None
+
+            while pending:
+                timeout = None if wait_until is None else wait_until - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    break
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for finished in sorted(done, key=lambda f: models.index(future_to_model[f])):
+                    finished_model, response, succeeded = finished.result()
+                    if succeeded:
+                        for loser in pending:
+                            loser.cancel()
+                        return FanOutResult(response, strategy, [finished_model])
+                    failures[finished_model] = response
+
+        return FanOutResult(self.combine_responses(models, failures), strategy, [])
+
+    def fan_out_deadline(self, models: List[str], text: str, image_url: str, conversation_id: Optional[str],
+                         deadline_ms: int) -> FanOutResult:
+        """
+        Return whatever has answered within deadline_ms. The upstream calls get the same deadline, so late models
+        aren't retried, or waited on, once the request has given up on them.
+        """
+        deadline = time.monotonic() + deadline_ms / 1000
+        future_to_model = {self.executor.submit(self.send_to_model, model, text, image_url, conversation_id,
+                                                deadline): model
+                           for model in models}
+        done, _ = wait(future_to_model, timeout=deadline_ms / 1000)
+        responses = {}
+        for future in done:
+            model, response, _ = future.result()
+            responses[model] = response
+        return self.deadline_result(models, responses, deadline_ms)
+
+    def deadline_result(self, models: List[str], responses: Dict[str, str], deadline_ms: int) -> FanOutResult:
+        answered_models = [model for model in models if model in responses]
+        if not answered_models:
+            return FanOutResult(f"No model answered within {deadline_ms} ms", "deadline", [])
+        return FanOutResult(self.combine_responses(answered_models, responses), "deadline", answered_models)
+
+    def get_model_stream(self, model: str, text: str, image_url: str, conversation_id: Optional[str]) -> Iterator[str]:
+        if self.worker_pool is not None:
+            return self.worker_pool.stream_prompt(model, text, image_url, conversation_id)
+        return self.router.stream_prompt(model, text, image_url, conversation_id)
+
+    def stream_to_model(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                        chunks: queue.Queue):
+        try:
+            cache_key = self.get_cache_key(model, text, image_url, conversation_id)
+            if cache_key is not None:
+                cached_response = self.response_cache.get(cache_key)
+                if cached_response is not None:
+                    chunks.put(cached_response)
+                    return
+
+            response_chunks = []
+            for chunk in self.get_model_stream(model, text, image_url, conversation_id):
+                response_chunks.append(chunk)
+                chunks.put(chunk)
+            logger.info("Finished streaming response from model %s", model)
+            if cache_key is not None:
+                self.response_cache.put(cache_key, "".join(response_chunks))
+        except Exception as e:
+            self.metrics.upstream_errors.inc(model, type(e).__name__)
+            logger.error("Failed to stream prompt to model '%s': %s", model, e,
+                         exc_info=not isinstance(e, ProviderError))
+            chunks.put(f"Failed to send prompt to model '{model}': {e}")
+        finally:
+            # Marks the end of this model's stream
+            chunks.put(None)
+
+    def stream_prompt(self, models: List[str], text: str, image_url: str,
+                      conversation_id: Optional[str]) -> Iterator[str]:
+        """
+        Start every model at once and yield their text in request order, with the same framing as combine_responses.
+        The first model is forwarded live while later ones buffer. Each model keeps running to completion even if the
+        caller disconnects, so its full response still lands in the conversation.
+        """
+        logger.info("Streaming prompt to %d models: %s", len(models), models)
+        queues = {model: queue.Queue() for model in models}
+        for model in models:
+            self.executor.submit(self.stream_to_model, model, text, image_url, conversation_id, queues[model])
+
+        for index, model in enumerate(models):
+            if len(models) > 1:
+                yield ("\n\n\n" if index > 0 else "") + f"Response from model '{model}':\n"
+            while True:
+                chunk = queues[model].get()
+                if chunk is None:
+                    break
+                yield chunk
+
+    def combine_responses(self, models: List[str], responses: Dict[str, str]) -> str:
         if len(models) == 1:
             return responses[models[0]]
 
@@ -137,13 +521,6 @@ class Server:
 
         return combined_response
 
-    def delete_old_callers(self):
-        current_time = time.time()
-        for caller in self.callers.copy():
-            time_diff = current_time - self.callers[caller]
-            if time_diff > self.min_seconds_between_requests_per_user:
-                del self.callers[caller]
-
     def run(self):
         self.app.run(host=self.config.host, port=self.config.port)
-        logger.info(f"Server started on {self.config.host}:{self.config.port}")
+        logger.info("Server started on %s:%s", self.config.host, self.config.port)
@@ -0,0 +1,94 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class AsyncCall:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls that share a key into one: the first caller runs the function, everyone arriving
+    while it is in flight waits for and shares its result. Exceptions are raised in every waiting caller.
+    """
+    def __init__(self):
+        self.calls: Dict[Hashable, Future] = {}
+        self.async_calls: Dict[Hashable, AsyncCall] = {}
+        self.lock = threading.Lock()
+        self.executed = 0
+        self.collapsed = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+                self.executed += 1
+            else:
+                self.collapsed += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        # Only ever touched from the event loop thread, so no lock is needed around async_calls
+        call = self.async_calls.get(key)
+        if call is None:
+            call = AsyncCall(asyncio.ensure_future(fn()))
+            self.async_calls[key] = call
+            call.task.add_done_callback(lambda task: self.on_async_call_done(key, call))
+            with self.lock:
+                self.executed += 1
+        else:
+            with self.lock:
+                self.collapsed += 1
+
+        call.waiters += 1
+        try:
+            # Shielded so one caller going away doesn't cancel the call everyone else is waiting on
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if not call.task.done():
+                call.waiters -= 1
+                if call.waiters == 0:
+                    # Nobody is left waiting, so the call itself can go
+                    call.task.cancel()
+                    self.discard_async_call(key, call)
+            raise
+
+    def on_async_call_done(self, key: Hashable, call: "AsyncCall"):
+        self.discard_async_call(key, call)
+        # Mark the outcome as retrieved even when nobody was waiting any more, so asyncio doesn't warn about it
+        if not call.task.cancelled():
+            call.task.exception()
+
+    def discard_async_call(self, key: Hashable, call: "AsyncCall"):
+        if self.async_calls.get(key) is call:
+            del self.async_calls[key]
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "executed": self.executed,
+                "collapsed": self.collapsed,
+                "in_flight": len(self.calls) + len(self.async_calls),
+            }
@@ -0,0 +1,65 @@
+import threading
+import weakref
+from typing import Optional, Tuple
+
+
+class Turn:
+    """
+    What the user sent in one turn, in no provider's format. Every model asked in the same request gets the same
+    Turn, and its dialogue only adds that model's answer to it. Never modified once made.
+    """
+    __slots__ = ("text", "image_url", "__weakref__")
+
+    def __init__(self, text: str, image_url: Optional[str] = None):
+        self.text = text
+        self.image_url = image_url
+
+
+class TurnStore:
+    """
+    The turns held by conversations, stored once each by content. Like the image store it only keeps weak
+    references, so a turn lives exactly as long as one of the models' dialogues holds it.
+    """
+    def __init__(self):
+        self.turns: "weakref.WeakValueDictionary[Tuple[str, Optional[str]], Turn]" = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+        self.num_stored = 0
+        self.num_shared = 0
+
+    def get_turn(self, text: str, image_url: Optional[str] = None) -> Turn:
+        key = (text, image_url)
+        with self.lock:
+            turn = self.turns.get(key)
+            if turn is not None:
+                self.num_shared += 1
+                return turn
+            turn = self.turns[key] = Turn(text, image_url)
+            self.num_stored += 1
+            return turn
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "turns": len(self.turns),
+                "stored": self.num_stored,
+                "shared": self.num_shared,
+            }
+
+
+shared_turn_store: Optional[TurnStore] = None
+shared_turn_store_lock = threading.Lock()
+
+
+def get_shared_turn_store() -> TurnStore:
+    global shared_turn_store
+    if shared_turn_store is None:
+        with shared_turn_store_lock:
+            if shared_turn_store is None:
+                shared_turn_store = TurnStore()
+    return shared_turn_store
+
+
+def set_shared_turn_store(turn_store: TurnStore):
+    global shared_turn_store
+    with shared_turn_store_lock:
+        shared_turn_store = turn_store
@@ -0,0 +1,399 @@
+import asyncio
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.reduction
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from typing import AsyncIterator, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+from modules.Config import Config
+from modules.Metrics import MetricFamily, get_shared_metrics
+from modules.helpers.logging_helper import configure_logging, logger, stop_logging
+
+def create_model_router(config_path: str):
+    """Default router factory, run inside each worker: the same clients main.py builds, plus a conversation store."""
+    from modules.ConversationStore import SQLiteConversationStore
+    from modules.ModelRouter import ModelRouter
+    from modules.helpers.client_helpers import create_api_clients
+
+    config = Config(config_path)
+    configure_logging(config)
+    conversation_store = SQLiteConversationStore.from_config(config) if config.persistence_enabled else None
+    openai_api_client, google_api_client, claude_api_client = create_api_clients(config, conversation_store)
+    return ModelRouter(openai_api_client=openai_api_client, google_ai_api_client=google_api_client,
+                       claude_api_client=claude_api_client, config=config)
+
+
+def run_worker(config_path: str, router_factory: Callable, num_threads: int, tasks: Connection, results: Connection):
+    router = router_factory(config_path)
+    executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="worker")
+    # Tasks waiting behind the running one of each conversation branch, oldest first. A branch has an entry while
+    # one of its tasks is with the executor, and that thread goes on to run the waiting ones in order
+    conversation_queues: Dict[str, Deque[tuple]] = {}
+    queues_lock = threading.Lock()
+    results_lock = threading.Lock()
+
+    def send(task_id: int, kind: str, payload):
+        with results_lock:
+            results.send((task_id, kind, payload))
+
+    def execute(task_id: int, kind: str, args: tuple):
+        try:
+            if kind == "stats":
+                send(task_id, "result", router.get_stats())
+                return
+            if kind == "metrics":
+                send(task_id, "result", get_shared_metrics().collect())
+                return
+            if kind == "upstreams":
+                send(task_id, "result", router.get_upstream_stats())
+                return
+            if kind == "compaction":
+                send(task_id, "result", router.get_compaction_stats())
+                return
+            if kind == "stream":
+                for chunk in router.stream_prompt(*args):
+                    send(task_id, "chunk", chunk)
+                send(task_id, "end", None)
+            else:
+                model, text, image_url, conversation_id, deadline_epoch = args
+                send(task_id, "result", router.send_prompt(model, text, image_url, conversation_id,
+                                                           to_monotonic(deadline_epoch)))
+        except Exception as e:
+            send(task_id, "error", picklable_exception(e))
+
+    def get_conversation_key(kind: str, args: tuple) -> Optional[str]:
+        if kind not in ("prompt", "stream"):
+            return None
+        model, conversation_id = args[0], args[3]
+        if conversation_id is None:
+            return None
+        # Each provider keeps its own branch of the conversation, so the models of a multi-model request only wait
+        # for turns of their own branch
+        return f"{router.get_provider(model) or model}\0{conversation_id}"
+
+    def execute_in_turn(key: str, task: tuple):
+        # The thread runs the branch's waiting tasks after its own. Submitting them instead could find the executor
+        # already shutting down
+        while True:
+            execute(*task)
+            with queues_lock:
+                waiting = conversation_queues[key]
+                if not waiting:
+                    del conversation_queues[key]
+                    return
+                task = waiting.popleft()
+
+    while True:
+        try:
+            task = tasks.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        key = get_conversation_key(task[1], task[2])
+        if key is None:
+            executor.submit(execute, *task)
+            continue
+        # Turns of one conversation are applied one at a time, in the order this worker received them
+        with queues_lock:
+            waiting = conversation_queues.get(key)
+            if waiting is not None:
+                waiting.append(task)
+                continue
+            conversation_queues[key] = deque()
+        executor.submit(execute_in_turn, key, task)
+    executor.shutdown(wait=True)
+    router.close()
+    stop_logging()
+
+
+def to_epoch(deadline: Optional[float]) -> Optional[float]:
+    """A time.monotonic() deadline as a time.time(), which means the same in every process."""
+    return None if deadline is None else time.time() + (deadline - time.monotonic())
+
+
+def to_monotonic(deadline_epoch: Optional[float]) -> Optional[float]:
+    return None if deadline_epoch is None else time.monotonic() + (deadline_epoch - time.time())
+
+
+def picklable_exception(e: Exception) -> Exception:
+    try:
+        multiprocessing.reduction.ForkingPickler.dumps(e)
+        return e
+    except Exception:
+        return RuntimeError(f"{type(e).__name__}: {e}")
+
+
+class AsyncChunks:
+    """
+    A stream's chunks handed from the result reader thread to an asyncio.Queue on the event loop, so a waiting
+    stream doesn't tie up a thread of the loop's executor.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def put(self, item: tuple):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, item)
+        except RuntimeError:
+            # The loop has been closed, nothing is reading the stream any more
+            pass
+
+
+class WorkerPool:
+    """
+    Runs upstream calls in num_workers processes, each with its own API clients and conversations. Calls for a
+    conversation always go to the worker that conversation_id hashes to, so its turns are applied in order by the one
+    process holding it. Stateless calls go to the least busy worker. With persistence enabled every worker opens the
+    same SQLite store, so conversations move to their new worker when the number of workers changes.
+
+    Workers are started with spawn, so they never inherit the front end's threads or locks, and each talks to the
+    front end over its own pair of pipes. Nothing is locked across processes, so a worker that dies can't wedge the
+    others; its in-flight calls fail and it is replaced.
+    """
+    def __init__(self, config_path: str, num_workers: int, threads_per_worker: int = 32,
+                 router_factory: Callable = create_model_router):
+        self.config_path = config_path
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.router_factory = router_factory
+        self.context = multiprocessing.get_context("spawn")
+
+        self.lock = threading.Lock()
+        self.task_ids = itertools.count()
+        # task id -> (worker index, future for calls or queue for streams)
+        self.pending: Dict[int, Tuple[int, object]] = {}
+        self.in_flight = [0] * num_workers
+        self.dispatched = [0] * num_workers
+        self.restarts = 0
+        self.closed = False
+
+        self.processes: List[Optional[multiprocessing.Process]] = [None] * num_workers
+        self.task_connections: List[Optional[Connection]] = [None] * num_workers
+        self.result_connections: List[Optional[Connection]] = [None] * num_workers
+        # Guards sending on (and replacing) each worker's task connection
+        self.send_locks = [threading.Lock() for _ in range(num_workers)]
+        for index in range(num_workers):
+            self.start_worker(index)
+
+        self.reader = threading.Thread(target=self.read_results, name="worker-pool-results", daemon=True)
+        self.reader.start()
+
+    @classmethod
+    def from_config(cls, config_path: str, config: Config) -> "WorkerPool":
+        return cls(config_path=config_path, num_workers=config.workers,
+                   threads_per_worker=config.max_concurrent_upstream_requests)
+
+    def start_worker(self, index: int):
+        """Start the worker at index; the caller holds its send lock, or the pool isn't running yet."""
+        task_receiver, task_sender = self.context.Pipe(duplex=False)
+        result_receiver, result_sender = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=run_worker, name=f"neos-gpt-worker-{index}", daemon=True,
+                                       args=(self.config_path, self.router_factory, self.threads_per_worker,
+                                             task_receiver, result_sender))
+        process.start()
+        # Only the worker keeps its ends open, so the front end sees EOF as soon as the worker dies
+        task_receiver.close()
+        result_sender.close()
+        self.processes[index] = process
+        self.task_connections[index] = task_sender
+        self.result_connections[index] = result_receiver
+
+    def pick_worker(self, conversation_id: Optional[str]) -> int:
+        if conversation_id is not None:
+            # crc32 rather than hash(), which is salted per process and would move conversations on every restart
+            return zlib.crc32(conversation_id.encode("utf-8")) % self.num_workers
+        return min(range(self.num_workers), key=lambda index: self.in_flight[index])
+
+    def dispatch(self, worker_index: int, kind: str, args: tuple, handle) -> int:
+        # Registered and sent under the worker's send lock, so a task is never sent to a replacement after being
+        # counted among the tasks of the worker it replaced
+        with self.send_locks[worker_index]:
+            with self.lock:
+                if self.closed:
+                    raise RuntimeError("The worker pool is closed")
+                task_id = next(self.task_ids)
+                self.pending[task_id] = (worker_index, handle)
+                self.in_flight[worker_index] += 1
+                self.dispatched[worker_index] += 1
+            try:
+                self.task_connections[worker_index].send((task_id, kind, args))
+                return task_id
+            except (OSError, ValueError):
+                # The worker is gone, the result reader replaces it
+                self.complete(task_id)
+        raise RuntimeError(f"Worker {worker_index} is not running")
+
+    def complete(self, task_id: int):
+        """Forget a task, returning its handle, or None if it had already been completed or failed."""
+        with self.lock:
+            entry = self.pending.pop(task_id, None)
+            if entry is None:
+                return None
+            worker_index, handle = entry
+            self.in_flight[worker_index] -= 1
+            return handle
+
+    def submit_prompt(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                      deadline: Optional[float] = None) -> Future:
+        """deadline is a time.monotonic(), see ModelRouter.send_prompt. It crosses to the worker as a time.time()."""
+        future = Future()
+        self.dispatch(self.pick_worker(conversation_id), "prompt",
+                      (model, text, image_url, conversation_id, to_epoch(deadline)), future)
+        return future
+
+    def send_prompt(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                    deadline: Optional[float] = None) -> str:
+        return self.submit_prompt(model, text, image_url, conversation_id, deadline).result()
+
+    async def send_prompt_async(self, model: str, text: str, image_url: str, conversation_id: Optional[str],
+                                deadline: Optional[float] = None) -> str:
+        return await asyncio.wrap_future(self.submit_prompt(model, text, image_url, conversation_id, deadline))
+
+    def open_stream(self, model: str, text: str, image_url: str, conversation_id: Optional[str], chunks=None):
+        """chunks is anything with a put method the result reader can hand (kind, payload) to, a new Queue if None."""
+        if chunks is None:
+            chunks = queue.Queue()
+        self.dispatch(self.pick_worker(conversation_id), "stream", (model, text, image_url, conversation_id), chunks)
+        return chunks
+
+    def stream_prompt(self, model: str, text: str, image_url: str,
+                      conversation_id: Optional[str]) -> Iterator[str]:
+        chunks = self.open_stream(model, text, image_url, conversation_id)
+        while True:
+            kind, payload = chunks.get()
+            if kind == "end":
+                return
+            if kind == "error":
+                raise payload
+            yield payload
+
+    async def stream_prompt_async(self, model: str, text: str, image_url: str,
+                                  conversation_id: Optional[str]) -> AsyncIterator[str]:
+        chunks = self.open_stream(model, text, image_url, conversation_id, AsyncChunks(asyncio.get_running_loop()))
+        while True:
+            kind, payload = await chunks.queue.get()
+            if kind == "end":
+                return
+            if kind == "error":
+                raise payload
+            yield payload
+
+    def get_worker_stats(self, timeout_seconds: float = 1.0) -> List[Optional[dict]]:
+        """Conversation stats from every worker, None for a worker that didn't answer in time."""
+        return self.query_workers("stats", timeout_seconds)
+
+    def get_worker_metrics(self, timeout_seconds: float = 1.0) -> List[Optional[List[MetricFamily]]]:
+        """The metrics recorded in every worker, None for a worker that didn't answer in time."""
+        return self.query_workers("metrics", timeout_seconds)
+
+    def get_worker_upstream_stats(self, timeout_seconds: float = 1.0) -> List[Optional[dict]]:
+        """Retries and circuit breakers from every worker, each worker has its own."""
+        return self.query_workers("upstreams", timeout_seconds)
+
+    def get_worker_compaction_stats(self, timeout_seconds: float = 1.0) -> List[Optional[dict]]:
+        """Summaries written and dialogues dropped by every worker's compactor."""
+        return self.query_workers("compaction", timeout_seconds)
+
+    def query_workers(self, kind: str, timeout_seconds: float) -> list:
+        futures = []
+        for index in range(self.num_workers):
+            future = Future()
+            self.dispatch(index, kind, (), future)
+            futures.append(future)
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout=timeout_seconds))
+            except Exception:
+                results.append(None)
+        return results
+
+    def read_results(self):
+        while True:
+            connections = {connection: index for index, connection in enumerate(self.result_connections)
+                           if connection is not None}
+            if not connections:
+                return
+            for connection in multiprocessing.connection.wait(list(connections)):
+                index = connections[connection]
+                try:
+                    task_id, kind, payload = connection.recv()
+                except (EOFError, OSError):
+                    self.on_worker_exit(index)
+                    continue
+                self.deliver(task_id, kind, payload)
+
+    def deliver(self, task_id: int, kind: str, payload):
+        if kind == "chunk":
+            with self.lock:
+                entry = self.pending.get(task_id)
+            handle = entry[1] if entry is not None else None
+        else:
+            handle = self.complete(task_id)
+        if handle is None:
+            # Already failed because its worker died
+            return
+        if isinstance(handle, Future):
+            if kind == "error":
+                handle.set_exception(payload)
+            else:
+                handle.set_result(payload)
+        else:
+            handle.put((kind, payload))
+
+    def on_worker_exit(self, index: int):
+        process = self.processes[index]
+        process.join()
+        self.result_connections[index].close()
+        self.result_connections[index] = None
+        with self.send_locks[index]:
+            with self.lock:
+                failed = [task_id for task_id, (worker_index, _) in self.pending.items() if worker_index == index]
+                restart = not self.closed
+                if restart:
+                    self.restarts += 1
+            self.task_connections[index].close()
+            if restart:
+                logger.error("Worker %d exited with code %s, restarting it", index, process.exitcode)
+                self.start_worker(index)
+
+        error = RuntimeError(f"Worker {index} exited while handling the request")
+        for task_id in failed:
+            handle = self.complete(task_id)
+            if isinstance(handle, Future):
+                handle.set_exception(error)
+            elif handle is not None:
+                handle.put(("error", error))
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "workers": self.num_workers,
+                "alive": sum(process.is_alive() for process in self.processes),
+                "dispatched": list(self.dispatched),
+                "in_flight": list(self.in_flight),
+                "restarts": self.restarts,
+            }
+
+    def close(self, timeout_seconds: float = 30):
+        with self.lock:
+            self.closed = True
+        for index in range(self.num_workers):
+            with self.send_locks[index]:
+                try:
+                    self.task_connections[index].send(None)
+                except (OSError, ValueError):
+                    pass
+        for process in self.processes:
+            process.join(timeout_seconds)
+            if process.is_alive():
+                process.terminate()
+        self.reader.join(timeout_seconds)
@@ -0,0 +1,81 @@
+from typing import Optional, Tuple
+from modules.APIClient import ProviderCaller
+from modules.Compactor import Compactor
+from modules.Config import Config
+from modules.OpenAIAPIClient import OpenAIAPIClient
+from modules.GoogleAIAPIClient import GoogleAIAPIClient
+from modules.ClaudeAPIClient import ClaudeAPIClient
+from modules.HTTPTransport import HTTPTransport, set_shared_transport
+from modules.ConversationContainer import MemoryBudget
+from modules.ConversationStore import ConversationStore
+from modules.ImageCache import ImageCache, set_shared_image_cache
+from modules.ImageProcessor import ImageProcessor, set_shared_image_processor
+
+
+def create_api_clients(config: Config, conversation_store: Optional[ConversationStore] = None
+                       ) -> Tuple[OpenAIAPIClient, GoogleAIAPIClient, ClaudeAPIClient]:
+    """
+    Build the three API clients, and the process-wide transport, image cache and image processor they share, from
+    config.
+    """
+    transport = HTTPTransport.from_config(config)
+    set_shared_transport(transport)
+    set_shared_image_cache(ImageCache.from_config(config))
+    set_shared_image_processor(ImageProcessor.from_config(config))
+    # One budget across all three containers caps the memory held by conversations in this process
+    memory_budget = MemoryBudget(max_bytes=config.max_conversation_memory_bytes)
+    # Also shared, started by the ModelRouter once there is one to send the summaries through
+    compactor = Compactor.from_config(config) if config.compaction_enabled else None
+
+    openai_api_client = OpenAIAPIClient(base_url=config.openai_base_url, path=config.openai_path,
+                                        api_key=config.openai_api_key,
+                           max_conversation_tokens=config.openai_max_conversation_tokens,
+                           max_response_tokens=config.openai_max_response_tokens,
+                           max_dialogues_per_conversation=config.openai_max_dialogues_per_conversation,
+                           conversation_prune_after_seconds=config.openai_conversation_prune_after_seconds,
+                           temperature=config.openai_temperature, system_message=config.openai_system_message,
+                           transport=transport,
+                           max_conversations=config.max_conversations,
+                           memory_budget=memory_budget,
+                           sweep_interval_seconds=config.conversation_sweep_interval_seconds,
+                           conversation_store=conversation_store,
+                           caller=ProviderCaller.from_config("openai", OpenAIAPIClient.classify_error, config),
+                           model_max_conversation_tokens=config.model_max_conversation_tokens,
+                           compactor=compactor,
+                           image_history_turns=config.image_history_turns)
+
+    google_api_client = GoogleAIAPIClient(api_key=config.google_api_key,
+                                          model_name=config.google_model,
+                                          conversation_prune_after_seconds=config.openai_conversation_prune_after_seconds,
+                                          max_dialogues_per_conversation=config.openai_max_dialogues_per_conversation,
+                                          max_conversations=config.max_conversations,
+                                          memory_budget=memory_budget,
+                                          sweep_interval_seconds=config.conversation_sweep_interval_seconds,
+                                          conversation_store=conversation_store,
+                                          compactor=compactor,
+                                          image_history_turns=config.image_history_turns,
+                                          base_url=config.google_base_url,
+                                          max_conversation_tokens=config.model_max_conversation_tokens.get(
+                                              config.google_model, config.google_max_conversation_tokens),
+                                          caller=ProviderCaller.from_config("google", GoogleAIAPIClient.classify_error,
+                                                                            config))
+
+    claude_api_client = ClaudeAPIClient(api_key=config.claude_api_key,
+                                        model_name=config.claude_model,
+                                        conversation_prune_after_seconds=config.openai_conversation_prune_after_seconds,
+                                        max_dialogues_per_conversation=config.openai_max_dialogues_per_conversation,
+                                        max_conversations=config.max_conversations,
+                                        memory_budget=memory_budget,
+                                        sweep_interval_seconds=config.conversation_sweep_interval_seconds,
+                                        conversation_store=conversation_store,
+                                        compactor=compactor,
+                                        image_history_turns=config.image_history_turns,
+                                        base_url=config.claude_base_url,
+                                        max_conversation_tokens=config.model_max_conversation_tokens.get(
+                                            config.claude_model, config.claude_max_conversation_tokens),
+                                        system_message=config.claude_system_message,
+                                        prompt_caching=config.claude_prompt_caching,
+                                        caller=ProviderCaller.from_config("claude", ClaudeAPIClient.classify_error,
+                                                                          config))
+
+    return openai_api_client, google_api_client, claude_api_client
@@ -0,0 +1,80 @@
+import json
+from typing import List
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Which codec dumps and loads use, orjson when it is installed
+JSON_CODEC = "orjson" if orjson is not None else "json"
+
+
+def dumps(value) -> bytes:
+    """Compact UTF-8 JSON. Both codecs give the same bytes, so a request's prefix doesn't change with the codec."""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def encode_messages(messages: List[dict]) -> bytes:
+    """The messages as the elements of a JSON array, without its brackets, ready to be spliced into one."""
+    return dumps(messages)[1:-1]
+
+
+class EncodedMessages:
+    """
+    A request's messages kept as encoded fragments of the JSON array, each one or more messages from encode_messages.
+    dumps_body splices them into the body as they are, so the history isn't encoded again for every request.
+    """
+    __slots__ = ("fragments", "count", "newest")
+
+    def __init__(self, fragments: List[bytes], count: int, newest: dict):
+        self.fragments = [fragment for fragment in fragments if fragment]
+        self.count = count
+        # Kept decoded for the log, which only shows the newest message
+        self.newest = newest
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __repr__(self) -> str:
+        return f"['<{self.count - 1} earlier>', {self.newest!r}]"
+
+    def encode(self) -> bytes:
+        pieces = []
+        self.add_pieces(pieces)
+        return b"".join(pieces)
+
+    def add_pieces(self, pieces: List[bytes]):
+        pieces.append(b"[")
+        for i, fragment in enumerate(self.fragments):
+            if i > 0:
+                pieces.append(b",")
+            pieces.append(fragment)
+        pieces.append(b"]")
+
+
+def dumps_body(body: dict) -> bytes:
+    """
+    Like dumps, with the EncodedMessages values in body spliced in rather than encoded. The pieces are joined once,
+    so a long history is only copied into the body, not through intermediate strings on the way.
+    """
+    pieces = [b"{"]
+    for key, value in body.items():
+        if len(pieces) > 1:
+            pieces.append(b",")
+        pieces.append(dumps(key))
+        pieces.append(b":")
+        if isinstance(value, EncodedMessages):
+            value.add_pieces(pieces)
+        else:
+            pieces.append(dumps(value))
+    pieces.append(b"}")
+    return b"".join(pieces)
@@ -1,3 +1,134 @@
+import itertools
 import logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
\ No newline at end of file
+import logging.handlers
+import queue
+from typing import Optional
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+logger = logging.getLogger(__name__)
+
+# Longest prompt, response or request body written to the log, the rest is cut off
+DEFAULT_MAX_PAYLOAD_CHARS = 300
+
+
+class Truncated:
+    """
+    A payload that is only turned into a string if its log record is emitted, and then never longer than max_chars.
+    Pass it as a logging argument ('%s') rather than formatting it into the message.
+    """
+    __slots__ = ("value", "max_chars")
+
+    max_payload_chars = DEFAULT_MAX_PAYLOAD_CHARS
+
+    def __init__(self, value, max_chars: Optional[int] = None):
+        self.value = value
+        self.max_chars = max_chars if max_chars is not None else Truncated.max_payload_chars
+
+    def __str__(self) -> str:
+        return truncate(summarize_payload(self.value), self.max_chars)
+
+
+def truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... ({len(text) - max_chars} more chars)"
+
+
+def summarize_payload(value) -> str:
+    """
+    A request body with its conversation history left out, so logging it costs the same on the first turn and the
+    hundredth. Only the newest message is kept, the ones before it are counted.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        for key in ("messages", "contents"):
+            history = value.get(key)
+            if isinstance(history, list) and len(history) > 1:
+                value = dict(value)
+                value[key] = [f"<{len(history) - 1} earlier>", truncate(str(history[-1]), Truncated.max_payload_chars)]
+    return str(value)
+
+
+class SampledDebugFilter(logging.Filter):
+    """Let every record through, except that only one in every sample_rate DEBUG records is kept."""
+    def __init__(self, sample_rate: int):
+        super().__init__()
+        self.sample_rate = max(1, sample_rate)
+        self.counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.DEBUG or self.sample_rate == 1:
+            return True
+        # itertools.count is advanced atomically under the GIL, no lock needed
+        return next(self.counter) % self.sample_rate == 0
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a QueueListener thread, which does the formatting of timestamps and the writing. When the
+    queue is full the record is dropped and counted, so a slow log sink never blocks a request.
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def get_stats(self) -> dict:
+        return {"queued": self.queue.qsize(), "dropped": self.dropped}
+
+
+queue_handler: Optional[BoundedQueueHandler] = None
+queue_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def configure_logging(config) -> BoundedQueueHandler:
+    """
+    Move the root logger's output to a background thread behind a bounded queue. The handlers basicConfig installed
+    are the ones the listener writes to.
+    """
+    global queue_handler, queue_listener
+    Truncated.max_payload_chars = config.log_max_payload_chars
+    root = logging.getLogger()
+    root.setLevel(config.log_level)
+    if queue_handler is not None:
+        return queue_handler
+
+    handlers = [handler for handler in root.handlers]
+    if not handlers:
+        handlers = [logging.StreamHandler()]
+        handlers[0].setFormatter(logging.Formatter(LOG_FORMAT))
+    for handler in handlers:
+        root.removeHandler(handler)
+
+    queue_handler = BoundedQueueHandler(queue.Queue(maxsize=config.log_queue_size))
+    queue_handler.addFilter(SampledDebugFilter(config.log_debug_sample_rate))
+    root.addHandler(queue_handler)
+    queue_listener = logging.handlers.QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    queue_listener.start()
+    return queue_handler
+
+
+def stop_logging():
+    """Write out whatever is still queued. Called on shutdown."""
+    global queue_handler, queue_listener
+    if queue_listener is None:
+        return
+    queue_listener.stop()
+    root = logging.getLogger()
+    root.removeHandler(queue_handler)
+    for handler in queue_listener.handlers:
+        root.addHandler(handler)
+    queue_handler = None
+    queue_listener = None
+
+
+def get_logging_stats() -> Optional[dict]:
+    return queue_handler.get_stats() if queue_handler is not None else None
@@ -1,28 +1,38 @@
-import requests
-from PIL import Image
-from io import BytesIO
-from typing import Union
-import base64
-from typing import Optional
+from modules.HTTPTransport import get_shared_transport
+from modules.ImageCache import get_shared_image_cache
+from modules.ImageProcessor import get_media_type, get_shared_image_processor
+from modules.helpers.logging_helper import logger
+from typing import Optional, Tuple
 
-def get_image_from_url(url: str) -> Union[Image.Image, None]:
+
+def download_image(url: str) -> bytes:
+    response = get_shared_transport().get(url, follow_redirects=True)
+    response.raise_for_status()  # Ensure the request was successful
+    return response.content
+
+
+def get_image_bytes_and_hash_from_url(url: str) -> Optional[Tuple[bytes, str]]:
     try:
-        response = requests.get(url)
-        response.raise_for_status()  # Ensure the request was successful
-        image = Image.open(BytesIO(response.content))
-        return image
+        content_hash, data = get_shared_image_cache().get(url, download_image)
+        return data, content_hash
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.warning("Failed to download image from %s: %r", url, e)
         return None
 
 
-
-def get_base64_from_image_url(url: str) -> Optional[str]:
-    image = get_image_from_url(url)
-    if image is None:
+def get_provider_image_from_url(url: str, provider: str) -> Optional[Tuple[bytes, str]]:
+    """
+    (bytes, media type) of the image at url, resized and recompressed to provider's limits. The prepared image is
+    cached next to the downloaded one, so later requests for it skip the work.
+    """
+    result = get_image_bytes_and_hash_from_url(url)
+    if result is None:
         return None
-
-    buffered = BytesIO()
-    image.save(buffered, format=image.format)
-    img_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
-    return img_base64
+    data, content_hash = result
+    try:
+        data = get_shared_image_cache().get_variant(
+            content_hash, provider, lambda: get_shared_image_processor().process(data, provider))
+    except Exception:
+        logger.exception("Failed to prepare the image from %s for %s", url, provider)
+        return None
+    return data, get_media_type(data)
@@ -1,6 +1,77 @@
+import threading
+import time
 import tiktoken
+from typing import List
+from modules.helpers.logging_helper import logger
+
+# Loading an encoding parses its whole BPE table, so it is done once per model and reused
+encodings = {}
+encodings_lock = threading.Lock()
+# A model whose encoding could not be loaded is counted approximately, and the load is tried again after this long,
+# so a transient failure (e.g. a network hiccup while fetching the BPE file) doesn't last for the process's lifetime
+ENCODING_RETRY_SECONDS = 60.0
+# When each model using the approximate encoding may try loading its real one again
+encoding_retry_at = {}
+
+# Below this many strings, encoding in a loop beats spinning up tiktoken's batch thread pool
+MIN_STRINGS_FOR_BATCH_ENCODE = 16
+
+
+class ApproximateEncoding:
+    """Used when no tiktoken encoding can be loaded (e.g. offline), estimating ~4 characters per token."""
+    name = "approximate"
+
+    def encode_ordinary(self, text: str) -> List[int]:
+        return [0] * ((len(text) + 3) // 4)
+
+    def encode_ordinary_batch(self, texts: List[str]) -> List[List[int]]:
+        return [self.encode_ordinary(text) for text in texts]
+
+
+def load_encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.warning("tiktoken has no encoding registered for model '%s', using cl100k_base", model)
+    except Exception as e:
+        logger.warning("Failed to load tiktoken encoding for model '%s': %s", model, e)
+        return ApproximateEncoding()
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning("Failed to load tiktoken encoding cl100k_base: %s", e)
+        return ApproximateEncoding()
+
+
+def needs_loading(encoding, model: str) -> bool:
+    if encoding is None:
+        return True
+    return isinstance(encoding, ApproximateEncoding) and time.monotonic() >= encoding_retry_at.get(model, 0.0)
+
+
+def get_encoding(model: str):
+    encoding = encodings.get(model)
+    if needs_loading(encoding, model):
+        with encodings_lock:
+            encoding = encodings.get(model)
+            if needs_loading(encoding, model):
+                encoding = load_encoding(model)
+                encodings[model] = encoding
+                if isinstance(encoding, ApproximateEncoding):
+                    encoding_retry_at[model] = time.monotonic() + ENCODING_RETRY_SECONDS
+                else:
+                    encoding_retry_at.pop(model, None)
+    return encoding
+
 
 def get_num_tokens_from_string(string: str, encoding_name: str) -> int:
-    encoding = tiktoken.encoding_for_model(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
\ No newline at end of file
+    encoding = get_encoding(encoding_name)
+    num_tokens = len(encoding.encode_ordinary(string))
+    return num_tokens
+
+
+def get_num_tokens_from_strings(strings: List[str], encoding_name: str) -> List[int]:
+    encoding = get_encoding(encoding_name)
+    if len(strings) < MIN_STRINGS_FOR_BATCH_ENCODE:
+        return [len(encoding.encode_ordinary(string)) for string in strings]
+    return [len(tokens) for tokens in encoding.encode_ordinary_batch(strings)]
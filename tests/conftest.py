@@ -0,0 +1,63 @@
+import os
+import pytest
+from modules.APIClient import ProviderCaller
+from modules.Config import Config
+from modules.ConversationContainer import OpenAIConversationContainer
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeAPIClient:
+    """Stands in for the provider clients so the server can be exercised without network access."""
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = []
+        self.deadlines = []
+        self.conversations = OpenAIConversationContainer(conversation_prune_after_seconds=0,
+                                                         max_dialogues_per_conversation=5)
+        self.caller = ProviderCaller(name, classify=lambda e: None)
+
+    def send_prompt(self, prompt: str, image_url: str = None, conversation_id: str = None, model: str = None,
+                    deadline: float = None) -> str:
+        self.calls.append((prompt, image_url, conversation_id, model))
+        self.deadlines.append(deadline)
+        return f"{model or self.name}: {prompt}"
+
+    def stream_prompt(self, prompt: str, image_url: str = None, conversation_id: str = None, model: str = None):
+        response = self.send_prompt(prompt=prompt, image_url=image_url, conversation_id=conversation_id, model=model)
+        for index in range(0, len(response), 4):
+            yield response[index:index + 4]
+
+    async def stream_prompt_async(self, prompt: str, image_url: str = None, conversation_id: str = None,
+                                  model: str = None):
+        for chunk in self.stream_prompt(prompt=prompt, image_url=image_url, conversation_id=conversation_id,
+                                        model=model):
+            yield chunk
+
+    async def send_prompt_async(self, prompt: str, image_url: str = None, conversation_id: str = None,
+                                model: str = None, deadline: float = None) -> str:
+        return self.send_prompt(prompt=prompt, image_url=image_url, conversation_id=conversation_id, model=model,
+                                deadline=deadline)
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    with open(os.path.join(base_dir, 'config_sample.ini')) as f:
+        contents = f.read()
+    contents = contents.replace("api_key =\n", "api_key = test-key\n")
+    contents = contents.replace("whitelist_enabled = True", "whitelist_enabled = False")
+    contents = contents.replace("min_seconds_between_requests_per_user = 5", "min_seconds_between_requests_per_user = 0")
+    contents = contents.replace("caller_requests_per_minute = 12", "caller_requests_per_minute = 0")
+    path = tmp_path / "config.ini"
+    path.write_text(contents)
+    return str(path)
+
+
+@pytest.fixture
+def config(config_path):
+    return Config(config_path)
+
+
+@pytest.fixture
+def fake_clients():
+    return FakeAPIClient("openai"), FakeAPIClient("google"), FakeAPIClient("claude")
@@ -1,33 +1,174 @@
-from modules.Config import Config
-from modules.OpenAIAPIClient import APIClient, ConversationContainer, Conversation, Dialogue, get_num_tokens_from_string
-import os
+import asyncio
+import base64
+from io import BytesIO
+import PIL.Image
 import pytest
+from benchmarks.mock_upstreams import MockUpstreams
+from modules.APIClient import ProviderError
+from modules.ClaudeAPIClient import ClaudeAPIClient
+from modules.GoogleAIAPIClient import GoogleAIAPIClient
+from modules.HTTPTransport import HTTPTransport
+from modules.ImageStore import StoredImage
+from modules.OpenAIAPIClient import OpenAIAPIClient
+
+# The clients talk to the local mock upstreams over real HTTP, no API keys or network access needed
+
+
+@pytest.fixture(scope="module")
+def upstreams():
+    with MockUpstreams(response_words=4) as upstreams:
+        yield upstreams
+
+
+@pytest.fixture
+def openai_client(upstreams):
+    return OpenAIAPIClient(base_url=upstreams.base_url, path="/v1/chat/completions", api_key="test-key",
+                           max_conversation_tokens=4096, max_response_tokens=100, max_dialogues_per_conversation=5,
+                           conversation_prune_after_seconds=0, temperature=0.5,
+                           # Its own transport, async connections can't outlive the event loop of one test
+                           transport=HTTPTransport())
 
-base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 @pytest.fixture
-def api_client():
-    config = Config(os.path.join(base_dir, 'config.ini'))
-    return APIClient(base_url=config.base_url,
-                     path=config.path,
-                     api_key=config.api_key,
-                     model=config.model,
-                     max_conversation_tokens=config.max_conversation_tokens,
-                     max_response_tokens=config.max_response_tokens,
-                     temperature=config.temperature,
-                     conversation_prune_after_seconds=config.conversation_prune_after_seconds,
-                     max_dialogues_per_conversation=config.max_dialogues_per_conversation
-                     )
-
-def test_APIClient_send_prompt_english(api_client: APIClient):
-    response = api_client.send_prompt(prompt="What is 9 plus 10?")
-    assert response is not None
-    assert isinstance(response, str)
-    assert len(response) > 0
-
-def test_APIClient_send_prompt_japanese(api_client: APIClient):
-    response = api_client.send_prompt(prompt="9たす10は何ですか？")
-    assert response is not None
-    assert isinstance(response, str)
-    assert len(response) > 0
+def google_client(upstreams):
+    return GoogleAIAPIClient(api_key="test-key", model_name="gemini-1.5-flash", conversation_prune_after_seconds=0,
+                             max_dialogues_per_conversation=5, base_url=upstreams.base_url)
+
+
+@pytest.fixture
+def claude_client(upstreams):
+    return ClaudeAPIClient(api_key="test-key", model_name="claude-3-5-sonnet-latest",
+                           conversation_prune_after_seconds=0, max_dialogues_per_conversation=5,
+                           base_url=upstreams.base_url)
+
+
+def test_openai_send_prompt_english(openai_client, upstreams):
+    assert openai_client.send_prompt(prompt="What is 9 plus 10?", model="gpt-4o") == \
+        "Mock reply to: What is 9 plus 10?"
+    assert upstreams.last_bodies["openai"]["model"] == "gpt-4o"
+
+
+def test_openai_send_prompt_japanese(openai_client):
+    assert openai_client.send_prompt(prompt="9たす10は何ですか？", model="gpt-4o") == "Mock reply to: 9たす10は何ですか？"
+
+
+def test_openai_keeps_the_conversation(openai_client, upstreams):
+    openai_client.send_prompt(prompt="first", model="gpt-4o", conversation_id="abc")
+    openai_client.send_prompt(prompt="second", model="gpt-4o", conversation_id="abc")
+    messages = upstreams.last_bodies["openai"]["messages"]
+    assert [message["role"] for message in messages] == ["user", "assistant", "user"]
+    assert messages[1]["content"] == "Mock reply to: first"
+
+
+def test_openai_stream_prompt(openai_client):
+    chunks = list(openai_client.stream_prompt(prompt="stream me", model="gpt-4o", conversation_id="abc"))
+    assert "".join(chunks).strip() == "Mock reply to: stream me"
+    assert len(openai_client.conversations.get_conversation("abc", "gpt-4o").dialogues) == 1
+
+
+def test_failed_calls_are_retried(openai_client, google_client, claude_client, upstreams):
+    for client, kind in ((openai_client, "openai"), (google_client, "gemini"), (claude_client, "anthropic")):
+        upstreams.fail_next(kind, status=503)
+        upstreams.fail_next(kind, status=429, retry_after=0)
+        assert client.send_prompt(prompt="retry me", **({"model": "gpt-4o"} if kind == "openai" else {})) == \
+            "Mock reply to: retry me"
+        assert client.caller.get_stats()["retries"] == 2
+
+
+def test_openai_client_errors_are_raised(openai_client, upstreams):
+    upstreams.fail_next("openai", status=400)
+    with pytest.raises(ProviderError, match="400"):
+        openai_client.send_prompt(prompt="bad", model="gpt-4o")
+    assert openai_client.caller.get_stats()["retries"] == 0
+
+
+def test_google_send_prompt_with_image(google_client, upstreams):
+    assert google_client.send_prompt(prompt="Describe it", image_url=upstreams.base_url + "/images/cat.png",
+                                     conversation_id="abc") == "Mock reply to: Describe it"
+    assert google_client.send_prompt(prompt="And now?", conversation_id="abc") == "Mock reply to: And now?"
+    assert len(upstreams.last_bodies["gemini"]["contents"]) == 3
+    # The history keeps the image's encoded bytes, not a decoded copy
+    assert isinstance(google_client.conversations.get_conversation("abc", "gemini-1.5-flash")
+                      .dialogues[0].image, StoredImage)
+
+
+def test_claude_send_prompt_with_image(claude_client, upstreams):
+    assert claude_client.send_prompt(prompt="Describe it", image_url=upstreams.base_url + "/images/cat.png") == \
+        "Mock reply to: Describe it"
+    image = upstreams.last_bodies["anthropic"]["messages"][0]["content"][1]
+    assert image["source"]["media_type"] == "image/png"
+
+
+def test_large_images_are_scaled_down_before_upload(claude_client, google_client, upstreams):
+    image = PIL.Image.new("RGB", (3000, 1500), (200, 30, 60))
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    upstreams.images["/images/large.png"] = buffered.getvalue()
+    url = upstreams.base_url + "/images/large.png"
+
+    claude_client.send_prompt(prompt="Describe it", image_url=url)
+    source = upstreams.last_bodies["anthropic"]["messages"][0]["content"][1]["source"]
+    assert PIL.Image.open(BytesIO(base64.b64decode(source["data"]))).size == (1568, 784)
+
+    google_client.send_prompt(prompt="Describe it", image_url=url)
+    inline_data = upstreams.last_bodies["gemini"]["contents"][0]["parts"][0]["inlineData"]
+    assert PIL.Image.open(BytesIO(base64.b64decode(inline_data["data"]))).size == (1536, 768)
+
+
+
+def test_claude_marks_the_prompt_prefix_as_cacheable(upstreams):
+    client = ClaudeAPIClient(api_key="test-key", model_name="claude-3-5-sonnet-latest",
+                             conversation_prune_after_seconds=0, max_dialogues_per_conversation=5,
+                             base_url=upstreams.base_url, system_message="Be brief.")
+    for prompt in ("first", "second", "third"):
+        client.send_prompt(prompt=prompt, conversation_id="cached")
+    body = upstreams.last_bodies["anthropic"]
+    assert body["system"] == [{"type": "text", "text": "Be brief.", "cache_control": {"type": "ephemeral"}}]
+    # Only the newest turn carries a breakpoint, the stored turns are sent as they were
+    breakpoints = [i for i, message in enumerate(body["messages"])
+                   if any("cache_control" in block for block in message["content"])]
+    assert breakpoints == [4]
+
+
+
+def test_images_are_not_resent_with_every_turn(upstreams):
+    client = ClaudeAPIClient(api_key="test-key", model_name="claude-3-5-sonnet-latest",
+                             conversation_prune_after_seconds=0, max_dialogues_per_conversation=5,
+                             base_url=upstreams.base_url, image_history_turns=1)
+    client.send_prompt(prompt="Describe it", image_url=upstreams.base_url + "/images/cat.png", conversation_id="img")
+    sent_image = []
+    for prompt in ("second", "third", "fourth"):
+        client.send_prompt(prompt=prompt, conversation_id="img")
+        sent_image.append(any(block["type"] == "image" for message in upstreams.last_bodies["anthropic"]["messages"]
+                              for block in message["content"]))
+    # Only the turn right after the image still sends it
+    assert sent_image == [True, False, False]
+
+
+def test_async_send_prompt(openai_client, google_client, claude_client):
+    async def main():
+        return await asyncio.gather(openai_client.send_prompt_async(prompt="one", model="gpt-4o"),
+                                    google_client.send_prompt_async(prompt="two"),
+                                    claude_client.send_prompt_async(prompt="three"))
+
+    assert asyncio.run(main()) == ["Mock reply to: one", "Mock reply to: two", "Mock reply to: three"]
+
+
+def test_google_and_claude_stream_prompt(google_client, claude_client):
+    for client in (google_client, claude_client):
+        chunks = list(client.stream_prompt(prompt="stream me", conversation_id="abc"))
+        assert len(chunks) > 1
+        assert "".join(chunks).strip() == "Mock reply to: stream me"
+        assert len(client.conversations.get_conversation("abc", client.model_name).dialogues) == 1
+
+
+def test_async_stream_prompt(openai_client, google_client, claude_client):
+    async def collect(chunks):
+        return "".join([chunk async for chunk in chunks]).strip()
+
+    async def main():
+        return await asyncio.gather(collect(openai_client.stream_prompt_async(prompt="one", model="gpt-4o")),
+                                    collect(google_client.stream_prompt_async(prompt="two")),
+                                    collect(claude_client.stream_prompt_async(prompt="three")))
 
+    assert asyncio.run(main()) == ["Mock reply to: one", "Mock reply to: two", "Mock reply to: three"]
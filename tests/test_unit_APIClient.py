@@ -1,70 +1,255 @@
-from modules.OpenAIAPIClient import APIClient, ConversationContainer, Conversation, Dialogue, get_num_tokens_from_string
-import os
+import json
+import pickle
+import time
 import pytest
-
-base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-
-# Hardcoded test data
+from types import SimpleNamespace
+from anthropic.types import Usage
+from modules.APIClient import CircuitBreaker, CircuitOpenError, ProviderCaller, ProviderError, parse_retry_after
+from modules.Metrics import Metrics, set_shared_metrics
+from modules.ClaudeAPIClient import ClaudeAPIClient
+from modules.OpenAIAPIClient import OpenAIAPIClient
+from modules.helpers import prompt_helpers
+from modules.helpers.prompt_helpers import get_num_tokens_from_string
+
+MODEL = "test-model"
 PROMPT = "What is 9 plus 10?"
 RESPONSE = "The answer is 19."
-MODEL = "gpt-3.5-turbo"
-TOKEN_LIMIT = 20  # Arbitrary limit
 
-@pytest.fixture
-def dialogue():
-    return Dialogue(PROMPT, RESPONSE, MODEL)
+
+class WordEncoding:
+    """One token per whitespace separated word, so expected counts are easy to read."""
+    def encode_ordinary(self, text):
+        return text.split()
+
+    def encode_ordinary_batch(self, texts):
+        return [self.encode_ordinary(text) for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def word_encoding(monkeypatch):
+    monkeypatch.setitem(prompt_helpers.encodings, MODEL, WordEncoding())
 
 
 @pytest.fixture
-def conversation():
-    return Conversation(max_length=5, model=MODEL)
+def api_client():
+    return OpenAIAPIClient(base_url="http://upstream", path="/v1/chat/completions", api_key="test-key",
+                           max_conversation_tokens=20, max_response_tokens=100, max_dialogues_per_conversation=5,
+                           conversation_prune_after_seconds=0, temperature=0.5, system_message="Be brief.")
 
 
-def test_get_num_tokens_from_string_english():
-    num_tokens = get_num_tokens_from_string(string="What is 9 plus 10?", encoding_name="gpt-3.5-turbo")
-    assert num_tokens == 8
+def completion(text: str) -> str:
+    return json.dumps({"choices": [{"message": {"role": "assistant", "content": text}}]})
 
 
-def test_dialogue_init(dialogue):
-    assert dialogue.prompt == PROMPT
-    assert dialogue.response == RESPONSE
-    assert dialogue.prompt_num_tokens == get_num_tokens_from_string(PROMPT, MODEL)
-    assert dialogue.response_num_tokens == get_num_tokens_from_string(RESPONSE, MODEL)
-    assert dialogue.total_num_tokens == dialogue.prompt_num_tokens + dialogue.response_num_tokens
+def sent_body(api_client, body: dict) -> dict:
+    return json.loads(api_client.encode_body(body))
 
 
-def test_conversation_init(conversation):
-    assert conversation.max_length == 5
-    assert len(conversation.dialogues) == 0
+def test_get_num_tokens_from_string():
+    assert get_num_tokens_from_string(PROMPT, MODEL) == 5
 
 
-def test_conversation_add(conversation, dialogue):
-    conversation.add(dialogue.prompt, dialogue.response)
-    assert len(conversation.dialogues) == 1
-    assert conversation.dialogues[0].prompt == dialogue.prompt
-    assert conversation.dialogues[0].response == dialogue.response
+def test_build_request_without_conversation(api_client):
+    headers, body, conversation, turn, prompt_tokens = api_client.build_request(
+        prompt=PROMPT, model=MODEL, image_url="http://images/cat.png")
+    assert headers["Authorization"] == "Bearer test-key"
+    assert conversation is None
+    assert prompt_tokens == 5
+    assert (turn.text, turn.image_url) == (PROMPT, "http://images/cat.png")
+    body = sent_body(api_client, body)
+    assert body["model"] == MODEL
+    assert body["max_tokens"] == 100
+    assert [message["role"] for message in body["messages"]] == ["system", "user"]
+    assert body["messages"][1]["content"] == [{"type": "text", "text": PROMPT},
+                                              {"type": "image_url", "image_url": {"url": "http://images/cat.png"}}]
 
 
-def test_conversation_get_messages_for_api(conversation, dialogue):
-    conversation.add(dialogue.prompt, dialogue.response)
-    messages = conversation.get_messages_for_api()
-    assert len(messages) == 2
-    assert messages[0]['role'] == 'user'
-    assert messages[0]['content'] == dialogue.prompt
-    assert messages[1]['role'] == 'assistant'
-    assert messages[1]['content'] == dialogue.response
+def test_responses_are_added_to_the_conversation(api_client):
+    request = api_client.build_request(prompt=PROMPT, model=MODEL, conversation_id="abc")
+    _, _, conversation, turn, prompt_tokens = request
+    assert api_client.handle_response(completion(f" {RESPONSE} "), conversation, turn,
+                                      prompt_tokens, MODEL) == RESPONSE
 
+    _, body, _, _, _ = api_client.build_request(prompt="And 10 plus 11?", model=MODEL, conversation_id="abc")
+    assert len(body["messages"]) == 4
+    messages = sent_body(api_client, body)["messages"]
+    assert [message["role"] for message in messages] == ["system", "user", "assistant", "user"]
+    assert messages[2]["content"] == f" {RESPONSE} "
+    assert messages == [api_client.system_message_dict] + conversation.get_messages_for_api() + [messages[-1]]
 
-def test_conversation_get_total_tokens(conversation, dialogue):
-    conversation.add(dialogue.prompt, dialogue.response)
-    total_tokens = conversation.get_total_tokens()
-    assert total_tokens == dialogue.total_num_tokens
 
+def test_conversation_is_trimmed_to_the_token_limit(api_client):
+    for _ in range(3):
+        _, _, conversation, turn, prompt_tokens = api_client.build_request(
+            prompt=PROMPT, model=MODEL, conversation_id="abc")
+        api_client.handle_response(completion(RESPONSE), conversation, turn, prompt_tokens, MODEL)
+    # Each dialogue is 9 tokens, so with a 5 token prompt only one fits under the limit of 20
+    _, body, conversation, _, _ = api_client.build_request(prompt=PROMPT, model=MODEL, conversation_id="abc")
+    assert len(conversation.dialogues) == 1
+    assert len(body["messages"]) == 4
+
+
+def test_token_metrics_prefer_the_usage_report(api_client):
+    metrics = Metrics()
+    set_shared_metrics(metrics)
+    _, _, conversation, turn, prompt_tokens = api_client.build_request(
+        prompt=PROMPT, model=MODEL, conversation_id="abc")
+    api_client.handle_response(completion(RESPONSE), conversation, turn, prompt_tokens, MODEL)
+    with_usage = json.loads(completion(RESPONSE))
+    with_usage["usage"] = {"prompt_tokens": 40, "completion_tokens": 6}
+    api_client.handle_response(json.dumps(with_usage), None, turn, prompt_tokens, MODEL)
+
+    assert metrics.prompt_tokens.collect().samples == {(MODEL, "estimate"): 5, (MODEL, "usage"): 40}
+    assert metrics.response_tokens.collect().samples == {(MODEL, "estimate"): 4, (MODEL, "usage"): 6}
+
+
+
+def test_cached_prompt_tokens_are_recorded(api_client):
+    metrics = Metrics()
+    set_shared_metrics(metrics)
+    with_usage = json.loads(completion(RESPONSE))
+    with_usage["usage"] = {"prompt_tokens": 2000, "completion_tokens": 6,
+                           "prompt_tokens_details": {"cached_tokens": 1536}}
+    api_client.handle_response(json.dumps(with_usage), None, {}, 0, MODEL)
+
+    claude_client = ClaudeAPIClient(api_key="test-key", model_name="claude-test", conversation_prune_after_seconds=0,
+                                    max_dialogues_per_conversation=5)
+    # Claude's input_tokens leaves out the cached part of the prompt
+    usage = Usage(input_tokens=20, output_tokens=6, cache_read_input_tokens=1800, cache_creation_input_tokens=300)
+    assert claude_client.record_usage(usage) == (2120, 6)
+    assert metrics.cached_prompt_tokens.collect().samples == {(MODEL, "read"): 1536, ("claude-test", "read"): 1800,
+                                                              ("claude-test", "write"): 300}
+
+
+def test_claude_dialogues_count_only_their_own_prompt():
+    claude_client = ClaudeAPIClient(api_key="test-key", model_name=MODEL, conversation_prune_after_seconds=0,
+                                    max_dialogues_per_conversation=5, system_message="Answer in one short sentence.")
+    # The system message and the history are read from or written to the cache, and not part of input_tokens
+    usages = [Usage(input_tokens=3, output_tokens=4, cache_read_input_tokens=0, cache_creation_input_tokens=20),
+              Usage(input_tokens=2, output_tokens=4, cache_read_input_tokens=20, cache_creation_input_tokens=15)]
+    for prompt, usage in zip([PROMPT, "And 9 plus 11?"], usages):
+        conversation, messages, new_turn, prompt_tokens = claude_client.build_messages(
+            prompt=prompt, conversation_id="cached")
+        response = SimpleNamespace(content=[SimpleNamespace(text=RESPONSE)], usage=usage)
+        claude_client.handle_response(response, conversation, new_turn, prompt_tokens)
+    # Each dialogue holds its own prompt, not the cached prefix, nor the history sent along with it
+    assert [dialogue.prompt_num_tokens for dialogue in conversation.dialogues] == [5, 4]
+    assert [dialogue.response_num_tokens for dialogue in conversation.dialogues] == [4, 4]
+    assert conversation.get_total_tokens() == 17
+
+
+def test_error_bodies_are_not_returned_as_answers(api_client):
+    error = json.dumps({"error": {"message": "quota exceeded"}})
+    with pytest.raises(ProviderError):
+        api_client.handle_response(error, None, {}, 0, MODEL)
+
+
+def test_parse_stream_line(api_client):
+    chunk = {"choices": [{"delta": {"content": "Hel"}}]}
+    assert api_client.parse_stream_line(f"data: {json.dumps(chunk)}") == "Hel"
+    assert api_client.parse_stream_line("data: [DONE]") is None
+    assert api_client.parse_stream_line(": keep-alive") is None
+    assert api_client.parse_stream_line('data: {"choices": []}') is None
 
-def test_conversation_trim(conversation, dialogue):
-    for _ in range(6):  # Add more dialogues than max_length
-        conversation.add(dialogue.prompt, dialogue.response)
-    assert len(conversation.dialogues) == conversation.max_length  # Check trimming from adding
-    prompt_tokens = get_num_tokens_from_string(PROMPT, MODEL)
-    conversation.trim(prompt_tokens=prompt_tokens, token_limit=TOKEN_LIMIT)
-    assert len(conversation.dialogues) < conversation.max_length  # Check trimming by token limit
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr("modules.APIClient.time.sleep", delays.append)
+    return delays
+
+
+def failing(errors: list, result: str = "ok"):
+    """An attempt that raises the given errors one per call, then returns result."""
+    def attempt(timeout):
+        if errors:
+            raise errors.pop(0)
+        return result
+    return attempt
+
+
+def test_retries_respect_retry_after(sleeps):
+    caller = ProviderCaller("test", classify=lambda e: None, backoff_base_seconds=0.01)
+    errors = [ProviderError("rate limited", "test", status=429, retryable=True, retry_after=2),
+              ProviderError("unavailable", "test", status=503, retryable=True)]
+    assert caller.call(failing(errors)) == "ok"
+    assert sleeps[0] == 2 and sleeps[1] <= 0.02
+    assert caller.get_stats()["retries"] == 2
+
+
+def test_client_errors_are_not_retried(sleeps):
+    caller = ProviderCaller("test", classify=lambda e: None)
+    with pytest.raises(ProviderError):
+        caller.call(failing([ProviderError("bad request", "test", status=400)]))
+    assert sleeps == []
+    assert caller.get_stats()["circuit"]["consecutive_failures"] == 0
+
+
+def test_waits_that_outlast_the_deadline_give_up(sleeps):
+    caller = ProviderCaller("test", classify=lambda e: None, timeout_seconds=1)
+    with pytest.raises(ProviderError, match="rate limited"):
+        caller.call(failing([ProviderError("rate limited", "test", status=429, retryable=True, retry_after=5)]))
+    assert sleeps == []
+
+
+def test_request_deadlines_cut_calls_short(sleeps):
+    caller = ProviderCaller("test", classify=lambda e: None, timeout_seconds=30)
+    # The request is due in 3 seconds, so a retry 5 seconds out is pointless and attempts only get what is left
+    with pytest.raises(ProviderError, match="rate limited"):
+        caller.call(failing([ProviderError("rate limited", "test", status=429, retryable=True, retry_after=5)]),
+                    deadline=time.monotonic() + 3)
+    assert sleeps == []
+    assert caller.call(lambda timeout: timeout, deadline=time.monotonic() + 3) <= 3
+    assert caller.call(lambda timeout: timeout) > 3
+    with pytest.raises(ProviderError, match="deadline"):
+        caller.call(lambda timeout: timeout, deadline=time.monotonic() - 1)
+
+
+def test_unknown_exceptions_are_raised_as_they_are(sleeps):
+    caller = ProviderCaller("test", classify=lambda e: None)
+    with pytest.raises(ZeroDivisionError):
+        caller.call(failing([ZeroDivisionError()]))
+
+
+def test_circuit_opens_and_recovers(sleeps, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("modules.APIClient.time.monotonic", lambda: now[0])
+    caller = ProviderCaller("test", classify=lambda e: ProviderError(str(e), "test", retryable=True),
+                            max_attempts=1, failure_threshold=2, reset_seconds=30)
+    for _ in range(2):
+        with pytest.raises(ProviderError):
+            caller.call(failing([ConnectionError("refused")]))
+    with pytest.raises(CircuitOpenError):
+        caller.call(failing([]))
+    assert caller.get_stats()["circuit"] == {"state": CircuitBreaker.OPEN, "consecutive_failures": 2,
+                                             "times_opened": 1, "rejected": 1}
+
+    now[0] += 30
+    # One probe is let through once the breaker has cooled down, and closes it again
+    assert caller.call(failing([])) == "ok"
+    assert caller.get_stats()["circuit"]["state"] == CircuitBreaker.CLOSED
+
+
+def test_streams_are_only_retried_before_the_first_chunk(sleeps):
+    caller = ProviderCaller("test", classify=lambda e: ProviderError(str(e), "test", retryable=True))
+    attempts = []
+
+    def stream(timeout):
+        attempts.append(timeout)
+        if len(attempts) == 1:
+            raise ConnectionError("refused")
+        yield "Hel"
+        raise ConnectionError("reset")
+
+    chunks = []
+    with pytest.raises(ProviderError, match="reset"):
+        for chunk in caller.stream(stream):
+            chunks.append(chunk)
+    assert chunks == ["Hel"]
+    assert len(attempts) == 2
+
+
+def test_provider_errors_survive_pickling():
+    error = pickle.loads(pickle.dumps(CircuitOpenError("open", "claude", status=None, retryable=False)))
+    assert isinstance(error, CircuitOpenError) and error.provider == "claude"
+    assert parse_retry_after("3") == 3 and parse_retry_after("soon") is None
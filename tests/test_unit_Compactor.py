@@ -0,0 +1,128 @@
+import threading
+import pytest
+from modules.Compactor import Compactor
+from modules.Conversation import (ClaudeConversation, GoogleAIConversation, OpenAIConversation, SUMMARY_PREFIX)
+from modules.ConversationContainer import ClaudeConversationContainer
+from modules.TurnStore import Turn
+from modules.helpers import prompt_helpers
+
+MODEL = "test-model"
+
+
+class WordEncoding:
+    """One token per whitespace separated word, so expected counts are easy to read."""
+    def encode_ordinary(self, text):
+        return text.split()
+
+    def encode_ordinary_batch(self, texts):
+        return [self.encode_ordinary(text) for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def word_encoding(monkeypatch):
+    monkeypatch.setitem(prompt_helpers.encodings, MODEL, WordEncoding())
+
+
+class RecordingSummarizer:
+    """Answers every summary prompt with a numbered summary, and remembers the prompts."""
+    def __init__(self):
+        self.prompts = []
+        self.answered = threading.Event()
+
+    def __call__(self, prompt: str) -> str:
+        self.prompts.append(prompt)
+        self.answered.set()
+        return f"summary {len(self.prompts)}"
+
+
+def add_turn(conversation, prompt: str, response: str):
+    conversation.add(turn=Turn(prompt), response_text=response)
+
+
+def test_evicted_dialogues_are_folded_into_the_summary():
+    summarizer = RecordingSummarizer()
+    compactor = Compactor(model=MODEL)
+    container = ClaudeConversationContainer(conversation_prune_after_seconds=0, max_dialogues_per_conversation=2,
+                                            model=MODEL, compactor=compactor)
+    conversation = container.get_conversation("abc", MODEL)
+    for turn in ("first", "second", "third"):
+        add_turn(conversation, f"{turn} question", f"{turn} answer")
+
+    compactor.start(summarizer)
+    assert summarizer.answered.wait(timeout=5)
+    compactor.close()
+
+    assert "User: first question\nAssistant: first answer" in summarizer.prompts[0]
+    # Left for the next request to apply, the compactor's thread doesn't change the conversation itself
+    assert conversation.summary is None
+    assert container.get_conversation("abc", MODEL) is conversation
+    assert conversation.summary == "summary 1"
+    messages = conversation.get_messages_for_api()
+    assert messages[0]["content"][0]["text"] == SUMMARY_PREFIX + "summary 1"
+    assert [message["role"] for message in messages] == ["user", "assistant"] * 3
+    assert compactor.get_stats() == {"queued": 0, "compacted": 1, "dropped": 0, "failed": 0}
+
+
+def test_summary_prompt_carries_the_previous_summary():
+    compactor = Compactor(model=MODEL, max_summary_words=50)
+    conversation = ClaudeConversation(max_length=1, model=MODEL)
+    add_turn(conversation, "hi", "hello")
+    prompt = compactor.build_prompt("they met", [conversation.dialogues[0]])
+    assert "at most 50 words" in prompt
+    assert "Summary so far:\nthey met" in prompt
+
+
+def test_summaries_not_yet_applied_are_carried_forward():
+    summarizer = RecordingSummarizer()
+    compactor = Compactor(model=MODEL)
+    compactor.send_prompt = summarizer
+    conversation = ClaudeConversation(max_length=1, model=MODEL)
+    add_turn(conversation, "hi", "hello")
+    add_turn(conversation, "bye", "goodbye")
+    compactor.compact(conversation, list(conversation.dialogues))
+    compactor.compact(conversation, list(conversation.dialogues))
+    assert "Summary so far:\nsummary 1" in summarizer.prompts[1]
+    conversation.apply_pending_summary()
+    assert (conversation.summary, conversation.pending_summary) == ("summary 2", None)
+    assert conversation.get_total_tokens() == 2 + 2
+
+
+def test_failed_summaries_drop_the_dialogues():
+    def failing(prompt):
+        raise ConnectionError("refused")
+
+    compactor = Compactor(model=MODEL)
+    compactor.send_prompt = failing
+    conversation = ClaudeConversation(max_length=1, model=MODEL)
+    add_turn(conversation, "hi", "hello")
+    compactor.compact(conversation, list(conversation.dialogues))
+    assert conversation.summary is None
+    assert compactor.get_stats()["failed"] == 1
+
+
+def test_full_queue_drops_evicted_dialogues():
+    compactor = Compactor(model=MODEL, queue_size=1)
+    conversation = ClaudeConversation(max_length=5, model=MODEL)
+    for _ in range(3):
+        compactor.on_dialogue_evicted(conversation, None)
+    assert compactor.get_stats()["dropped"] == 2
+
+
+def test_summary_counts_against_the_token_budget():
+    conversation = OpenAIConversation(max_length=5, model=MODEL)
+    for _ in range(3):
+        conversation.add(turn=Turn("a b"), response_text="c d")
+    conversation.set_summary("s t u v", 4)
+    assert conversation.get_total_tokens() == 16
+    conversation.trim(prompt_tokens=2, token_limit=14)
+    assert len(conversation.dialogues) == 1
+    assert conversation.get_messages_for_api()[0] == {"role": "system", "content": SUMMARY_PREFIX + "s t u v"}
+
+
+def test_summary_is_persisted():
+    conversation = GoogleAIConversation(max_length=5, model=MODEL)
+    conversation.add(turn=Turn("a"), response_text="b")
+    conversation.set_summary("earlier", 1)
+    restored = GoogleAIConversation.from_dict(conversation.to_dict(), max_length=5)
+    assert restored.summary == "earlier" and restored.get_total_tokens() == 3
+    assert [message["role"] for message in restored.get_messages_for_api()] == ["user", "model"] * 2
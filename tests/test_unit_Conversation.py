@@ -0,0 +1,166 @@
+import pytest
+from modules.Conversation import ClaudeConversation, GoogleAIConversation, OpenAIConversation
+from modules.Dialogue import IMAGE_PLACEHOLDER, ClaudeDialogue, split_usage
+from modules.ImageStore import ImageStore
+from modules.TurnStore import Turn
+from modules.helpers import prompt_helpers
+
+MODEL = "test-model"
+
+
+class WordEncoding:
+    """One token per whitespace separated word, so expected counts are easy to read."""
+    def encode_ordinary(self, text):
+        return text.split()
+
+    def encode_ordinary_batch(self, texts):
+        return [self.encode_ordinary(text) for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def word_encoding(monkeypatch):
+    monkeypatch.setitem(prompt_helpers.encodings, MODEL, WordEncoding())
+
+
+def add_dialogue(conversation, prompt: str, response: str):
+    conversation.add(turn=Turn(prompt), response_text=response)
+
+
+def test_failed_encoding_loads_are_retried(monkeypatch):
+    attempts = []
+
+    def load_encoding(model):
+        attempts.append(model)
+        return prompt_helpers.ApproximateEncoding() if len(attempts) == 1 else WordEncoding()
+
+    clock = [1000.0]
+    monkeypatch.setattr(prompt_helpers, "load_encoding", load_encoding)
+    monkeypatch.setattr(prompt_helpers.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(prompt_helpers, "encodings", {})
+    monkeypatch.setattr(prompt_helpers, "encoding_retry_at", {})
+    text = "a b c d e f g h"
+    # Approximated (about 4 characters a token) until the retry is due
+    assert prompt_helpers.get_num_tokens_from_string(text, "flaky-model") == 4
+    assert prompt_helpers.get_num_tokens_from_string(text, "flaky-model") == 4
+    clock[0] += prompt_helpers.ENCODING_RETRY_SECONDS
+    # Then the real encoding is loaded and kept
+    assert prompt_helpers.get_num_tokens_from_string(text, "flaky-model") == 8
+    clock[0] += prompt_helpers.ENCODING_RETRY_SECONDS
+    assert prompt_helpers.get_num_tokens_from_string(text, "flaky-model") == 8
+    assert attempts == ["flaky-model", "flaky-model"]
+
+
+def test_batch_token_counts():
+    strings = ["one two", "three", ""] * 10
+    assert prompt_helpers.get_num_tokens_from_strings(strings, MODEL) == [2, 1, 0] * 10
+
+
+def test_running_total_follows_add_and_evict():
+    conversation = OpenAIConversation(max_length=2, model=MODEL)
+    add_dialogue(conversation, "a b", "c")
+    add_dialogue(conversation, "d", "e f g")
+    assert conversation.get_total_tokens() == 7
+    add_dialogue(conversation, "h", "i")
+    assert len(conversation.dialogues) == 2
+    assert conversation.get_total_tokens() == 6
+
+
+def test_trim_uses_running_total():
+    conversation = OpenAIConversation(max_length=5, model=MODEL)
+    for _ in range(5):
+        add_dialogue(conversation, "a b", "c d")
+    conversation.trim(prompt_tokens=3, token_limit=12)
+    assert len(conversation.dialogues) == 2
+    assert conversation.get_total_tokens() == 8
+    assert conversation.get_total_tokens() == sum(d.total_num_tokens for d in conversation.dialogues)
+
+
+def test_messages_are_cached_until_the_conversation_changes():
+    conversation = OpenAIConversation(max_length=2, model=MODEL)
+    add_dialogue(conversation, "a", "b")
+    messages = conversation.get_messages_for_api()
+    assert conversation.get_messages_for_api() is messages
+    add_dialogue(conversation, "c", "d")
+    add_dialogue(conversation, "e", "f")
+    messages = conversation.get_messages_for_api()
+    assert [message["content"] for message in messages[1::2]] == ["d", "f"]
+    assert messages[0]["content"][0]["text"] == "c"
+
+
+def test_messages_are_rendered_from_the_turn():
+    conversation = OpenAIConversation(max_length=2, model=MODEL)
+    turn = Turn("hi")
+    conversation.add(turn=turn, response_text=" hello ")
+    dialogue = conversation.dialogues[0]
+    assert dialogue.turn is turn
+    assert dialogue.prompt_message == {"role": "user", "content": [{"type": "text", "text": "hi"}]}
+    assert dialogue.response_message == {"role": "assistant", "content": " hello "}
+    assert dialogue.response_text == "hello"
+    assert not hasattr(dialogue, "__dict__")
+
+
+IMAGE = ImageStore().intern(b"\x89PNG\r\n\x1a\n", "image/png")
+
+
+def test_claude_and_gemini_conversations_are_trimmed_to_a_budget():
+    claude = ClaudeConversation(max_length=10, model=MODEL)
+    gemini = GoogleAIConversation(max_length=10, model=MODEL)
+    for _ in range(5):
+        claude.add(turn=Turn("a b"), response_text="c d")
+        gemini.add(turn=Turn("a b"), response_text="c d")
+    for conversation in (claude, gemini):
+        conversation.trim(prompt_tokens=3, token_limit=12)
+        assert len(conversation.dialogues) == 2
+        assert conversation.get_total_tokens() == 8
+
+
+def test_images_are_estimated_at_a_flat_cost():
+    assert ClaudeDialogue.estimate_prompt_tokens(Turn("a b"), IMAGE, MODEL) == 2 + ClaudeDialogue.image_num_tokens
+
+
+def test_usage_reports_are_preferred_over_estimates():
+    conversation = ClaudeConversation(max_length=10, model=MODEL)
+    conversation.add(turn=Turn("a b"), response_text="c d")
+    # The provider counted 30 input tokens for the history, the system message and the prompt, and 7 output tokens
+    prompt_num_tokens, response_num_tokens = split_usage(30, 7, prompt_tokens=1)
+    conversation.add(turn=Turn("e"), response_text="f", prompt_num_tokens=prompt_num_tokens,
+                     response_num_tokens=response_num_tokens)
+    assert conversation.get_total_tokens() == 4 + 1 + 7
+    assert split_usage(None, 7, prompt_tokens=None) == (None, 7)
+    assert split_usage(None, None, prompt_tokens=1) == (1, None)
+
+
+def test_dialogues_saved_without_counts_are_estimated():
+    conversation = GoogleAIConversation.from_dict({
+        "model": MODEL, "update_epoch": 1,
+        "dialogues": [{"prompt_contents": {"role": "user", "parts": ["a b c"]}, "response_text": "d"}]}, max_length=10)
+    assert conversation.get_total_tokens() == 4
+    restored = GoogleAIConversation.from_dict(conversation.to_dict(), max_length=10)
+    assert restored.dialogues[0].to_dict()["prompt_num_tokens"] == 3
+
+
+def test_images_are_only_kept_for_the_newest_turns():
+    conversation = ClaudeConversation(max_length=10, model=MODEL)
+    conversation.image_history_turns = 1
+    conversation.add(turn=Turn("a b"), response_text="c", image=IMAGE)
+    image_turn = conversation.dialogues[0]
+    assert image_turn.prompt_num_tokens == 2 + ClaudeDialogue.image_num_tokens
+    # The next request still sends the image
+    assert conversation.get_messages_for_api()[0]["content"][1]["type"] == "image"
+    size_bytes = conversation.size_bytes
+
+    conversation.add(turn=Turn("d"), response_text="e")
+    assert [block["type"] for block in image_turn.prompt_contents["content"]] == ["text", "text"]
+    assert conversation.get_messages_for_api()[0]["content"][1]["text"] == IMAGE_PLACEHOLDER
+    assert image_turn.image is None
+    assert image_turn.prompt_num_tokens == 2
+    assert conversation.get_total_tokens() == sum(d.total_num_tokens for d in conversation.dialogues) == 5
+    assert conversation.size_bytes < size_bytes + conversation.dialogues[-1].size_bytes
+
+
+def test_openai_image_urls_are_dropped_from_old_turns():
+    conversation = OpenAIConversation(max_length=10, model=MODEL)
+    conversation.image_history_turns = 0
+    conversation.add(turn=Turn("what is this", "http://images/cat.png"), response_text="a cat")
+    assert conversation.get_messages_for_api()[0]["content"][1] == {"type": "text", "text": IMAGE_PLACEHOLDER}
+    assert conversation.dialogues[0].prompt_text == "what is this"
@@ -0,0 +1,73 @@
+from modules.ConversationContainer import ClaudeConversationContainer, MemoryBudget
+from modules.TurnStore import Turn
+
+MODEL = "claude-test"
+
+
+def make_container(**kwargs):
+    options = dict(conversation_prune_after_seconds=0, max_dialogues_per_conversation=5, model=MODEL)
+    options.update(kwargs)
+    return ClaudeConversationContainer(**options)
+
+
+def add_turn(conversation, text: str):
+    conversation.add(turn=Turn(text), response_text=text)
+
+
+def test_expired_conversations_are_pruned():
+    container = make_container(conversation_prune_after_seconds=60)
+    old = container.get_conversation("old", MODEL)
+    old.update_epoch -= 120
+    container.get_conversation("new", MODEL)
+    assert list(container.conversations) == ["new"]
+    assert container.get_stats()["evictions"]["expired"] == 1
+
+
+def test_expired_conversation_is_replaced_on_access():
+    container = make_container(conversation_prune_after_seconds=60)
+    conversation = container.get_conversation("a", MODEL)
+    add_turn(conversation, "hello")
+    conversation.update_epoch -= 120
+    fresh = container.get_conversation("a", MODEL)
+    assert fresh is not conversation
+    assert len(fresh.dialogues) == 0
+
+
+def test_least_recently_used_is_evicted_over_max_conversations():
+    container = make_container(max_conversations=2)
+    container.get_conversation("a", MODEL)
+    container.get_conversation("b", MODEL)
+    container.get_conversation("a", MODEL)
+    container.get_conversation("c", MODEL)
+    assert list(container.conversations) == ["a", "c"]
+    assert container.get_stats()["evictions"]["max_conversations"] == 1
+
+
+def test_shared_memory_budget_evicts_across_growth():
+    budget = MemoryBudget(max_bytes=2000)
+    container = make_container(memory_budget=budget)
+    for conversation_id in ["a", "b", "c"]:
+        add_turn(container.get_conversation(conversation_id, MODEL), "x" * 300)
+    assert budget.used_bytes <= 2000
+    assert "c" in container.conversations
+    assert container.get_stats()["evictions"]["max_bytes"] >= 1
+    assert container.total_bytes == sum(c.size_bytes for c in container.conversations.values())
+    assert budget.used_bytes == container.total_bytes
+
+
+def test_shared_memory_budget_evicts_the_oldest_of_all_containers():
+    budget = MemoryBudget(max_bytes=20000)
+    small = make_container(memory_budget=budget)
+    large = make_container(memory_budget=budget)
+    add_turn(large.get_conversation("large", MODEL), "x" * 9000)
+    for conversation_id in range(30):
+        add_turn(small.get_conversation(str(conversation_id), MODEL), "x")
+    assert not budget.is_exceeded()
+
+    # The small container crosses the budget, but the large conversation is the oldest of all and goes first
+    add_turn(small.get_conversation("30", MODEL), "x" * 2000)
+    assert list(large.conversations) == []
+    assert len(small.conversations) == 31
+    assert large.get_stats()["evictions"]["max_bytes"] == 1
+    assert small.get_stats()["evictions"]["max_bytes"] == 0
+    assert budget.used_bytes == small.total_bytes + large.total_bytes <= 20000
@@ -0,0 +1,160 @@
+import sqlite3
+import threading
+from modules.ConversationContainer import ClaudeConversationContainer, GoogleConversationContainer
+from modules.ConversationStore import ConversationStore, SQLiteConversationStore
+from modules.ImageStore import get_shared_image_store
+from modules.TurnStore import Turn
+
+MODEL = "claude-test"
+
+
+def make_container(store, **kwargs):
+    options = dict(conversation_prune_after_seconds=0, max_dialogues_per_conversation=5, model=MODEL, store=store)
+    options.update(kwargs)
+    return ClaudeConversationContainer(**options)
+
+
+def add_turn(conversation, text: str):
+    conversation.add(turn=Turn(text), response_text=f"re: {text}")
+
+
+def test_records_survive_reopening(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    store = SQLiteConversationStore(path, flush_interval_seconds=60)
+    store.save("claude", "a", {"update_epoch": 1.0, "dialogues": []})
+    # Readable before the writer has committed it
+    assert store.load("claude", "a") == {"update_epoch": 1.0, "dialogues": []}
+    assert store.get_stats()["pending"] == 1
+    store.close()
+
+    store = SQLiteConversationStore(path)
+    assert store.load("claude", "a") == {"update_epoch": 1.0, "dialogues": []}
+    assert store.load("openai", "a") is None
+    store.delete("claude", "a")
+    store.flush()
+    assert store.get_stats()["pending"] == 0
+    store.close()
+    assert SQLiteConversationStore(path).load("claude", "a") is None
+
+
+def test_repeated_saves_are_written_once(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "conversations.sqlite3"), flush_interval_seconds=60)
+    for index in range(10):
+        store.save("claude", "a", {"update_epoch": float(index), "dialogues": []})
+    store.flush()
+    assert store.get_stats()["written"] == 1
+    assert store.load("claude", "a")["update_epoch"] == 9.0
+    store.close()
+
+
+def test_conversations_are_restored_after_restart(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    store = SQLiteConversationStore(path)
+    container = make_container(store)
+    conversation = container.get_conversation("abc", MODEL)
+    add_turn(conversation, "hello")
+    add_turn(conversation, "again")
+    store.close()
+
+    store = SQLiteConversationStore(path)
+    container = make_container(store)
+    restored = container.get_conversation("abc", MODEL)
+    assert restored.get_messages_for_api() == conversation.get_messages_for_api()
+    assert container.get_stats()["restored"] == 1
+    assert container.get_stats()["bytes"] == conversation.size_bytes
+    store.close()
+
+
+def test_evicted_conversations_come_back_from_the_store(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "conversations.sqlite3"))
+    container = make_container(store, max_conversations=1)
+    add_turn(container.get_conversation("a", MODEL), "hello")
+    container.get_conversation("b", MODEL)
+    assert "a" not in container.conversations
+    assert len(container.get_conversation("a", MODEL).dialogues) == 1
+    store.close()
+
+
+def test_expired_conversations_are_not_restored(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "conversations.sqlite3"))
+    add_turn(make_container(store).get_conversation("a", MODEL), "hello")
+    store.flush()
+    record = store.load("claude", "a")
+    record["update_epoch"] -= 120
+    store.save("claude", "a", record)
+
+    container = make_container(store, conversation_prune_after_seconds=60)
+    assert len(container.get_conversation("a", MODEL).dialogues) == 0
+    assert container.get_stats()["restored"] == 0
+    store.close()
+
+
+def test_expired_rows_are_deleted_by_the_writer(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "conversations.sqlite3"), flush_interval_seconds=60)
+    store.save("claude", "old", {"update_epoch": 100.0, "dialogues": []})
+    store.save("claude", "new", {"update_epoch": 300.0, "dialogues": []})
+    store.flush()
+    store.delete_older_than("claude", 200.0)
+    store.flush()
+    assert store.load("claude", "old") is None
+    assert store.load("claude", "new") is not None
+    store.close()
+
+
+def test_conversations_are_snapshotted_by_the_writer(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "conversations.sqlite3"), flush_interval_seconds=60)
+    conversation = make_container(store).get_conversation("a", MODEL)
+    add_turn(conversation, "hello")
+    # The request only queued the conversation, to_dict is left to the writer
+    assert store.pending[("claude", "a")] is conversation
+    add_turn(conversation, "again")
+    assert len(store.load("claude", "a")["dialogues"]) == 2
+    store.flush()
+    assert store.load("claude", "a") == conversation.to_dict()
+    store.close()
+
+
+class FailingStore(ConversationStore):
+    def __init__(self):
+        self.sweeps = threading.Semaphore(0)
+
+    def load(self, namespace, conversation_id):
+        return None
+
+    def save(self, namespace, conversation_id, record):
+        pass
+
+    def delete(self, namespace, conversation_id):
+        pass
+
+    def delete_older_than(self, namespace, update_epoch):
+        self.sweeps.release()
+        raise sqlite3.OperationalError("database is locked")
+
+
+def test_sweeper_survives_store_errors():
+    store = FailingStore()
+    container = make_container(store, conversation_prune_after_seconds=60, sweep_interval_seconds=0.01)
+    for _ in range(3):
+        assert store.sweeps.acquire(timeout=5)
+    assert container.sweeper.is_alive()
+    container.close()
+
+
+def test_images_in_gemini_prompts_round_trip(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    store = SQLiteConversationStore(path)
+    container = GoogleConversationContainer(conversation_prune_after_seconds=0, max_dialogues_per_conversation=5,
+                                            model="gemini-test", store=store)
+    image = get_shared_image_store().intern(b"\x89PNG\r\n\x1a\n", "image/png")
+    container.get_conversation("a", "gemini-test").add(
+        turn=Turn("look", "http://images/red.png"), response_text="red", image=image)
+    store.close()
+
+    store = SQLiteConversationStore(path)
+    container = GoogleConversationContainer(conversation_prune_after_seconds=0, max_dialogues_per_conversation=5,
+                                            model="gemini-test", store=store)
+    dialogue = container.get_conversation("a", "gemini-test").dialogues[0]
+    assert (dialogue.turn.text, dialogue.turn.image_url) == ("look", "http://images/red.png")
+    assert dialogue.prompt_contents["parts"] == [image, "look"]
+    store.close()
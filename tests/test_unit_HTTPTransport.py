@@ -0,0 +1,53 @@
+import http.server
+import threading
+import time
+import httpx
+import pytest
+from modules.HTTPTransport import HTTPTransport
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path == "/slow":
+            time.sleep(0.5)
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class QuietServer(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # The timeout test hangs up mid-response on purpose
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = QuietServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_connections_are_reused(upstream):
+    transport = HTTPTransport(pool_size=2)
+    for _ in range(5):
+        assert transport.get(upstream + "/").text == "ok"
+    stats = transport.get_stats()
+    assert stats["requests"] == 5
+    assert stats["connections_opened"] == 1
+    assert stats["reuse_ratio"] == pytest.approx(0.8)
+    assert stats["in_use_connections"] == 0
+
+
+def test_read_timeout_is_enforced(upstream):
+    transport = HTTPTransport(read_timeout_seconds=0.1)
+    with pytest.raises(httpx.ReadTimeout):
+        transport.get(upstream + "/slow")
+    assert transport.get_stats()["failures"] == 1
@@ -0,0 +1,76 @@
+import threading
+import time
+import pytest
+from modules.ImageCache import ImageCache
+
+
+def test_repeat_requests_hit_the_cache():
+    cache = ImageCache()
+    calls = []
+
+    def fetch(url):
+        calls.append(url)
+        return b"image-bytes"
+
+    first = cache.get("http://a/1.png", fetch)
+    second = cache.get("http://a/1.png", fetch)
+    assert first == second
+    assert calls == ["http://a/1.png"]
+    assert cache.get_stats()["hits"] == 1
+
+
+def test_identical_content_is_stored_once():
+    cache = ImageCache()
+    hash_a, data_a = cache.get("http://a/1.png", lambda url: b"same" * 10)
+    hash_b, data_b = cache.get("http://b/2.png", lambda url: b"same" * 10)
+    assert hash_a == hash_b
+    assert data_a is data_b
+    assert cache.get_stats()["images"] == 1
+
+
+def test_concurrent_fetches_share_one_download():
+    cache = ImageCache()
+    calls = []
+    release = threading.Event()
+
+    def fetch(url):
+        calls.append(url)
+        release.wait(5)
+        return b"slow"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get("http://a/slow.png", fetch)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(results) == 8
+    assert cache.get_stats()["coalesced"] == 7
+
+
+def test_errors_reach_every_waiter_and_are_not_cached():
+    cache = ImageCache()
+
+    def fail(url):
+        raise IOError("boom")
+
+    with pytest.raises(IOError):
+        cache.get("http://a/broken.png", fail)
+    assert cache.get("http://a/broken.png", lambda url: b"ok")[1] == b"ok"
+
+
+def test_expired_urls_and_byte_cap():
+    cache = ImageCache(max_bytes=10, ttl_seconds=0)
+    cache.get("http://a/1.png", lambda url: b"x" * 8)
+    cache.get("http://a/2.png", lambda url: b"y" * 8)
+    stats = cache.get_stats()
+    assert stats["images"] == 1
+    assert stats["evictions"] == 1
+    # A zero TTL means the URL is fetched again
+    calls = []
+    cache.get("http://a/2.png", lambda url: calls.append(url) or b"y" * 8)
+    assert calls == ["http://a/2.png"]
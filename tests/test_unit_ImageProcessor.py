@@ -0,0 +1,96 @@
+import random
+from io import BytesIO
+import pytest
+from PIL import Image
+from modules.ImageCache import ImageCache
+from modules.ImageProcessor import ImageProcessor, get_media_type, process_image, sniff_image_format
+
+LIMITS = {"claude": (64, 4096), "google": (128, 64 * 1024)}
+
+
+def make_image(size, image_format: str, mode: str = "RGB") -> bytes:
+    # Noise, so the encoded size grows with the image like a photo's does
+    rng = random.Random(0)
+    image = Image.frombytes(mode, size, bytes(rng.getrandbits(8) for _ in range(size[0] * size[1] * len(mode))))
+    buffered = BytesIO()
+    image.save(buffered, format=image_format)
+    return buffered.getvalue()
+
+
+def open_image(data: bytes) -> Image.Image:
+    return Image.open(BytesIO(data))
+
+
+def test_small_images_are_sent_as_they_are():
+    processor = ImageProcessor(LIMITS)
+    data = make_image((32, 16), "PNG")
+    assert processor.process(data, "claude") is data
+    assert processor.get_stats()["passed_through"] == 1
+
+
+def test_large_images_are_scaled_down_to_the_longest_edge():
+    processed = ImageProcessor(LIMITS).process(make_image((400, 200), "JPEG"), "google")
+    assert open_image(processed).size == (128, 64)
+    assert len(processed) <= 64 * 1024
+
+
+def test_images_are_recompressed_to_the_byte_limit():
+    data = make_image((64, 64), "PNG")
+    assert len(data) > 4096
+    processed = process_image(data, max_edge=64, max_bytes=4096)
+    assert len(processed) <= 4096
+    assert get_media_type(processed) == "image/jpeg"
+
+
+def test_transparent_images_stay_png_when_they_fit():
+    image = Image.new("RGBA", (300, 300), (255, 0, 0, 0))
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    processed = process_image(buffered.getvalue(), max_edge=100, max_bytes=64 * 1024)
+    assert sniff_image_format(processed) == "PNG"
+    assert open_image(processed).mode == "RGBA"
+
+
+def test_formats_providers_dont_take_are_converted():
+    processed = process_image(make_image((16, 16), "BMP"), max_edge=64, max_bytes=64 * 1024)
+    assert sniff_image_format(processed) == "JPEG"
+
+
+def test_small_gifs_are_converted_for_gemini_only():
+    processor = ImageProcessor(LIMITS)
+    data = make_image((32, 16), "GIF", mode="L")
+    assert processor.process(data, "claude") is data
+    processed = processor.process(data, "google")
+    assert get_media_type(processed) in ("image/png", "image/jpeg")
+    assert open_image(processed).size == (32, 16)
+
+
+def test_unreadable_images_raise():
+    with pytest.raises(Exception):
+        ImageProcessor(LIMITS).process(b"not an image", "claude")
+
+
+def test_variants_are_built_once_and_cached():
+    cache = ImageCache()
+    content_hash, data = cache.get("http://a/1.png", lambda url: b"original")
+    calls = []
+
+    def make():
+        calls.append(1)
+        return b"small"
+
+    assert cache.get_variant(content_hash, "claude", make) == b"small"
+    assert cache.get_variant(content_hash, "claude", make) == b"small"
+    assert calls == [1]
+    assert cache.get_stats()["variant_hits"] == 1
+    assert cache.get_stats()["bytes"] == len(b"original") + len(b"small")
+
+
+def test_processing_in_a_pool():
+    processor = ImageProcessor(LIMITS, num_processes=1)
+    try:
+        processed = processor.process(make_image((200, 100), "PNG"), "google")
+        assert open_image(processed).size == (128, 64)
+        assert processor.get_stats()["processes"] == 1
+    finally:
+        processor.close()
@@ -0,0 +1,68 @@
+import base64
+import gc
+from modules.ConversationContainer import ClaudeConversationContainer
+from modules.ConversationStore import SQLiteConversationStore
+from modules.ImageStore import (ImageStore, StoredImage, get_shared_image_store, render_claude_messages,
+                                render_google_messages)
+from modules.TurnStore import Turn
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"pixels" * 10
+
+
+def test_identical_images_are_stored_once():
+    store = ImageStore()
+    first = store.intern(PNG, "image/png")
+    second = store.intern(bytes(PNG), "image/png")
+    assert first is second
+    assert store.get_stats() == {"images": 1, "bytes": len(PNG), "stored": 1, "shared": 1}
+
+
+def test_images_are_freed_with_the_last_holder():
+    store = ImageStore()
+    holders = [store.intern(PNG, "image/png") for _ in range(3)]
+    del holders[:2]
+    gc.collect()
+    assert store.get_stats()["images"] == 1
+    del holders
+    gc.collect()
+    assert store.get_stats()["images"] == 0
+
+
+def test_claude_images_are_rendered_as_base64_sources():
+    image = ImageStore().intern(PNG, "image/png")
+    text_message = {"role": "assistant", "content": [{"type": "text", "text": "hi"}]}
+    image_message = {"role": "user", "content": [{"type": "text", "text": "look"},
+                                                 {"type": "image", "source": image}]}
+    rendered = render_claude_messages([text_message, image_message])
+    assert rendered[0] is text_message
+    assert rendered[1]["content"][1]["source"] == {"type": "base64", "media_type": "image/png",
+                                                   "data": base64.b64encode(PNG).decode("ascii")}
+    # The stored message keeps the compact form
+    assert image_message["content"][1]["source"] is image
+
+
+def test_google_images_are_rendered_as_blobs_sharing_the_bytes():
+    image = ImageStore().intern(PNG, "image/png")
+    rendered = render_google_messages([{"role": "user", "parts": [image, "look"]}])
+    assert rendered[0]["parts"][0] == {"mime_type": "image/png", "data": PNG}
+    assert rendered[0]["parts"][0]["data"] is image.data
+
+
+def test_stored_images_round_trip_through_persistence(tmp_path):
+    path = str(tmp_path / "conversations.sqlite3")
+    options = dict(conversation_prune_after_seconds=0, max_dialogues_per_conversation=5, model="claude-test")
+    image = get_shared_image_store().intern(PNG, "image/png")
+    store = SQLiteConversationStore(path)
+    container = ClaudeConversationContainer(store=store, **options)
+    for conversation_id in ("a", "b"):
+        container.get_conversation(conversation_id, "claude-test").add(
+            turn=Turn(""), response_text="ok", image=image)
+    store.close()
+
+    store = SQLiteConversationStore(path)
+    container = ClaudeConversationContainer(store=store, **options)
+    restored = [container.get_conversation(conversation_id, "claude-test").dialogues[0].image
+                for conversation_id in ("a", "b")]
+    assert isinstance(restored[0], StoredImage)
+    assert restored[0] is restored[1] is image
+    store.close()
@@ -0,0 +1,19 @@
+from modules.LatencyStats import LatencyRegistry, LatencyWindow
+
+
+def test_percentiles_over_the_window():
+    window = LatencyWindow(max_samples=100)
+    assert window.percentile(95) is None
+    for index in range(200):
+        window.record(index / 1000)
+    # Only the last 100 samples (0.100 .. 0.199) are kept
+    assert window.percentile(50) == 0.15
+    assert window.percentile(95) == 0.195
+    assert window.percentile(95, min_samples=101) is None
+    assert window.get_stats()["count"] == 200
+
+
+def test_registry_reports_every_window():
+    registry = LatencyRegistry()
+    registry.record("race", 0.25)
+    assert registry.get_stats() == {"race": {"count": 1, "p50_ms": 250.0, "p95_ms": 250.0, "p99_ms": 250.0}}
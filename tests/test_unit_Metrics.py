@@ -0,0 +1,66 @@
+from modules.Metrics import Counter, Histogram, Metrics, merge_families
+
+
+def test_counters_and_gauges_render_with_labels():
+    metrics = Metrics()
+    metrics.upstream_errors.inc("gpt-4o", "ReadTimeout")
+    metrics.upstream_errors.inc("gpt-4o", "ReadTimeout")
+    metrics.record_tokens("gpt-4o", 12, 30, "usage")
+    metrics.requests_in_flight.inc()
+    metrics.requests_in_flight.inc()
+    metrics.requests_in_flight.dec()
+
+    text = metrics.render(metrics.collect())
+    assert "# TYPE neosgpt_upstream_errors_total counter" in text
+    assert 'neosgpt_upstream_errors_total{model="gpt-4o",type="ReadTimeout"} 2' in text
+    assert 'neosgpt_prompt_tokens_total{model="gpt-4o",source="usage"} 12' in text
+    assert 'neosgpt_response_tokens_total{model="gpt-4o",source="usage"} 30' in text
+    assert "neosgpt_requests_in_flight 1" in text
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = Metrics()
+    for seconds in (0.07, 0.3, 0.3, 200):
+        metrics.upstream_latency.observe(seconds, "claude")
+
+    lines = metrics.render(metrics.collect()).splitlines()
+    assert 'neosgpt_upstream_latency_seconds_bucket{model="claude",le="0.05"} 0' in lines
+    assert 'neosgpt_upstream_latency_seconds_bucket{model="claude",le="0.1"} 1' in lines
+    assert 'neosgpt_upstream_latency_seconds_bucket{model="claude",le="0.5"} 3' in lines
+    assert 'neosgpt_upstream_latency_seconds_bucket{model="claude",le="120"} 3' in lines
+    assert 'neosgpt_upstream_latency_seconds_bucket{model="claude",le="+Inf"} 4' in lines
+    assert 'neosgpt_upstream_latency_seconds_count{model="claude"} 4' in lines
+    assert 'neosgpt_upstream_latency_seconds_sum{model="claude"} 200.67' in lines
+
+
+def test_label_values_are_escaped():
+    counter = Counter("errors_total", "Errors", ["type"])
+    counter.inc('bad "quote"\n')
+    metrics = Metrics()
+    assert 'errors_total{type="bad \\"quote\\"\\n"} 1' in metrics.render([counter.collect()])
+
+
+def test_families_from_several_processes_are_summed():
+    first, second = Metrics(), Metrics()
+    first.prompt_tokens.inc("gpt-4o", "usage", amount=5)
+    second.prompt_tokens.inc("gpt-4o", "usage", amount=7)
+    second.prompt_tokens.inc("claude", "usage", amount=1)
+    first.image_fetch.observe(0.02)
+    second.image_fetch.observe(3)
+
+    merged = {family.name: family for family in merge_families([first.collect(), second.collect()])}
+    assert merged["neosgpt_prompt_tokens_total"].samples == {("gpt-4o", "usage"): 12, ("claude", "usage"): 1}
+    image_fetch = merged["neosgpt_image_fetch_seconds"].samples[()]
+    assert image_fetch.count == 2
+    assert sum(image_fetch.bucket_counts) == 2
+    # Merging doesn't touch the collected families
+    assert first.collect()[2].samples == {("gpt-4o", "usage"): 5}
+
+
+def test_histogram_rejects_wrong_labels():
+    histogram = Histogram("latency_seconds", "Latency", ["model"])
+    try:
+        histogram.observe(1.0)
+    except ValueError:
+        return
+    assert False, "expected a ValueError"
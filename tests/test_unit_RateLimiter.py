@@ -0,0 +1,57 @@
+from modules.RateLimiter import RateLimiter, format_retry_after
+
+
+def test_burst_then_sustained_rate():
+    limiter = RateLimiter(caller_rate=1.0, caller_burst=3)
+    assert [limiter.acquire("a", ["m"], now=0) for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire("a", ["m"], now=0) == 1.0
+    # Other callers have their own bucket
+    assert limiter.acquire("b", ["m"], now=0) == 0
+    assert limiter.acquire("a", ["m"], now=1.0) == 0
+    assert limiter.get_stats()["limited"] == 1
+
+
+def test_model_costs_are_weighted():
+    limiter = RateLimiter(caller_rate=1.0, caller_burst=4, model_costs={"big": 3})
+    assert limiter.acquire("a", ["big"], now=0) == 0
+    assert limiter.acquire("a", ["small", "small-2"], now=0) == 1.0
+    assert limiter.acquire("a", ["small"], now=0) == 0
+
+
+def test_requests_costing_more_than_the_burst_are_not_capped():
+    limiter = RateLimiter(caller_rate=1.0, caller_burst=3, model_costs={"big": 2})
+    assert not limiter.exceeds_burst(["m1", "big"])
+    assert limiter.exceeds_burst(["m1", "m2", "big"])
+    # Every model of a request counts, however many there are
+    assert limiter.get_cost(["m1", "m2", "big"]) == 4
+    assert not RateLimiter().exceeds_burst(["m1", "m2", "big"])
+
+
+def test_rejected_requests_charge_no_bucket():
+    limiter = RateLimiter(caller_rate=1.0, caller_burst=5, model_rate=1.0, model_burst=1)
+    assert limiter.acquire("a", ["m"], now=0) == 0
+    assert limiter.acquire("a", ["m"], now=0) == 1.0
+    # The caller bucket was not charged for the rejected request
+    assert limiter.buckets[("caller", "a")].tokens == 4
+    assert limiter.acquire("a", ["other"], now=0) == 0
+
+
+def test_full_buckets_expire():
+    limiter = RateLimiter(caller_rate=1.0, caller_burst=2)
+    limiter.acquire("a", ["m"], now=0)
+    limiter.acquire("b", ["m"], now=0.5)
+    assert limiter.get_stats()["buckets"] == 2
+    limiter.acquire("c", ["m"], now=1.2)
+    # Only a has refilled completely
+    assert set(limiter.buckets) == {("caller", "b"), ("caller", "c")}
+
+
+def test_disabled_limiter_admits_everything():
+    limiter = RateLimiter()
+    assert all(limiter.acquire("a", ["m"], now=0) == 0 for _ in range(100))
+    assert limiter.get_stats()["buckets"] == 0
+
+
+def test_retry_after_is_rounded_up():
+    assert format_retry_after(0.2) == "1"
+    assert format_retry_after(2.1) == "3"
@@ -0,0 +1,44 @@
+from modules.ResponseCache import ResponseCache
+
+
+def key(prompt: str, model: str = "gpt-4o", image_hash: str = None):
+    return ResponseCache.make_key(model=model, prompt=prompt, image_hash=image_hash, temperature=0.5,
+                                  system_message=None)
+
+
+def test_hit_after_put_with_normalized_prompt():
+    cache = ResponseCache()
+    cache.put(key("Hello   there "), "hi!")
+    assert cache.get(key(" Hello there")) == "hi!"
+    assert cache.get(key("Hello there", image_hash="abc")) is None
+    assert cache.get(key("Hello there", model="other")) is None
+    stats = cache.get_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+
+
+def test_entries_expire():
+    cache = ResponseCache(ttl_seconds=0)
+    cache.put(key("a"), "b")
+    assert cache.get(key("a")) is None
+    assert cache.get_stats()["entries"] == 0
+
+
+def test_least_recently_used_is_evicted():
+    cache = ResponseCache(max_entries=2)
+    cache.put(key("a"), "1")
+    cache.put(key("b"), "2")
+    cache.get(key("a"))
+    cache.put(key("c"), "3")
+    assert cache.get(key("b")) is None
+    assert cache.get(key("a")) == "1"
+    assert cache.get_stats()["evictions"] == 1
+
+
+def test_memory_bound():
+    cache = ResponseCache(max_bytes=1000)
+    for index in range(10):
+        cache.put(key(str(index)), "x" * 300)
+    assert cache.get_stats()["bytes"] <= 1000
+    cache.put(key("huge"), "x" * 5000)
+    assert cache.get(key("huge")) is None
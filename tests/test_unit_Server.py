@@ -0,0 +1,244 @@
+import asyncio
+import time
+from werkzeug.test import Client
+from modules.Server import Server
+from modules.AsyncServer import AsyncServer
+from modules.Metrics import Metrics, set_shared_metrics
+from modules.ResponseCache import ResponseCache
+
+
+def make_server(server_class, config, fake_clients):
+    openai_client, google_client, claude_client = fake_clients
+    return server_class(openai_api_client=openai_client, google_ai_api_client=google_client,
+                        claude_api_client=claude_client, config=config)
+
+
+def call_asgi(app, path: str, query: bytes, body: bytes, method: str = "POST"):
+    sent = []
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "path": path, "method": method, "client": ("127.0.0.1", 1234), "query_string": query}
+    asyncio.run(app(scope, receive, send))
+    return sent[0]["status"], b"".join(message.get("body", b"") for message in sent[1:])
+
+
+def test_sync_server_single_model(config, fake_clients):
+    server = make_server(Server, config, fake_clients)
+    response = Client(server.app).post("/prompt?models=gpt-4o", data=b"hello")
+    assert response.status_code == 200
+    assert response.data == b"gpt-4o: hello"
+
+
+def test_sync_server_rejects_invalid_model(config, fake_clients):
+    server = make_server(Server, config, fake_clients)
+    response = Client(server.app).post("/prompt?models=not-a-model", data=b"hello")
+    assert response.status_code == 400
+
+
+def test_async_server_combines_models(config, fake_clients):
+    server = make_server(AsyncServer, config, fake_clients)
+    query = f"models=gpt-4o,{config.claude_model}&conversation_id=abc".encode()
+    status, body = call_asgi(server, "/prompt", query, b"hello")
+    assert status == 200
+    assert body.decode() == (f"Response from model 'gpt-4o':\ngpt-4o: hello\n\n\n"
+                             f"Response from model '{config.claude_model}':\nclaude: hello")
+    assert fake_clients[2].calls == [("hello", None, "abc", None)]
+
+
+def test_async_server_unknown_route(config, fake_clients):
+    server = make_server(AsyncServer, config, fake_clients)
+    status, _ = call_asgi(server, "/nope", b"", b"")
+    assert status == 404
+
+
+def test_sync_server_streams_models_in_order(config, fake_clients):
+    server = make_server(Server, config, fake_clients)
+    query = f"models=gpt-4o,{config.google_model}&stream=true"
+    response = Client(server.app).post("/prompt?" + query, data=b"hello there")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert response.data.decode() == (f"Response from model 'gpt-4o':\ngpt-4o: hello there\n\n\n"
+                                      f"Response from model '{config.google_model}':\ngoogle: hello there")
+
+
+def test_async_server_streams_chunks(config, fake_clients):
+    server = make_server(AsyncServer, config, fake_clients)
+    status, body = call_asgi(server, "/prompt", b"models=gpt-4o&stream=1", b"hello there")
+    assert status == 200
+    assert body == b"gpt-4o: hello there"
+
+
+def test_stateless_prompts_are_served_from_the_response_cache(config, fake_clients):
+    server = make_server(Server, config, fake_clients)
+    server.response_cache = ResponseCache()
+    client = Client(server.app)
+    assert client.post("/prompt?models=gpt-4o", data=b"hello").data == b"gpt-4o: hello"
+    assert client.post("/prompt?models=gpt-4o", data=b" hello ").data == b"gpt-4o: hello"
+    assert len(fake_clients[0].calls) == 1
+    # Conversations are never served from the cache
+    client.post("/prompt?models=gpt-4o&conversation_id=abc", data=b"hello")
+    assert len(fake_clients[0].calls) == 2
+    assert server.get_stats()["response_cache"]["hits"] == 1
+
+
+def test_identical_concurrent_prompts_are_coalesced(config, fake_clients):
+    server = make_server(AsyncServer, config, fake_clients)
+    original_call_model_async = server.call_model_async
+
+    async def slow_call_model_async(*args):
+        await asyncio.sleep(0.05)
+        return await original_call_model_async(*args)
+
+    server.call_model_async = slow_call_model_async
+
+    async def main():
+        return await asyncio.gather(server.send_prompt_async(["gpt-4o"], "hello", None, None),
+                                    server.send_prompt_async(["gpt-4o"], "hello", None, None),
+                                    server.send_prompt_async(["gpt-4o"], "hello", None, "abc"))
+
+    assert asyncio.run(main()) == ["gpt-4o: hello"] * 3
+    # The conversation prompt always goes upstream on its own
+    assert len(fake_clients[0].calls) == 2
+    assert server.get_stats()["coalescing"]["collapsed"] == 1
+
+
+def test_rate_limited_requests_get_retry_after(config, fake_clients):
+    config.rate_limit_caller_requests_per_minute = 1
+    config.rate_limit_caller_burst = 3
+    sync_server = make_server(Server, config, fake_clients)
+    client = Client(sync_server.app)
+    # gpt-4o costs 2, so asking it with two other models at once could never fit in the burst
+    assert client.post("/prompt?models=gpt-4o,gpt-4o-mini,gemini-1.5-flash", data=b"hello").status_code == 400
+    assert client.post("/prompt?models=gpt-4o", data=b"hello").status_code == 200
+    response = client.post("/prompt?models=gpt-4o", data=b"hello")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+
+    async_server = make_server(AsyncServer, config, fake_clients)
+    assert call_asgi(async_server, "/prompt", b"models=gpt-4o", b"hello")[0] == 200
+    assert call_asgi(async_server, "/prompt", b"models=gpt-4o", b"hello")[0] == 429
+
+
+def with_latencies(server, latencies, failing=()):
+    """Replace the upstream call so each model answers after its latency, or fails if it is in failing."""
+    def call_model(model, text, image_url, conversation_id, deadline=None):
+        time.sleep(latencies[model])
+        if model in failing:
+            raise RuntimeError(f"{model} is down")
+        return f"{model}: {text}"
+
+    async def call_model_async(model, text, image_url, conversation_id, deadline=None):
+        await asyncio.sleep(latencies[model])
+        if model in failing:
+            raise RuntimeError(f"{model} is down")
+        return f"{model}: {text}"
+
+    server.call_model = call_model
+    server.call_model_async = call_model_async
+    return server
+
+
+def test_race_returns_first_successful_answer(config, fake_clients):
+    server = with_latencies(make_server(Server, config, fake_clients), {"gpt-4o": 0.3, "gpt-4o-mini": 0.01})
+    response = Client(server.app).post("/prompt?models=gpt-4o,gpt-4o-mini&strategy=race", data=b"hi")
+    assert response.data == b"gpt-4o-mini: hi"
+    assert response.headers["X-Fan-Out-Strategy"] == "race"
+    assert response.headers["X-Answered-Models"] == "gpt-4o-mini"
+
+    # A fast failure doesn't win the race
+    server = with_latencies(make_server(Server, config, fake_clients), {"gpt-4o": 0.05, "gpt-4o-mini": 0.01},
+                            failing={"gpt-4o-mini"})
+    result = server.fan_out(["gpt-4o", "gpt-4o-mini"], "hi", None, None, strategy="race")
+    assert result.answered_models == ["gpt-4o"]
+
+
+def test_hedged_fires_backup_only_when_primary_is_slow(config, fake_clients):
+    config.fan_out_hedge_delay_ms = 50
+    server = with_latencies(make_server(Server, config, fake_clients), {"gpt-4o": 0.01, "gpt-4o-mini": 0.01})
+    calls = []
+    original_send_to_model = server.send_to_model
+    server.send_to_model = lambda model, *args: calls.append(model) or original_send_to_model(model, *args)
+    assert server.fan_out(["gpt-4o", "gpt-4o-mini"], "hi", None, None, strategy="hedged").text == "gpt-4o: hi"
+    assert calls == ["gpt-4o"]
+
+    server = with_latencies(make_server(AsyncServer, config, fake_clients), {"gpt-4o": 0.5, "gpt-4o-mini": 0.01})
+    result = asyncio.run(server.fan_out_async(["gpt-4o", "gpt-4o-mini"], "hi", None, None, strategy="hedged"))
+    assert result.answered_models == ["gpt-4o-mini"]
+    assert server.get_stats()["latency"]["strategies"]["hedged"]["count"] == 1
+
+
+def test_deadline_returns_what_has_answered(config, fake_clients):
+    latencies = {"gpt-4o": 0.5, "gpt-4o-mini": 0.01, config.claude_model: 0.01}
+    models = ["gpt-4o", "gpt-4o-mini", config.claude_model]
+    server = with_latencies(make_server(Server, config, fake_clients), latencies)
+    result = server.fan_out(models, "hi", None, None, strategy="deadline", deadline_ms=200)
+    assert result.answered_models == ["gpt-4o-mini", config.claude_model]
+    assert "gpt-4o:" not in result.text
+
+    server = with_latencies(make_server(AsyncServer, config, fake_clients), latencies)
+    status, body = call_asgi(server, "/prompt", b"models=gpt-4o&strategy=deadline&deadline_ms=50", b"hi")
+    assert (status, body) == (200, b"No model answered within 50 ms")
+
+
+def test_deadlines_reach_the_upstream_calls(config, fake_clients):
+    openai_client = fake_clients[0]
+    server = make_server(Server, config, fake_clients)
+    started = time.monotonic()
+    server.fan_out(["gpt-4o"], "hi", None, None, strategy="deadline", deadline_ms=5000)
+    assert started + 5 <= openai_client.deadlines[-1] <= time.monotonic() + 5
+    server.fan_out(["gpt-4o"], "hi", None, None)
+    assert openai_client.deadlines[-1] is None
+
+    async_server = make_server(AsyncServer, config, fake_clients)
+    started = time.monotonic()
+    call_asgi(async_server, "/prompt", b"models=gpt-4o&strategy=deadline&deadline_ms=5000", b"hi")
+    assert started + 5 <= openai_client.deadlines[-1] <= time.monotonic() + 5
+
+
+def test_async_race_cancels_the_losers(config, fake_clients):
+    server = with_latencies(make_server(AsyncServer, config, fake_clients), {"gpt-4o": 5, "gpt-4o-mini": 0.01})
+
+    async def main():
+        result = await server.fan_out_async(["gpt-4o", "gpt-4o-mini"], "hi", None, None, strategy="race")
+        await asyncio.sleep(0)
+        return result, server.single_flight.get_stats()["in_flight"]
+
+    result, in_flight = asyncio.run(main())
+    assert result.text == "gpt-4o-mini: hi"
+    assert in_flight == 0
+
+
+def test_invalid_strategies_are_rejected(config, fake_clients):
+    client = Client(make_server(Server, config, fake_clients).app)
+    assert client.post("/prompt?models=gpt-4o&strategy=fastest", data=b"hi").status_code == 400
+    assert client.post("/prompt?models=gpt-4o&strategy=race&stream=1", data=b"hi").status_code == 400
+    assert client.post("/prompt?models=gpt-4o&strategy=deadline&deadline_ms=soon", data=b"hi").status_code == 400
+
+
+def test_metrics_endpoint(config, fake_clients):
+    set_shared_metrics(Metrics())
+    server = with_latencies(make_server(Server, config, fake_clients), {"gpt-4o": 0, config.claude_model: 0},
+                            failing=[config.claude_model])
+    client = Client(server.app)
+    client.post(f"/prompt?models=gpt-4o,{config.claude_model}", data=b"hello")
+    client.post("/prompt?models=gpt-4o&conversation_id=abc", data=b"hello")
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    text = response.data.decode()
+    assert 'neosgpt_upstream_latency_seconds_count{model="gpt-4o"} 2' in text
+    assert f'neosgpt_upstream_errors_total{{model="{config.claude_model}",type="RuntimeError"}} 1' in text
+    assert "neosgpt_requests_in_flight 0" in text
+    assert "neosgpt_upstream_in_flight 0" in text
+    assert "neosgpt_rate_limited_total 0" in text
+
+    status, body = call_asgi(make_server(AsyncServer, config, fake_clients), "/metrics", b"", b"", method="GET")
+    assert status == 200
+    assert 'neosgpt_upstream_latency_seconds_count{model="gpt-4o"} 2' in body.decode()
@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from modules.SingleFlight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(flight.do, "key", fn) for _ in range(8)]
+        # Let every caller join the flight before the leader finishes
+        while flight.get_stats()["collapsed"] < 7:
+            threading.Event().wait(0.01)
+        release.set()
+        results = [future.result(5) for future in futures]
+
+    assert results == ["result"] * 8
+    assert len(calls) == 1
+    assert flight.get_stats() == {"executed": 1, "collapsed": 7, "in_flight": 0}
+
+
+def test_errors_reach_every_waiter():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fn():
+        release.wait(5)
+        raise RuntimeError("upstream down")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(flight.do, "key", fn) for _ in range(4)]
+        while flight.get_stats()["collapsed"] < 3:
+            threading.Event().wait(0.01)
+        release.set()
+        for future in futures:
+            with pytest.raises(RuntimeError, match="upstream down"):
+                future.result(5)
+
+    # A failed flight is not remembered, the next call runs again
+    assert flight.do("key", lambda: "ok") == "ok"
+
+
+def test_async_calls_share_one_execution():
+    flight = SingleFlight()
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async("key", fn) for _ in range(5)),
+                                    flight.do_async("other", fn))
+
+    assert asyncio.run(main()) == ["result"] * 6
+    assert len(calls) == 2
+    assert flight.get_stats() == {"executed": 2, "collapsed": 4, "in_flight": 0}
+
+
+def test_async_call_is_cancelled_only_when_every_waiter_leaves():
+    flight = SingleFlight()
+    started = []
+
+    async def fn():
+        started.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def main():
+        first = asyncio.ensure_future(flight.do_async("key", fn))
+        second = asyncio.ensure_future(flight.do_async("key", fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == "result"
+
+        lone = asyncio.ensure_future(flight.do_async("key", fn))
+        await asyncio.sleep(0)
+        lone.cancel()
+        await asyncio.sleep(0)
+        # The abandoned call is gone, so the next caller starts a fresh one
+        assert await flight.do_async("key", fn) == "result"
+
+    asyncio.run(main())
+    assert len(started) == 3
+    assert flight.get_stats()["in_flight"] == 0
@@ -0,0 +1,77 @@
+import gc
+import pytest
+from modules.Conversation import ClaudeConversation, GoogleAIConversation, OpenAIConversation
+from modules.Dialogue import IMAGE_PLACEHOLDER
+from modules.TurnStore import TurnStore, get_shared_turn_store
+from modules.helpers import prompt_helpers
+
+MODEL = "test-model"
+
+
+class WordEncoding:
+    def encode_ordinary(self, text):
+        return text.split()
+
+    def encode_ordinary_batch(self, texts):
+        return [self.encode_ordinary(text) for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def word_encoding(monkeypatch):
+    monkeypatch.setitem(prompt_helpers.encodings, MODEL, WordEncoding())
+
+
+def test_identical_turns_are_stored_once():
+    store = TurnStore()
+    first = store.get_turn("look", "http://images/cat.png")
+    assert store.get_turn("look", "http://images/cat.png") is first
+    text_only = store.get_turn("look")
+    assert text_only is not first
+    assert store.get_stats() == {"turns": 2, "stored": 2, "shared": 1}
+
+
+def test_each_model_branch_shares_the_turn():
+    turn = TurnStore().get_turn("what is this", "http://images/cat.png")
+    branches = [OpenAIConversation(max_length=5, model=MODEL), ClaudeConversation(max_length=5, model=MODEL),
+                GoogleAIConversation(max_length=5, model=MODEL)]
+    for conversation, answer in zip(branches, ("a cat", "a kitten", "a feline")):
+        conversation.add(turn=turn, response_text=answer)
+    assert all(conversation.dialogues[0].turn is turn for conversation in branches)
+    assert [conversation.dialogues[0].response_text for conversation in branches] == ["a cat", "a kitten", "a feline"]
+    assert branches[0].get_messages_for_api()[0]["content"][1] == {"type": "image_url",
+                                                                   "image_url": {"url": "http://images/cat.png"}}
+    # Claude and Gemini were not sent an image of their own, so they only see the text
+    assert branches[1].get_messages_for_api()[0]["content"] == [{"type": "text", "text": "what is this"}]
+    assert branches[2].get_messages_for_api()[0]["parts"] == ["what is this"]
+
+
+def test_turns_are_freed_with_the_last_branch():
+    store = TurnStore()
+    branches = [OpenAIConversation(max_length=1, model=MODEL), ClaudeConversation(max_length=1, model=MODEL)]
+    for conversation in branches:
+        conversation.add(turn=store.get_turn("a"), response_text="b")
+    branches[0].add(turn=store.get_turn("c"), response_text="d")
+    gc.collect()
+    assert store.get_stats()["turns"] == 2
+    branches[1].add(turn=store.get_turn("e"), response_text="f")
+    gc.collect()
+    assert sorted(text for text, _ in store.turns.keys()) == ["c", "e"]
+
+
+def test_dialogues_saved_as_messages_are_restored_onto_shared_turns():
+    openai = OpenAIConversation.from_dict({"model": MODEL, "update_epoch": 1, "dialogues": [{
+        "prompt_message": {"role": "user", "content": [{"type": "text", "text": "a b"},
+                                                       {"type": "text", "text": IMAGE_PLACEHOLDER}]},
+        "response_message": {"role": "assistant", "content": "c"},
+        "prompt_num_tokens": 2, "response_num_tokens": 1}]}, max_length=5)
+    claude = ClaudeConversation.from_dict({"model": MODEL, "update_epoch": 1, "dialogues": [{
+        "prompt_contents": {"role": "user", "content": [{"type": "text", "text": "a b"}]}, "response_text": "d"}]},
+        max_length=5)
+    dialogue = openai.dialogues[0]
+    assert dialogue.turn is claude.dialogues[0].turn is get_shared_turn_store().get_turn("a b")
+    assert dialogue.image_stripped
+    assert dialogue.prompt_message["content"][1] == {"type": "text", "text": IMAGE_PLACEHOLDER}
+    # And are saved again in the shared form
+    restored = OpenAIConversation.from_dict(openai.to_dict(), max_length=5)
+    assert restored.dialogues[0].turn is dialogue.turn
+    assert restored.dialogues[0].to_dict() == dialogue.to_dict()
@@ -0,0 +1,123 @@
+import asyncio
+import os
+import time
+import pytest
+from modules.WorkerPool import WorkerPool
+
+
+class FakeRouter:
+    """Stands in for ModelRouter inside the workers, keeping per-conversation turn counts in the worker process."""
+    def __init__(self):
+        self.turns = {}
+
+    def send_prompt(self, model, text, image_url, conversation_id, deadline=None):
+        if model == "budget":
+            return f"{deadline - time.monotonic():.1f}"
+        if model == "boom":
+            raise ValueError("upstream exploded")
+        if model == "slow":
+            time.sleep(30)
+        if model.endswith("sleepy"):
+            time.sleep(1)
+        if conversation_id is not None:
+            self.turns[conversation_id] = self.turns.get(conversation_id, 0) + 1
+        return f"{os.getpid()}:{self.turns.get(conversation_id, 0)}:{text}"
+
+    def get_provider(self, model):
+        return model.split("/")[0]
+
+    def stream_prompt(self, model, text, image_url, conversation_id):
+        return iter(text.split())
+
+    def get_stats(self):
+        return {"conversations": len(self.turns)}
+
+    def close(self):
+        pass
+
+
+def create_fake_router(config_path):
+    return FakeRouter()
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(config_path="unused.ini", num_workers=2, threads_per_worker=4, router_factory=create_fake_router)
+    yield pool
+    pool.close(timeout_seconds=5)
+
+
+def test_conversations_stick_to_one_worker(pool):
+    responses = [pool.send_prompt("m", "hi", None, "abc") for _ in range(5)]
+    pids = {response.split(":")[0] for response in responses}
+    assert len(pids) == 1
+    # Every turn saw the turns before it, so the conversation lived in that one worker
+    assert [int(response.split(":")[1]) for response in responses] == [1, 2, 3, 4, 5]
+
+    futures = [pool.submit_prompt("m", "hi", None, None) for _ in range(20)]
+    assert all(future.result(10).endswith(":0:hi") for future in futures)
+    assert pool.get_stats()["in_flight"] == [0, 0]
+
+
+def test_errors_and_streams_cross_the_process_boundary(pool):
+    with pytest.raises(ValueError, match="upstream exploded"):
+        pool.send_prompt("boom", "hi", None, None)
+    assert list(pool.stream_prompt("m", "one two three", None, "abc")) == ["one", "two", "three"]
+    assert sorted(pool.get_worker_stats(timeout_seconds=10), key=lambda stats: stats["conversations"]) == \
+        [{"conversations": 0}, {"conversations": 0}]
+
+
+def test_dead_workers_fail_their_calls_and_are_replaced(pool):
+    future = pool.submit_prompt("slow", "hi", None, "abc")
+    worker_index = pool.pick_worker("abc")
+    time.sleep(1)
+    pool.processes[worker_index].kill()
+    with pytest.raises(RuntimeError, match="exited"):
+        future.result(10)
+    assert pool.send_prompt("m", "hi", None, "abc").endswith(":1:hi")
+    assert pool.get_stats()["restarts"] == 1
+
+
+def test_models_of_one_conversation_run_in_parallel(pool):
+    started = time.monotonic()
+    futures = [pool.submit_prompt(model, "hi", None, "abc") for model in ("openai/sleepy", "claude/sleepy", "claude/also-sleepy")]
+    for future in futures:
+        future.result(10)
+    elapsed = time.monotonic() - started
+    # The two providers' branches overlap, while the two models of one provider share a branch and take turns
+    assert 2 <= elapsed < 2.8
+
+
+def test_turns_of_a_conversation_run_in_the_order_received(pool):
+    futures = [pool.submit_prompt("m", str(i), None, "ordered") for i in range(40)]
+    responses = [future.result(10).split(":") for future in futures]
+    assert [(int(turns), text) for _, turns, text in responses] == [(i + 1, str(i)) for i in range(40)]
+
+
+def test_waiting_turns_dont_hold_up_other_conversations(pool):
+    conversation_ids = [conversation_id for conversation_id in (f"c{i}" for i in range(100))
+                        if pool.pick_worker(conversation_id) == 0][:2]
+    started = time.monotonic()
+    futures = [pool.submit_prompt("openai/sleepy", "hi", None, conversation_id)
+               for conversation_id in conversation_ids for _ in range(2)]
+    for future in futures:
+        future.result(10)
+    # Two turns one after the other for each conversation, the conversations side by side
+    assert 2 <= time.monotonic() - started < 2.8
+
+
+def test_async_streams_are_read_on_the_event_loop(pool):
+    async def read_streams():
+        streams = [pool.stream_prompt_async("m", f"one two {i}", None, None) for i in range(20)]
+        return await asyncio.gather(*[collect(stream) for stream in streams])
+
+    async def collect(stream):
+        return [chunk async for chunk in stream]
+
+    assert asyncio.run(read_streams()) == [["one", "two", str(i)] for i in range(20)]
+
+
+def test_deadlines_reach_the_workers(pool):
+    # Less whatever the worker took to start up and pick the task up
+    assert 1 < float(pool.send_prompt("budget", "hi", None, None, deadline=time.monotonic() + 4)) <= 4
+    assert pool.send_prompt("m", "hi", None, None).endswith(":0:hi")
@@ -0,0 +1,56 @@
+import json
+import pytest
+from modules.Conversation import OpenAIConversation
+from modules.TurnStore import Turn
+from modules.helpers import json_helpers, prompt_helpers
+from modules.helpers.json_helpers import EncodedMessages, dumps, dumps_body, encode_messages
+
+MODEL = "test-model"
+MESSAGE = {"role": "user", "content": [{"type": "text", "text": "Grüße \"quoted\" ☃\n"}]}
+
+
+class WordEncoding:
+    def encode_ordinary(self, text):
+        return text.split()
+
+    def encode_ordinary_batch(self, texts):
+        return [self.encode_ordinary(text) for text in texts]
+
+
+@pytest.fixture(autouse=True)
+def word_encoding(monkeypatch):
+    monkeypatch.setitem(prompt_helpers.encodings, MODEL, WordEncoding())
+
+
+def test_both_codecs_give_the_same_bytes(monkeypatch):
+    encoded = dumps([MESSAGE, {"n": 1, "x": 0.5, "ok": None}])
+    monkeypatch.setattr(json_helpers, "orjson", None)
+    assert dumps([MESSAGE, {"n": 1, "x": 0.5, "ok": None}]) == encoded
+    assert json.loads(encoded)[0] == MESSAGE
+
+
+def test_encoded_messages_are_spliced_into_the_body():
+    fragments = [encode_messages([MESSAGE, MESSAGE]), b"", encode_messages([MESSAGE])]
+    body = {"model": MODEL, "messages": EncodedMessages(fragments, 3, MESSAGE), "stream": True}
+    assert json.loads(dumps_body(body)) == {"model": MODEL, "messages": [MESSAGE] * 3, "stream": True}
+    assert len(body["messages"]) == 3
+    assert repr(body["messages"]) == f"['<2 earlier>', {MESSAGE!r}]"
+
+
+def test_conversation_encodes_what_it_would_send():
+    conversation = OpenAIConversation(max_length=3, model=MODEL)
+    conversation.image_history_turns = 1
+    conversation.add(turn=Turn("what is this", "http://images/cat.png"), response_text="a cat")
+    conversation.add(turn=Turn("and now?"), response_text="a dog")
+    conversation.set_summary("earlier", 1)
+
+    fragments, count = conversation.get_encoded_messages()
+    messages = json.loads(b"[" + b",".join(fragments) + b"]")
+    assert messages == conversation.get_messages_for_api()
+    assert count == len(messages) == 5
+    # The stripped image was encoded again, and the size follows the new encoding
+    assert messages[1]["content"][1]["type"] == "text"
+    assert b"images/cat.png" not in conversation.dialogues[0].encoded_messages
+    # The responses are only kept encoded, and read back from there
+    assert [dialogue.response for dialogue in conversation.dialogues] == ["a cat", "a dog"]
+    assert conversation.size_bytes == sum(dialogue.size_bytes for dialogue in conversation.dialogues) + len("earlier")
@@ -0,0 +1,49 @@
+import logging
+import queue
+from modules.helpers.logging_helper import BoundedQueueHandler, SampledDebugFilter, Truncated
+
+
+def record(level: int, msg: str = "message", args: tuple = ()) -> logging.LogRecord:
+    return logging.LogRecord("test", level, __file__, 1, msg, args, None)
+
+
+def test_payloads_are_truncated():
+    text = str(Truncated("x" * 1000, max_chars=10))
+    assert text == "xxxxxxxxxx... (990 more chars)"
+    assert str(Truncated("short", max_chars=10)) == "short"
+
+
+def test_logged_body_does_not_grow_with_the_conversation():
+    def body(num_messages):
+        return {"model": "gpt-4o", "messages": [{"role": "user", "content": f"turn {i}"} for i in range(num_messages)]}
+
+    short, long = str(Truncated(body(3), max_chars=1000)), str(Truncated(body(3000), max_chars=1000))
+    assert "<2 earlier>" in short
+    assert "<2999 earlier>" in long and "turn 2999" in long
+    assert len(long) - len(short) < 10
+
+
+def test_payloads_are_only_formatted_when_emitted():
+    class Exploding:
+        def __str__(self):
+            raise AssertionError("formatted a record that was never emitted")
+
+    logger = logging.getLogger("test_logging_helper.lazy")
+    logger.setLevel(logging.INFO)
+    logger.debug("Request body: %s", Truncated(Exploding()))
+
+
+def test_full_queue_drops_records_instead_of_blocking():
+    handler = BoundedQueueHandler(queue.Queue(maxsize=2))
+    for i in range(5):
+        handler.handle(record(logging.INFO, "message %d", (i,)))
+    assert handler.get_stats() == {"queued": 2, "dropped": 3}
+    # Messages are formatted before they're queued, so the listener never sees the arguments
+    assert handler.queue.get_nowait().getMessage() == "message 0"
+
+
+def test_debug_records_are_sampled():
+    sampler = SampledDebugFilter(sample_rate=4)
+    kept = [sampler.filter(record(logging.DEBUG)) for _ in range(12)]
+    assert kept.count(True) == 3
+    assert all(sampler.filter(record(logging.INFO)) for _ in range(5))